@@ -34,7 +34,7 @@ if __name__ == '__main__':
         author=AUTHOR,
         author_email=AUTHOR_EMAIL,
         license=LICENSE,
-        packages=["shuup_correios"],
+        packages=setuptools.find_packages(exclude=EXCLUDED_PACKAGES),
         include_package_data=True,
         install_requires=REQUIRES,
         entry_points={"shuup.addon": "shuup_correios=shuup_correios"}
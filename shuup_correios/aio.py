@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Cliente assíncrono (asyncio) do WebService dos Correios. Requer Python 3.5+.
+
+Utiliza as mesmas chaves de cache, parâmetros e tratamento do retorno do
+cliente síncrono através de `CorreiosWS.PrecoPrazoRequest`.
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from requests.exceptions import ConnectionError, Timeout
+
+from shuup.utils.importing import cached_load
+from shuup_correios.correios import (CORREIOS_WS_PRECO_PRAZO_URL, CorreiosWS,
+                                     CorreiosWSCircuitOpenException,
+                                     CorreiosWSDeadlineExceededException,
+                                     CorreiosWSServerTimeoutException,
+                                     circuit_breaker, latency_tracker,
+                                     record_response_status)
+from shuup_correios.latency import get_retry_delay
+from shuup_correios.signals import preco_prazo_requested, ws_request_finished
+from shuup_correios.transport import get_transport
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+_async_transport = None
+_async_transport_lock = threading.Lock()
+
+AsyncResponse = namedtuple("AsyncResponse", ("status_code", "content"))
+
+
+class AsyncCorreiosTransport(object):
+    """ Interface do transporte HTTP assíncrono utilizado pelo `AsyncCorreiosWS` """
+
+    async def post(self, url, params=None, timeout=None):
+        """
+        Executa uma requisição POST
+
+        :rtype: AsyncResponse
+        """
+        raise NotImplementedError()
+
+    async def close(self):
+        """ Libera as conexões abertas pelo transporte """
+        pass
+
+
+class ExecutorAsyncTransport(AsyncCorreiosTransport):
+    """
+    Executa o transporte síncrono configurado (`get_transport`) no executor
+    padrão do event loop. Não requer dependências adicionais.
+    """
+
+    async def post(self, url, params=None, timeout=None):
+        response = await run_blocking(functools.partial(get_transport().post,
+                                                        url,
+                                                        params=params,
+                                                        timeout=timeout))
+        return AsyncResponse(response.status_code, response.content)
+
+
+class AiohttpTransport(AsyncCorreiosTransport):
+    """
+    Transporte nativo do asyncio com conexões keep-alive. Requer o pacote `aiohttp`.
+
+    A sessão é criada na primeira requisição e fica associada ao event loop
+    em que foi criada.
+    """
+
+    def __init__(self, limit_per_host=None):
+        if aiohttp is None:
+            raise ImproperlyConfigured("AiohttpTransport requer o pacote aiohttp.")
+
+        if limit_per_host is None:
+            limit_per_host = settings.CORREIOS_WEBSERVICE_POOL_MAXSIZE
+
+        self.limit_per_host = limit_per_host
+        self._session = None
+
+    async def post(self, url, params=None, timeout=None):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        params = dict((key, str(value)) for key, value in (params or {}).items())
+
+        try:
+            async with self._session.post(url,
+                                          params=params,
+                                          timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                return AsyncResponse(response.status, await response.read())
+
+        except asyncio.TimeoutError:
+            raise Timeout()
+
+        except aiohttp.ClientConnectionError as exc:
+            # mesmas exceções do transporte síncrono, repetidas pelo `AsyncCorreiosWS`
+            raise ConnectionError(exc)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+async def run_blocking(func, *args):
+    """
+    Executa `func` no executor padrão do event loop. Utilizada para as operações que
+    acessam o cache do Django (cotações, circuito), que são bloqueantes.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+
+def get_async_transport():
+    """
+    Obtém a instância do transporte configurado em `CORREIOS_WEBSERVICE_ASYNC_TRANSPORT_CLASS`,
+    criada uma única vez por processo
+
+    :rtype: AsyncCorreiosTransport
+    """
+    global _async_transport
+
+    if _async_transport is None:
+        with _async_transport_lock:
+            if _async_transport is None:
+                _async_transport = cached_load("CORREIOS_WEBSERVICE_ASYNC_TRANSPORT_CLASS")()
+
+    return _async_transport
+
+
+class AsyncCorreiosWS(object):
+    """ Versão assíncrona do `CorreiosWS` """
+
+    @classmethod
+    async def get_preco_prazo(cls, cep_destino, cep_origem, cod_servico, package, *args, **kwargs):
+        """
+        Versão assíncrona de `CorreiosWS.get_preco_prazo`, com os mesmos parâmetros
+
+        :rtype: shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult
+        """
+        servicos_adicionais = kwargs.pop("servicos_adicionais", None) or []
+        cod_servicos = [cod_servico] + [cod for cod in servicos_adicionais if cod != cod_servico]
+
+        results = await cls.get_preco_prazo_servicos(cep_destino, cep_origem, cod_servicos, package,
+                                                     *args, **kwargs)
+        return results[cod_servico]
+
+    @classmethod
+    async def get_preco_prazo_servicos(cls, *args, **kwargs):
+        """
+        Versão assíncrona de `CorreiosWS.get_preco_prazo_servicos`, com os mesmos parâmetros
+
+        :rtype: collections.OrderedDict[str, shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult]
+        """
+        request = CorreiosWS.PrecoPrazoRequest(*args, **kwargs)
+
+        if not preco_prazo_requested.has_listeners(CorreiosWS):
+            return await cls._get_results(request)
+
+        start = default_timer()
+        try:
+            results = await cls._get_results(request)
+        except Exception as exc:
+            CorreiosWS._send_preco_prazo_requested(request, False, start, exc)
+            raise
+
+        CorreiosWS._send_preco_prazo_requested(request, False, start)
+        return results
+
+    @classmethod
+    async def _get_results(cls, request):
+        # VERIFICA SE AS REQUISIÇÕES ESTÃO NO CACHE
+        missing = await run_blocking(request.load_cached)
+        await run_blocking(CorreiosWS.refresh_stale, request)
+
+        if not missing:
+            return request.results
+
+        if not ws_request_finished.has_listeners(CorreiosWS):
+            response = await cls._post(request)
+            return await run_blocking(request.process_response, response.status_code, response.content)
+
+        cod_servicos = request.missing
+        start = default_timer()
+        try:
+            response = await cls._post(request)
+        except Exception as exc:
+            CorreiosWS._send_ws_request_finished(request, cod_servicos, None, default_timer() - start, None, exc)
+            raise
+
+        http_duration = default_timer() - start
+        start = default_timer()
+        try:
+            results = await run_blocking(request.process_response, response.status_code, response.content)
+        except Exception as exc:
+            CorreiosWS._send_ws_request_finished(request, cod_servicos, response.status_code,
+                                                 http_duration, default_timer() - start, exc)
+            raise
+
+        CorreiosWS._send_ws_request_finished(request, cod_servicos, response.status_code,
+                                             http_duration, default_timer() - start)
+        return results
+
+    @classmethod
+    async def _post(cls, request):
+        """ Versão assíncrona de `CorreiosWS._post`, com as mesmas tentativas """
+        params = request.get_payload()
+        deadline = request.deadline
+        response = None
+        error = None
+
+        for attempt in range(settings.CORREIOS_WEBSERVICE_RETRIES + 1):
+            if attempt:
+                delay = get_retry_delay(attempt)
+                if deadline is not None and delay >= deadline.remaining():
+                    break
+
+                await asyncio.sleep(delay)
+
+            elif deadline is not None and deadline.expired:
+                logger.warning("Correios: prazo do pedido esgotado, requisição não realizada.")
+                raise CorreiosWSDeadlineExceededException()
+
+            if not await run_blocking(circuit_breaker.allow_request):
+                if attempt:
+                    break
+
+                logger.warning("Correios: circuito aberto, requisição não realizada.")
+                raise CorreiosWSCircuitOpenException()
+
+            logger.debug("Correios: Making async request")
+
+            try:
+                response = await cls._send_hedged(params, deadline)
+            except ConnectionError as exc:
+                logger.warning("Correios: erro de conexão com o WS dos Correios (tentativa %d): %r",
+                               attempt + 1, exc)
+                await run_blocking(circuit_breaker.record_failure)
+                response, error = None, exc
+                continue
+
+            await run_blocking(record_response_status, response.status_code)
+
+            if response.status_code < 500:
+                return response
+
+        if response is None:
+            raise error
+
+        return response
+
+    @classmethod
+    async def _send_hedged(cls, params, deadline=None):
+        """ Versão assíncrona de `CorreiosWS._send_hedged` """
+        timeout = latency_tracker.get_timeout()
+        if deadline is not None:
+            timeout = deadline.get_timeout(timeout)
+            if timeout <= 0:
+                raise CorreiosWSDeadlineExceededException()
+
+        hedge_delay = latency_tracker.get_hedge_delay(timeout)
+
+        if hedge_delay is None:
+            return await cls._send(params, timeout, deadline)
+
+        first = asyncio.ensure_future(cls._send(params, timeout, deadline))
+        done, pending = await asyncio.wait([first], timeout=hedge_delay)
+
+        if done:
+            return first.result()
+
+        logger.debug("Correios: Making hedged async request")
+        pending = set([first, asyncio.ensure_future(cls._send(params, timeout - hedge_delay, deadline))])
+        errors = []
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    errors.append(future.exception())
+        finally:
+            for future in pending:
+                future.cancel()
+
+        raise errors[0]
+
+    @classmethod
+    async def _send(cls, params, timeout, deadline=None):
+        """ Versão assíncrona de `CorreiosWS._send` """
+        start = default_timer()
+
+        try:
+            response = await get_async_transport().post(CORREIOS_WS_PRECO_PRAZO_URL,
+                                                        params=params,
+                                                        timeout=timeout)
+
+        except (Timeout, asyncio.TimeoutError) as exc:
+            if isinstance(exc, ConnectionError):
+                raise
+
+            if deadline is not None and deadline.expired:
+                logger.warning("Correios: prazo do pedido esgotado aguardando o WS dos Correios.")
+                raise CorreiosWSDeadlineExceededException()
+
+            logger.exception("Timeout de conexão com o WS dos Correios.")
+            latency_tracker.record(timeout)
+            await run_blocking(circuit_breaker.record_failure)
+            raise CorreiosWSServerTimeoutException()
+
+        latency_tracker.record(default_timer() - start)
+        return response
+
+
+def _prepare_groups(source, components):
+    """
+    Agrupa os componentes com os mesmos parâmetros de cotação, modo de cálculo e
+    empacotamento, empacotando o pedido e obtendo os resultados da tabela de preços
+    de cada grupo. Bloqueante, executada fora do event loop por `get_correios_results`.
+
+    :return: tupla com os grupos e os resultados da tabela de cada componente
+        (None para os pacotes que devem ser consultados no webservice)
+    :rtype: tuple[list[dict], list[list]]
+    """
+    groups = OrderedDict()
+
+    for index, component in enumerate(components):
+        params = component._get_preco_prazo_params(source)
+        if not params:
+            continue
+
+        cod_servico = params.pop("cod_servico")
+        group_key = (tuple(sorted(params.items())), component.pricing_mode, component._get_packing_key())
+        group = groups.setdefault(group_key, {"params": params, "component": component, "servicos": []})
+        group["servicos"].append((index, cod_servico))
+
+    results = [[] for _ in components]
+
+    for group in groups.values():
+        group["packages"] = group["component"]._get_packages(source) or []
+        group["deadline"] = group["component"]._get_deadline(source)
+
+        for index, cod_servico in group["servicos"]:
+            results[index] = components[index]._get_rate_table_results(dict(group["params"],
+                                                                             cod_servico=cod_servico),
+                                                                        group["packages"])
+
+    return list(groups.values()), results
+
+
+async def get_correios_results(source, components):
+    """
+    Versão assíncrona de `CorreiosBehaviorComponent._get_correios_results` para
+    vários componentes de uma vez.
+
+    Todos os pacotes e serviços do pedido são aguardados juntos. Componentes
+    com os mesmos parâmetros de cotação, modo de cálculo e empacotamento são
+    empacotados uma única vez e seus serviços são cotados na mesma requisição
+    por pacote. Os resultados da tabela local de preços são obtidos conforme o
+    modo de cálculo (`CorreiosBehaviorComponent._get_rate_table_results`) e apenas
+    os serviços não atendidos pela tabela são cotados no webservice. As requisições
+    compartilham o prazo do pedido (`CORREIOS_QUOTE_DEADLINE`).
+
+    :type source: shuup.core.order_creator.OrderSource
+    :type components: list[shuup_correios.models.CorreiosBehaviorComponent]
+    :return: Resultados de cada componente, na mesma ordem de `components`
+    :rtype: list[list[shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult]]
+    """
+    # empacotamento, parâmetros e tabela de preços acessam o banco, o cache e arquivos
+    groups, results = await run_blocking(_prepare_groups, source, components)
+    calls = []
+
+    for group in groups:
+        for package_index, package in enumerate(group["packages"]):
+            # apenas os serviços que a tabela não atendeu
+            servicos = [(index, cod_servico) for index, cod_servico in group["servicos"]
+                        if not results[index][package_index]]
+            if not servicos:
+                continue
+
+            cod_servicos = list(OrderedDict.fromkeys(cod_servico for _, cod_servico in servicos))
+            calls.append((servicos, package_index,
+                          AsyncCorreiosWS.get_preco_prazo_servicos(cod_servicos=cod_servicos,
+                                                                   package=package,
+                                                                   deadline=group["deadline"],
+                                                                   **group["params"])))
+
+    tasks = [asyncio.ensure_future(call) for _, _, call in calls]
+
+    try:
+        responses = await asyncio.gather(*tasks)
+    except BaseException:
+        # cancela as requisições restantes no primeiro erro
+        for task in tasks:
+            task.cancel()
+        raise
+
+    for (servicos, package_index, _), response in zip(calls, responses):
+        for index, cod_servico in servicos:
+            results[index][package_index] = response[cod_servico]
+
+    return results
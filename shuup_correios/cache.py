@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class CacheCounter(object):
+    """ Contadores de acertos e faltas de um nível de cache, seguros entre threads """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        """ :rtype: dict """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+class LRUCache(object):
+    """
+    Cache em memória do processo com capacidade limitada e tempo de expiração.
+
+    Ao atingir a capacidade, os itens utilizados há mais tempo são descartados.
+    """
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.counter = CacheCounter()
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """ :return: o valor ou None se não existir ou estiver expirado """
+        with self._lock:
+            item = self._items.get(key)
+
+            if item is not None:
+                expires_at, value = item
+                if time.time() < expires_at:
+                    self._items.move_to_end(key)
+                    self.counter.hit()
+                    return value
+
+                del self._items[key]
+
+        self.counter.miss()
+        return None
+
+    def set(self, key, value, timeout=None):
+        """ Armazena o valor por `timeout` segundos, limitado ao `ttl` do cache """
+        ttl = self.ttl if timeout is None else min(timeout, self.ttl)
+
+        with self._lock:
+            self._items[key] = (time.time() + ttl, value)
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class QuoteCache(object):
+    """
+    Cache das cotações em dois níveis: um `LRUCache` opcional no processo
+    (`CORREIOS_LOCAL_CACHE_ENABLED`) na frente do cache do Django.
+
+    Os valores devem ser imutáveis, pois o nível local retorna a mesma instância
+    para todas as threads.
+    """
+
+    def __init__(self, get_cache, get_remaining_ttl=None):
+        """
+        :param get_cache: função que retorna o cache do Django compartilhado
+        :param get_remaining_ttl: função que retorna o tempo de vida restante, em segundos,
+            de um valor lido do cache compartilhado ou None se desconhecido. Limita o tempo
+            do valor no cache local, para que não sobreviva à entrada do cache compartilhado.
+        """
+        self.get_cache = get_cache
+        self.get_remaining_ttl = get_remaining_ttl
+        self.shared_counter = CacheCounter()
+        self._local = None
+        self._lock = threading.Lock()
+
+    def get_local_cache(self):
+        """
+        Obtém o cache local, criado no primeiro uso
+        :rtype: LRUCache|None
+        """
+        if not settings.CORREIOS_LOCAL_CACHE_ENABLED:
+            return None
+
+        if self._local is None:
+            with self._lock:
+                if self._local is None:
+                    self._local = LRUCache(settings.CORREIOS_LOCAL_CACHE_CAPACITY,
+                                           settings.CORREIOS_LOCAL_CACHE_TTL)
+        return self._local
+
+    def get(self, key):
+        local = self.get_local_cache()
+
+        if local is not None:
+            value = local.get(key)
+            if value is not None:
+                return value
+
+        value = self.get_cache().get(key)
+
+        if value is None:
+            self.shared_counter.miss()
+            return None
+
+        self.shared_counter.hit()
+
+        if local is not None:
+            self._fill_local(local, key, value)
+
+        return value
+
+    def get_many(self, keys):
+        """
+        Obtém vários valores com uma única leitura do cache compartilhado
+        :return: valores encontrados, indexados pela chave
+        :rtype: dict
+        """
+        local = self.get_local_cache()
+        values = {}
+        missing = []
+
+        for key in keys:
+            value = local.get(key) if local is not None else None
+            if value is not None:
+                values[key] = value
+            else:
+                missing.append(key)
+
+        if missing:
+            found = self.get_cache().get_many(missing)
+
+            for key in missing:
+                value = found.get(key)
+                if value is None:
+                    self.shared_counter.miss()
+                    continue
+
+                self.shared_counter.hit()
+                values[key] = value
+                if local is not None:
+                    self._fill_local(local, key, value)
+
+        return values
+
+    def _fill_local(self, local, key, value, timeout=None):
+        """
+        Armazena um valor no cache local, no máximo pelo seu tempo de vida restante
+
+        :param timeout: tempo de expiração do valor no cache compartilhado, quando gravado
+        """
+        remaining = self.get_remaining_ttl(value) if self.get_remaining_ttl is not None else None
+
+        if remaining is not None:
+            if remaining <= 0:
+                return
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        local.set(key, value, timeout)
+
+    def set(self, key, value, timeout):
+        self.get_cache().set(key, value, timeout)
+
+        local = self.get_local_cache()
+        if local is not None:
+            self._fill_local(local, key, value, timeout)
+
+    def set_many(self, values, timeout):
+        """ Grava vários valores com o mesmo tempo de expiração em uma única escrita """
+        self.get_cache().set_many(values, timeout)
+
+        local = self.get_local_cache()
+        if local is not None:
+            for key, value in values.items():
+                self._fill_local(local, key, value, timeout)
+
+    def get_stats(self):
+        """
+        Acertos e faltas de cada nível desde o início do processo
+        :rtype: dict
+        """
+        local = self.get_local_cache()
+        return {
+            "local": local.counter.get_stats() if local is not None else None,
+            "shared": self.shared_counter.get_stats()
+        }
+
+    def reset(self):
+        """ Descarta o cache local e zera os contadores """
+        with self._lock:
+            self._local = None
+        self.shared_counter.reset()
+
+
+class QuoteCacheBatch(object):
+    """
+    Agrupa as leituras e gravações de cotações de um pedido.
+
+    As leituras são feitas com um único `get_many` para todas as chaves e ficam
+    memorizadas, inclusive as ausentes. As gravações são acumuladas e enviadas
+    ao cache com `flush`, em um `set_many` por tempo de expiração.
+    """
+
+    def __init__(self, quote_cache):
+        self.quote_cache = quote_cache
+        self.values = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def load(self, keys):
+        """ Lê do cache, de uma só vez, as chaves ainda não lidas """
+        missing = [key for key in keys if key not in self.values]
+
+        if missing:
+            found = self.quote_cache.get_many(missing)
+            with self._lock:
+                for key in missing:
+                    self.values.setdefault(key, found.get(key))
+
+    def get(self, key):
+        if key not in self.values:
+            self.load([key])
+        return self.values[key]
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self.values[key] = value
+            self._pending.setdefault(timeout, {})[key] = value
+
+    def flush(self, keys=None):
+        """
+        Grava no cache os valores acumulados
+        :param keys: grava apenas os valores destas chaves, mantendo os demais acumulados
+        """
+        with self._lock:
+            if keys is None:
+                pending, self._pending = self._pending, {}
+            else:
+                keys = set(keys)
+                pending = {}
+
+                for timeout, values in list(self._pending.items()):
+                    selected = dict((key, value) for key, value in values.items() if key in keys)
+                    if not selected:
+                        continue
+
+                    pending[timeout] = selected
+                    for key in selected:
+                        del values[key]
+                    if not values:
+                        del self._pending[timeout]
+
+        for timeout, values in pending.items():
+            self.quote_cache.set_many(values, timeout)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Índice local das faixas de CEP válidas, utilizado para rejeitar CEPs
+inexistentes sem consultar o webservice.
+
+O índice é compilado de um arquivo CSV para um arquivo binário compacto com
+`CepIndex.compile` (ou o comando `correios_build_cep_index`) e é mapeado em
+memória, assim os processos compartilham as mesmas páginas e nada é carregado
+além do que é consultado.
+"""
+
+import csv
+import io
+import logging
+import mmap
+import struct
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils.encoding import force_bytes, force_text
+
+from shuup_correios.correios import normalize_cep
+
+logger = logging.getLogger(__name__)
+
+# identificação e versão do formato do arquivo
+MAGIC = b"CEPIDX01"
+
+# cabeçalho: identificação e quantidade de faixas
+HEADER = struct.Struct("<8sI")
+
+# faixa: CEP inicial, CEP final e UF
+RECORD = struct.Struct("<II2s")
+
+_START = struct.Struct("<I")
+
+_cep_index = None
+_cep_index_lock = threading.Lock()
+
+
+class CepIndex(object):
+    """
+    Faixas de CEP [inicial, final] não sobrepostas, ordenadas pelo CEP inicial,
+    com a UF de cada faixa. As consultas são buscas binárias diretamente no arquivo.
+
+    O CSV de origem possui cabeçalho e as colunas `uf`, `cep_inicial` e `cep_final`,
+    normalmente uma linha por localidade. Apenas a UF é mantida no índice e as faixas
+    contíguas da mesma UF são unidas.
+    """
+
+    def __init__(self, buffer):
+        """
+        :param buffer: conteúdo do índice, ex: `mmap.mmap` do arquivo ou `bytes`
+        """
+        if len(buffer) < HEADER.size:
+            raise ValueError("Índice de CEPs inválido.")
+
+        magic, size = HEADER.unpack_from(buffer, 0)
+
+        if magic != MAGIC or len(buffer) != HEADER.size + size * RECORD.size:
+            raise ValueError("Índice de CEPs inválido.")
+
+        self._buffer = buffer
+        self.size = size
+
+    @classmethod
+    def open(cls, path):
+        """
+        Mapeia em memória um índice compilado
+
+        :rtype: CepIndex
+        """
+        with io.open(path, "rb") as index_file:
+            buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        index = cls(buffer)
+        logger.info("Correios: índice de CEPs %s carregado com %d faixas", path, index.size)
+        return index
+
+    @classmethod
+    def build(cls, rows):
+        """
+        Gera o conteúdo do índice
+
+        :param rows: linhas no formato das colunas do arquivo CSV
+        :type rows: Iterable[dict]
+        :raises ValueError: se houver faixas inválidas ou sobrepostas com UFs diferentes
+        :rtype: bytes
+        """
+        ranges = []
+
+        for row in rows:
+            uf = force_text(row["uf"]).strip().upper()
+            start = _to_int_cep(row["cep_inicial"])
+            end = _to_int_cep(row["cep_final"])
+
+            if len(uf) != 2 or start is None or end is None or start > end:
+                raise ValueError("Faixa de CEP inválida: {0}".format(dict(row)))
+
+            ranges.append((start, end, uf))
+
+        ranges.sort()
+        merged = []
+
+        for start, end, uf in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                if merged[-1][2] == uf:
+                    merged[-1][1] = max(merged[-1][1], end)
+                    continue
+
+                if start <= merged[-1][1]:
+                    raise ValueError("Faixas de CEP sobrepostas: {0}-{1} ({2}) e {3}-{4} ({5})".format(
+                        merged[-1][0], merged[-1][1], merged[-1][2], start, end, uf))
+
+            merged.append([start, end, uf])
+
+        return HEADER.pack(MAGIC, len(merged)) + b"".join(
+            RECORD.pack(start, end, force_bytes(uf)) for start, end, uf in merged)
+
+    @classmethod
+    def compile(cls, csv_path, index_path):
+        """
+        Compila o arquivo CSV das faixas de CEP no arquivo do índice
+
+        :return: quantidade de faixas do índice
+        :rtype: int
+        """
+        with io.open(csv_path, encoding="utf-8", newline="") as csv_file:
+            content = cls.build(csv.DictReader(csv_file))
+
+        with io.open(index_path, "wb") as index_file:
+            index_file.write(content)
+
+        return HEADER.unpack_from(content, 0)[1]
+
+    def find(self, cep):
+        """
+        Obtém a UF da faixa que contém o CEP
+
+        :type cep: str
+        :return: A UF ou None se o CEP não pertencer a nenhuma faixa
+        :rtype: str|None
+        """
+        key = _to_int_cep(cep)
+        if key is None:
+            return None
+
+        # última faixa com o CEP inicial menor ou igual ao CEP
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if _START.unpack_from(self._buffer, HEADER.size + middle * RECORD.size)[0] <= key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == 0:
+            return None
+
+        start, end, uf = RECORD.unpack_from(self._buffer, HEADER.size + (low - 1) * RECORD.size)
+        return force_text(uf) if key <= end else None
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+
+def get_cep_index():
+    """
+    Obtém o índice configurado em `CORREIOS_CEP_INDEX_PATH`, mapeado uma única vez por processo
+
+    :rtype: CepIndex|None
+    :return: O índice ou None se não houver índice configurado
+    """
+    global _cep_index
+
+    if _cep_index is None and settings.CORREIOS_CEP_INDEX_PATH:
+        with _cep_index_lock:
+            if _cep_index is None:
+                _cep_index = CepIndex.open(settings.CORREIOS_CEP_INDEX_PATH)
+
+    return _cep_index
+
+
+def reset_cep_index():
+    """ Descarta o índice carregado, que será recarregado na próxima utilização """
+    global _cep_index
+
+    with _cep_index_lock:
+        if _cep_index is not None:
+            _cep_index.close()
+        _cep_index = None
+
+
+def validate_cep(cep, description="CEP"):
+    """
+    Verifica se o CEP possui 8 dígitos e, se houver índice configurado, se ele existe
+
+    :param description: descrição do CEP nas mensagens de erro, ex: "CEP de destino"
+    :raises django.core.exceptions.ValidationError: se o CEP for inválido ou desconhecido
+    :return: o CEP normalizado (`normalize_cep`), apenas com os dígitos
+    :rtype: str
+    """
+    digits = "".join([d for d in force_text(cep or "") if d.isdigit()])
+
+    # aceita o CEP que perdeu o zero à esquerda, ex: 1310100 é 01310100
+    if len(digits) not in (7, 8):
+        raise ValidationError("{0} inválido: {1}.".format(description, cep), code="invalid_cep")
+
+    digits = normalize_cep(digits)
+
+    cep_index = get_cep_index()
+    if cep_index is not None and cep_index.find(digits) is None:
+        raise ValidationError("{0} não encontrado: {1}.".format(description, cep), code="unknown_cep")
+
+    return digits
+
+
+def _to_int_cep(cep):
+    digits = "".join([d for d in force_text(cep or "") if d.isdigit()])
+    if not digits or len(digits) > 8:
+        return None
+    # zeros à esquerda podem ter sido omitidos, ex: 1001000 é 01001000
+    return int(digits)
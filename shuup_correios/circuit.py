@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """
+    Disjuntor para as requisições ao WebService dos Correios.
+
+    O estado é compartilhado entre os processos através do cache. Após
+    `CORREIOS_CIRCUIT_BREAKER_THRESHOLD` falhas consecutivas o circuito abre e as
+    requisições falham imediatamente durante `CORREIOS_CIRCUIT_BREAKER_COOLDOWN`
+    segundos. Depois disso, uma única requisição de teste é liberada: se tiver
+    sucesso o circuito fecha, caso contrário abre novamente.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, get_cache):
+        """
+        :param name: nome do circuito, utilizado nas chaves do cache
+        :param get_cache: função que retorna o cache onde o estado é armazenado
+        """
+        self.name = name
+        self.get_cache = get_cache
+        self.failures_key = "correios:circuit:{0}:failures".format(name)
+        self.open_until_key = "correios:circuit:{0}:open_until".format(name)
+        self.probe_key = "correios:circuit:{0}:probe".format(name)
+
+    @property
+    def enabled(self):
+        return bool(settings.CORREIOS_CIRCUIT_BREAKER_THRESHOLD)
+
+    def get_state(self):
+        """ Obtém o estado atual do circuito """
+        open_until = self.get_cache().get(self.open_until_key)
+        if not open_until:
+            return self.CLOSED
+        if time.time() < open_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow_request(self):
+        """
+        Indica se uma requisição pode ser feita. Com o circuito semiaberto,
+        apenas a primeira chamada entre todos os processos é liberada.
+
+        :rtype: bool
+        """
+        if not self.enabled:
+            return True
+
+        state = self.get_state()
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+
+        return self.get_cache().add(self.probe_key, True, settings.CORREIOS_CIRCUIT_BREAKER_COOLDOWN)
+
+    def record_success(self):
+        """ Registra uma requisição com sucesso, fechando o circuito """
+        if not self.enabled:
+            return
+
+        cache = self.get_cache()
+        if cache.get(self.failures_key) or cache.get(self.open_until_key):
+            cache.delete_many([self.failures_key, self.open_until_key, self.probe_key])
+            logger.info("Correios: circuito %s fechado", self.name)
+
+    def record_failure(self):
+        """ Registra uma falha (timeout ou erro do servidor), abrindo o circuito se necessário """
+        if not self.enabled:
+            return
+
+        cache = self.get_cache()
+        cache.add(self.failures_key, 0, None)
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            # a chave expirou ou foi removida entre o add e o incr
+            failures = 1
+            cache.set(self.failures_key, failures, None)
+
+        # a requisição de teste falhou ou o limite foi atingido
+        if cache.get(self.probe_key) or failures >= settings.CORREIOS_CIRCUIT_BREAKER_THRESHOLD:
+            cooldown = settings.CORREIOS_CIRCUIT_BREAKER_COOLDOWN
+            cache.set(self.open_until_key, time.time() + cooldown, None)
+            cache.delete(self.probe_key)
+            logger.warning("Correios: circuito %s aberto por %s segundos após %d falhas",
+                           self.name, cooldown, failures)
@@ -7,24 +7,69 @@
 # This source code is licensed under the AGPLv3 license found in the
 # LICENSE file in the root directory of this source tree.
 
+import copy
 import hashlib
 import logging
-from decimal import Decimal
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait as futures_wait
+from timeit import default_timer
+from decimal import ROUND_CEILING, ROUND_HALF_UP, Decimal
 
-import requests
 import xmltodict
 from django.conf import settings
 from django.core.cache import caches
 from django.utils.encoding import force_bytes, force_text
-from requests.exceptions import Timeout
+from requests.exceptions import ConnectionError, Timeout
+
+from shuup_correios.cache import QuoteCache, QuoteCacheBatch
+from shuup_correios.circuit import CircuitBreaker
+from shuup_correios.latency import (LatencyTracker, get_max_request_time,
+                                    get_retry_delay)
+from shuup_correios.parser import parse_servicos
+from shuup_correios.signals import preco_prazo_requested, ws_request_finished
+from shuup_correios.singleflight import SingleFlight
+from shuup_correios.transport import get_transport
 
 logger = logging.getLogger(__name__)
 
 # URL de acesso ao cálculo de preço e prazo
 CORREIOS_WS_PRECO_PRAZO_URL = "http://ws.correios.com.br/calculador/CalcPrecoPrazo.aspx"
 
-# cache
-correios_cache = caches[settings.CORREIOS_CACHE_NAME]
+# cotações, com um nível opcional em memória na frente do `get_correios_cache`
+quote_cache = QuoteCache(lambda: get_correios_cache(), lambda value: QuoteCacheEntry.get_remaining_ttl(value))
+
+# disjuntor das requisições ao webservice, com estado compartilhado pelo cache
+circuit_breaker = CircuitBreaker("preco_prazo", lambda: get_correios_cache())
+
+# agrupa as requisições simultâneas com as mesmas chaves de cache
+single_flight = SingleFlight()
+
+# latências recentes do webservice, para o timeout adaptativo e as requisições duplicadas
+latency_tracker = LatencyTracker()
+
+_hedge_executor = None
+_hedge_slots = None
+_hedge_executor_lock = threading.Lock()
+
+# versão do formato das chaves de cache, altere para invalidar as chaves existentes
+CACHE_KEY_VERSION = 3
+
+# dimensões mínimas (mm) aceitas pelos Correios para caixas e pacotes
+CORREIOS_MIN_WIDTH = Decimal(110)
+CORREIOS_MIN_LENGTH = Decimal(160)
+CORREIOS_MIN_HEIGHT = Decimal(20)
+
+KG_IN_GRAMS = Decimal(1000)
+
+# precisão dos valores enviados ao webservice
+CENTS = Decimal("0.01")
+GRAMS_IN_KG = Decimal("0.001")
+MM_IN_CM = Decimal("0.1")
 
 
 class CorreiosServico(object):
@@ -45,11 +90,51 @@ class CorreiosFormatoEncomenda(object):
     ENVELOPE = 3
 
 
+class CorreiosErro(object):
+    """ Classes dos códigos de erro retornados pelo webservice """
+
+    # o serviço não atende a requisição: CEP inválido, trecho não atendido, limites excedidos...
+    INDISPONIVEL = 'indisponivel'
+    # instabilidade do sistema dos Correios
+    TEMPORARIO = 'temporario'
+    DESCONHECIDO = 'desconhecido'
+
+    # -33: Sistema temporariamente fora do ar, -888: Erro ao calcular a tarifa,
+    # 7: Serviço indisponível, tente mais tarde, 99: Outros erros
+    TEMPORARIOS = (-33, -888, 7, 99)
+
+    # 6: Localidade de origem não abrange o serviço, 8: Serviço indisponível para o trecho
+    INDISPONIVEIS = (6, 8)
+
+    @classmethod
+    def get_class(cls, erro):
+        """
+        Obtém a classe de um código de erro
+        :rtype: str
+        """
+        if erro in cls.TEMPORARIOS:
+            return cls.TEMPORARIO
+        # -1 a -23: serviço, CEPs, peso, dimensões e serviços adicionais inválidos para o trecho
+        if -23 <= erro < 0 or erro in cls.INDISPONIVEIS:
+            return cls.INDISPONIVEL
+        return cls.DESCONHECIDO
+
+
 class CorreiosWSServerTimeoutException(Timeout):
     """ Classe para exceções de Timeout de conexão com os Correios """
     pass
 
 
+class CorreiosWSCircuitOpenException(CorreiosWSServerTimeoutException):
+    """ Classe para exceções de requisições não realizadas por causa do circuito aberto """
+    pass
+
+
+class CorreiosWSDeadlineExceededException(CorreiosWSServerTimeoutException):
+    """ Classe para exceções de requisições não concluídas dentro do prazo total do pedido """
+    pass
+
+
 class CorreiosWSServerErrorException(Exception):
     """ Classe para exceções de status diferentes de HTTP 200 recebidos do servidor dos Correios """
 
@@ -65,24 +150,110 @@ class CorreiosWSServerErrorException(Exception):
                "content={1}".format(self.http_status_code, self.content)
 
 
+def record_response_status(status_code):
+    """ Registra o resultado de uma requisição no disjuntor """
+    if status_code >= 500:
+        circuit_breaker.record_failure()
+    else:
+        circuit_breaker.record_success()
+
+
+class QuoteCacheEntry(object):
+    """
+    Resultado armazenado no cache de cotações.
+
+    A entrada expira no cache após `CORREIOS_CACHE_HARD_TTL`, mas passa a ser
+    considerada obsoleta após `CORREIOS_CACHE_SOFT_TTL`: a partir daí continua
+    sendo utilizada enquanto é atualizada em segundo plano.
+    """
+
+    # versão do formato da tupla armazenada no cache
+    FORMAT_VERSION = 1
+
+    def __init__(self, result, soft_ttl=0, stale_at=None):
+        self.result = result
+        self.stale_at = stale_at if stale_at is not None else int(time.time() + soft_ttl)
+
+    def is_stale(self):
+        return time.time() >= self.stale_at
+
+    def dumps(self):
+        """ Valor armazenado no cache: versão, momento em que fica obsoleta e o resultado """
+        return (self.FORMAT_VERSION, self.stale_at) + self.result.to_tuple()
+
+    @classmethod
+    def loads(cls, value):
+        """
+        Recria a entrada a partir do valor do cache
+        :return: a entrada ou None se o valor não existir ou estiver em outro formato
+        :rtype: QuoteCacheEntry|None
+        """
+        if not isinstance(value, tuple) or not value or value[0] != cls.FORMAT_VERSION:
+            return None
+
+        return cls(CorreiosWS.CorreiosWSServiceResult.from_tuple(value[2:]), stale_at=value[1])
+
+    @classmethod
+    def get_remaining_ttl(cls, value):
+        """
+        Tempo, em segundos, até a entrada do cache ficar obsoleta. Para os erros,
+        armazenados por `CORREIOS_ERROR_CACHE_TTL`, é o tempo até expirar.
+        :return: o tempo restante ou None se o valor não for uma entrada
+        :rtype: float|None
+        """
+        if not isinstance(value, tuple) or not value or value[0] != cls.FORMAT_VERSION:
+            return None
+
+        return value[1] - time.time()
+
+
 class CorreiosWS(object):
     """ Classe que comunica com o WebService dos Correios """
 
     class CorreiosWSServiceResult(object):
-        """ Classe que representa o retorno de um serviço do WS dos Correios """
-
-        codigo = ''
-        valor = Decimal()
-        prazo_entrega = 0
-        valor_mao_propria = Decimal()
-        valor_aviso_recebimento = Decimal()
-        valor_declarado = Decimal()
-        entrega_domiciliar = True
-        entrega_sabado = True
-        erro = 0
-        msg_erro = ''
-        valor_sem_adicionais = Decimal()
-        obs_fim = ''
+        """
+        Classe que representa o retorno de um serviço do WS dos Correios
+
+        No cache o resultado é armazenado como uma tupla (`to_tuple`), sem o nome
+        da classe e dos atributos em cada entrada.
+        """
+
+        __slots__ = ("codigo", "valor", "prazo_entrega", "valor_mao_propria", "valor_aviso_recebimento",
+                     "valor_declarado", "entrega_domiciliar", "entrega_sabado", "erro", "msg_erro",
+                     "valor_sem_adicionais", "obs_fim")
+
+        # atributos armazenados como texto na tupla
+        DECIMAL_FIELDS = ("valor", "valor_mao_propria", "valor_aviso_recebimento",
+                          "valor_declarado", "valor_sem_adicionais")
+
+        def __init__(self):
+            self.codigo = ''
+            self.valor = Decimal()
+            self.prazo_entrega = 0
+            self.valor_mao_propria = Decimal()
+            self.valor_aviso_recebimento = Decimal()
+            self.valor_declarado = Decimal()
+            self.entrega_domiciliar = True
+            self.entrega_sabado = True
+            self.erro = 0
+            self.msg_erro = ''
+            self.valor_sem_adicionais = Decimal()
+            self.obs_fim = ''
+
+        def to_tuple(self):
+            """ Converte o resultado em uma tupla de tipos simples, na ordem de `__slots__` """
+            return tuple(
+                force_text(getattr(self, field)) if field in self.DECIMAL_FIELDS else getattr(self, field)
+                for field in self.__slots__
+            )
+
+        @classmethod
+        def from_tuple(cls, values):
+            """ Cria o resultado a partir de uma tupla gerada por `to_tuple` """
+            result = cls()
+            for field, value in zip(cls.__slots__, values):
+                setattr(result, field, Decimal(value) if field in cls.DECIMAL_FIELDS else value)
+            return result
 
         def __repr__(self, *args, **kwargs):
             return "<CorreiosWSServiceResult: codigo={0}, valor={1}, prazo_entrega={2}>, "\
@@ -140,7 +311,10 @@ class CorreiosWS(object):
                         aviso_recebimento=False,
                         min_package_width=Decimal(),
                         min_package_length=Decimal(),
-                        min_package_height=Decimal()):
+                        min_package_height=Decimal(),
+                        servicos_adicionais=None,
+                        batch=None,
+                        deadline=None):
         """
         Calcula o preço e prazo da encomenda através do webservice dos Correios.
 
@@ -176,80 +350,936 @@ class CorreiosWS(object):
         :param: min_package_width Largura mínima do pacote (mm)
         :param: min_package_length Comprimento mínimo do pacote (mm)
         :param: min_package_height Altura mínima do pacote (mm)
+        :param: servicos_adicionais Códigos de outros serviços a serem cotados
+            na mesma requisição, apenas para preencher o cache
+        :type batch: shuup_correios.cache.QuoteCacheBatch
+        :param: batch Leituras e gravações do cache agrupadas com outras requisições.
+            As gravações só são feitas no cache com `batch.flush()`
+        :type deadline: shuup_correios.latency.Deadline
+        :param: deadline Prazo total das requisições ao webservice, compartilhado com
+            as demais cotações do pedido
+        :raises CorreiosWSDeadlineExceededException: se o prazo terminar antes da resposta
+        """
+        results = cls.get_preco_prazo_servicos(cep_destino, cep_origem,
+                                               _get_cod_servicos(cod_servico, servicos_adicionais), package,
+                                               cod_empresa, senha, mao_propria, valor_declarado,
+                                               aviso_recebimento, min_package_width,
+                                               min_package_length, min_package_height, batch, deadline)
+        return results[cod_servico]
+
+    @classmethod
+    def get_preco_prazo_servicos(cls,
+                                 cep_destino,
+                                 cep_origem,
+                                 cod_servicos,
+                                 package,
+                                 cod_empresa=None,
+                                 senha=None,
+                                 mao_propria=False,
+                                 valor_declarado=0.0,
+                                 aviso_recebimento=False,
+                                 min_package_width=Decimal(),
+                                 min_package_length=Decimal(),
+                                 min_package_height=Decimal(),
+                                 batch=None,
+                                 deadline=None):
+        """
+        Calcula o preço e prazo da encomenda para vários serviços de uma só vez.
+
+        Os serviços que não estiverem no cache são requisitados em uma única
+        chamada ao webservice (`nCdServico` separado por vírgulas) e cada
+        resultado é armazenado no cache individualmente.
+
+        Os parâmetros são os mesmos de `get_preco_prazo`, exceto:
+
+        :type cod_servicos: list[str]
+        :param cod_servicos: Códigos dos serviços dos Correios a se obter o valor e prazo
+        :return: Resultados indexados pelo código do serviço, na ordem de `cod_servicos`
+        :rtype: collections.OrderedDict[str, shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult]
         """
 
-        package_width = max(package.width, min_package_width)
-        package_length = max(package.length, min_package_length)
-        package_height = max(package.height, min_package_height)
-
-        # VERIFICA SE A REQUISIÇÃO ESTÁ NO CACHE
-
-        # cria uma tupla de parâmetros para criar um chave única para
-        # identificar o pacote no cache
-        params = (cep_destino, cep_origem, cod_servico, cod_empresa, senha,
-                  mao_propria, valor_declarado, aviso_recebimento,
-                  package.weight, package_width, package_length, package_height)
-        # gera a chave do cache
-        cache_key = force_text(hashlib.md5(force_bytes(params)).hexdigest())
-
-        cached_result = correios_cache.get(cache_key)
-        if cached_result:
-            logger.debug("Correios: Using cached value")
-            return cached_result
-
-        payload = {
-            "nCdEmpresa": cod_empresa or '',
-            "sDsSenha": senha or '',
-            "nCdServico": cod_servico,
-            "sCepOrigem": cep_origem or '',
-            "sCepDestino": cep_destino or '',
-            "nVlPeso": package.weight * Decimal(0.001),
-            "nCdFormato": CorreiosFormatoEncomenda.CAIXA_PACOTE,
-            "nVlComprimento": package_length * Decimal(0.1),
-            "nVlAltura": package_height * Decimal(0.1),
-            "nVlLargura": package_width * Decimal(0.1),
-            "nVlDiametro": 0,
-            "sCdMaoPropria": 'S' if mao_propria else 'N',
-            "nVlValorDeclarado": valor_declarado or 0.0,
-            "sCdAvisoRecebimento": 'S' if aviso_recebimento else 'N',
-            "strRetorno": 'xml'
-        }
-
-        logger.debug("Correios: Making request")
+        request = cls.PrecoPrazoRequest(cep_destino, cep_origem, cod_servicos, package,
+                                        cod_empresa, senha, mao_propria, valor_declarado,
+                                        aviso_recebimento, min_package_width,
+                                        min_package_length, min_package_height, batch, deadline)
+
+        if not preco_prazo_requested.has_listeners(cls):
+            return cls._get_results(request)
 
+        start = default_timer()
         try:
-            response = requests.post(CORREIOS_WS_PRECO_PRAZO_URL,
-                                     params=payload,
-                                     timeout=settings.CORREIOS_WEBSERVICE_TIMEOUT)
+            results = cls._get_results(request)
+        except Exception as exc:
+            cls._send_preco_prazo_requested(request, False, start, exc)
+            raise
 
-            if response.status_code == 200:
-                # deixa a coisa mais 'fácil' para se obter os valores
-                result = xmltodict.parse(response.text)
+        cls._send_preco_prazo_requested(request, False, start)
+        return results
 
-                is_list = isinstance(result["Servicos"]["cServico"], list)
+    @classmethod
+    def _get_results(cls, request):
+        """
+        Obtém os resultados do cache e requisita os que não estão no cache
+        :type request: CorreiosWS.PrecoPrazoRequest
+        """
+        # VERIFICA SE AS REQUISIÇÕES ESTÃO NO CACHE
+        missing = request.load_cached()
+        cls.refresh_stale(request)
 
-                if is_list:
-                    # obtém o primeiro serviço - só requisitamos um mesmo...
-                    servico = result["Servicos"]["cServico"][0]
-                else:
-                    servico = result["Servicos"]["cServico"]
+        if not missing:
+            return request.results
 
-                result = CorreiosWS.CorreiosWSServiceResult.from_service(servico)
+        if settings.CORREIOS_SINGLE_FLIGHT:
+            return cls._fetch_coalesced(request)
 
-                if result.erro == 0:
-                    # sem erros, salva no cache
-                    correios_cache.set(cache_key, result)
+        return cls._fetch(request)
 
-                return result
+    @classmethod
+    def _send_preco_prazo_requested(cls, request, cache_only, start, exception=None):
+        preco_prazo_requested.send(
+            sender=cls,
+            request=request,
+            cache_hits=list(request.cached),
+            cache_misses=[cod_servico for cod_servico in request.results if cod_servico not in request.cached],
+            cache_only=cache_only,
+            duration=default_timer() - start,
+            exception=exception
+        )
 
-            else:
-                logger.error("Erro do servidor de WS dos Correios.")
-                raise CorreiosWSServerErrorException(response.status_code, response.text)
+    @classmethod
+    def _fetch_coalesced(cls, request):
+        """
+        Requisita os serviços sem resultado garantindo uma única requisição em andamento
+        por conjunto de chaves de cache no processo e, opcionalmente, entre processos
+        (`CORREIOS_SINGLE_FLIGHT_CACHE_LOCK`).
+
+        :type request: CorreiosWS.PrecoPrazoRequest
+        """
+        cache_keys = sorted(request.cache_keys[cod_servico] for cod_servico in request.missing)
+
+        def fetch():
+            locked = False
+
+            if settings.CORREIOS_SINGLE_FLIGHT_CACHE_LOCK:
+                should_fetch, locked = cls._acquire_flight_lock(request, cache_keys)
+                if not should_fetch:
+                    # outro processo obteve as cotações e elas já estão no cache
+                    return dict((request.cache_keys[cod_servico], result)
+                                for cod_servico, result in request.results.items())
+            try:
+                results = cls._fetch(request)
+            finally:
+                # a trava só é liberada por quem a obteve, depois que as cotações acumuladas
+                # em `batch` chegaram ao cache, onde os outros processos as aguardam
+                if locked:
+                    if request.batch is not None:
+                        request.batch.flush(cache_keys)
+                    get_correios_cache().delete(_get_flight_lock_key(cache_keys))
+
+            return dict((request.cache_keys[cod_servico], result) for cod_servico, result in results.items())
+
+        try:
+            # aguarda a requisição em andamento no máximo até o fim do prazo do pedido
+            results, shared = single_flight.do(tuple(cache_keys), fetch,
+                                               request.deadline.remaining() if request.deadline else None)
+        except FutureTimeoutError:
+            logger.warning("Correios: prazo do pedido esgotado aguardando requisição em andamento.")
+            raise CorreiosWSDeadlineExceededException()
+
+        if shared:
+            logger.debug("Correios: Using coalesced request")
+            for cod_servico in request.missing:
+                request.results[cod_servico] = results.get(request.cache_keys[cod_servico])
+
+        return request.results
+
+    @classmethod
+    def _acquire_flight_lock(cls, request, cache_keys):
+        """
+        Obtém a trava entre processos para requisitar as chaves informadas. Se outro
+        processo já possui a trava, aguarda as cotações aparecerem no cache.
+
+        :return: tupla indicando se a requisição deve ser feita (False se as cotações foram
+            obtidas do cache) e se a trava foi obtida, False quando a espera pelo outro processo
+            terminou e a requisição é feita sem a trava
+        :rtype: tuple[bool, bool]
+        """
+        lock_key = _get_flight_lock_key(cache_keys)
+
+        # a trava dura o tempo máximo da requisição com todas as tentativas, limitado ao prazo do pedido
+        request_time = get_max_request_time()
+        if request.deadline is not None:
+            request_time = min(request_time, request.deadline.remaining())
+
+        lock_timeout = int(math.ceil(request_time)) + 1
+        wait_until = time.time() + request_time + 1
+
+        if request.deadline is not None:
+            wait_until = min(wait_until, time.time() + request.deadline.remaining())
+
+        while not get_correios_cache().add(lock_key, True, lock_timeout):
+            if time.time() >= wait_until:
+                # o outro processo não terminou a tempo, faz a requisição mesmo assim
+                # (ou falha em `_post` se o prazo do pedido terminou), sem liberar a trava do outro processo
+                return True, False
+
+            time.sleep(settings.CORREIOS_SINGLE_FLIGHT_POLL_INTERVAL)
+
+            if not request.load_cached(skip_batch=True):
+                return False, False
+
+        return True, True
+
+    @classmethod
+    def _fetch(cls, request):
+        """
+        Requisita ao webservice os serviços sem resultado de uma requisição
+        :type request: CorreiosWS.PrecoPrazoRequest
+        """
+        if not ws_request_finished.has_listeners(cls):
+            response = cls._post(request)
+            return request.process_response(response.status_code, response.content)
+
+        cod_servicos = request.missing
+        start = default_timer()
+        try:
+            response = cls._post(request)
+        except Exception as exc:
+            cls._send_ws_request_finished(request, cod_servicos, None, default_timer() - start, None, exc)
+            raise
+
+        http_duration = default_timer() - start
+        start = default_timer()
+        try:
+            results = request.process_response(response.status_code, response.content)
+        except Exception as exc:
+            cls._send_ws_request_finished(request, cod_servicos, response.status_code,
+                                          http_duration, default_timer() - start, exc)
+            raise
+
+        cls._send_ws_request_finished(request, cod_servicos, response.status_code,
+                                      http_duration, default_timer() - start)
+        return results
+
+    @classmethod
+    def _post(cls, request):
+        """
+        Envia a requisição ao webservice, respeitando o disjuntor.
+
+        Erros de conexão e respostas HTTP 5xx são repetidos até `CORREIOS_WEBSERVICE_RETRIES`
+        vezes, com recuo exponencial, enquanto o circuito e o prazo do pedido permitirem.
+        Timeouts não são repetidos.
+
+        :type request: CorreiosWS.PrecoPrazoRequest
+        :raises requests.exceptions.ConnectionError: se todas as tentativas falharem por erro de conexão
+        :raises CorreiosWSDeadlineExceededException: se o prazo do pedido terminar antes da resposta
+        """
+        params = request.get_payload()
+        deadline = request.deadline
+        response = None
+        error = None
+
+        for attempt in range(settings.CORREIOS_WEBSERVICE_RETRIES + 1):
+            if attempt:
+                delay = get_retry_delay(attempt)
+                if deadline is not None and delay >= deadline.remaining():
+                    # não há tempo para uma nova tentativa
+                    break
+
+                time.sleep(delay)
+
+            elif deadline is not None and deadline.expired:
+                logger.warning("Correios: prazo do pedido esgotado, requisição não realizada.")
+                raise CorreiosWSDeadlineExceededException()
+
+            if not circuit_breaker.allow_request():
+                if attempt:
+                    # o circuito abriu durante as tentativas
+                    break
+
+                logger.warning("Correios: circuito aberto, requisição não realizada.")
+                raise CorreiosWSCircuitOpenException()
+
+            logger.debug("Correios: Making request")
+
+            try:
+                response = cls._send_hedged(params, deadline)
+            except ConnectionError as exc:
+                logger.warning("Correios: erro de conexão com o WS dos Correios (tentativa %d): %r",
+                               attempt + 1, exc)
+                circuit_breaker.record_failure()
+                response, error = None, exc
+                continue
+
+            record_response_status(response.status_code)
+
+            if response.status_code < 500:
+                return response
+
+        if response is None:
+            raise error
+
+        return response
+
+    @classmethod
+    def _send_hedged(cls, params, deadline=None):
+        """
+        Envia a requisição com o timeout adaptativo, limitado ao tempo restante de `deadline`.
+        Com `CORREIOS_WEBSERVICE_HEDGE`, se não houver resposta dentro do p95 recente, envia
+        uma requisição duplicada e utiliza a resposta que chegar primeiro. As duas requisições
+        são feitas no executor `get_hedge_executor`; se ele não tiver threads livres, a
+        requisição é feita na thread atual, sem duplicação.
+
+        :type deadline: shuup_correios.latency.Deadline|None
+        :rtype: requests.Response
+        """
+        timeout = latency_tracker.get_timeout()
+        if deadline is not None:
+            timeout = deadline.get_timeout(timeout)
+            if timeout <= 0:
+                raise CorreiosWSDeadlineExceededException()
+
+        hedge_delay = latency_tracker.get_hedge_delay(timeout)
+
+        if hedge_delay is None:
+            return cls._send(params, timeout, deadline)
+
+        first = _submit_hedge_task(cls._send, params, timeout, deadline)
+        if first is None:
+            return cls._send(params, timeout, deadline)
+
+        try:
+            return first.result(hedge_delay)
+        except FutureTimeoutError:
+            pass
+
+        hedge = _submit_hedge_task(cls._send, params, timeout - hedge_delay, deadline, True)
+        if hedge is None:
+            return first.result()
+
+        logger.debug("Correios: Making hedged request")
+        pending = set([first, hedge])
+
+        while pending:
+            done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+        # as duas falharam: o erro da primeira requisição
+        return first.result()
+
+    @classmethod
+    def _send(cls, params, timeout, deadline=None, hedge=False):
+        """
+        Envia uma única requisição ao webservice, registrando a sua latência
+
+        :param hedge: indica a requisição duplicada, cujo timeout não é registrado como falha
+            nem como latência, pois o timeout da primeira requisição já foi registrado
+
+        :raises CorreiosWSServerTimeoutException: se o webservice não responder a tempo
+        :raises CorreiosWSDeadlineExceededException: se o timeout foi causado pelo fim de `deadline`
+        :rtype: requests.Response
+        """
+        start = default_timer()
+
+        try:
+            response = get_transport().post(CORREIOS_WS_PRECO_PRAZO_URL, params=params, timeout=timeout)
+
+        except Timeout as exc:
+            if isinstance(exc, ConnectionError):
+                # timeout ao conectar: tratado como erro de conexão
+                raise
+
+            if deadline is not None and deadline.expired:
+                # o timeout foi reduzido pelo prazo do pedido: não indica lentidão do webservice
+                logger.warning("Correios: prazo do pedido esgotado aguardando o WS dos Correios.")
+                raise CorreiosWSDeadlineExceededException()
 
-        except Timeout:
             logger.exception("Timeout de conexão com o WS dos Correios.")
+            if not hedge:
+                latency_tracker.record(timeout)
+                circuit_breaker.record_failure()
             raise CorreiosWSServerTimeoutException()
 
+        latency_tracker.record(default_timer() - start)
+        return response
+
+    @classmethod
+    def _send_ws_request_finished(cls, request, cod_servicos, status_code,
+                                  http_duration, parse_duration, exception=None):
+        erros = dict((cod_servico, request.results[cod_servico].erro)
+                     for cod_servico in cod_servicos if request.results.get(cod_servico))
+
+        ws_request_finished.send(
+            sender=cls,
+            request=request,
+            status_code=status_code,
+            http_duration=http_duration,
+            parse_duration=parse_duration,
+            erros=erros,
+            exception=exception
+        )
+
+    @classmethod
+    def refresh_stale(cls, request):
+        """
+        Atualiza em segundo plano os resultados obsoletos obtidos do cache.
+
+        Apenas uma atualização por chave é executada de cada vez, mesmo entre
+        processos diferentes, através de uma trava no próprio cache.
+
+        :type request: CorreiosWS.PrecoPrazoRequest
+        :return: A thread da atualização ou None se não houver o que atualizar
+        :rtype: threading.Thread|None
+        """
+        stale = [cod_servico for cod_servico in request.stale
+                 if get_correios_cache().add(request.cache_keys[cod_servico] + ":refresh", True,
+                                       settings.CORREIOS_CACHE_REFRESH_TIMEOUT)]
+        if not stale:
+            return None
+
+        refresh_request = request.get_refresh_request(stale)
+
+        def refresh():
+            try:
+                cls._fetch(refresh_request)
+            except Exception:
+                logger.exception("Correios: Erro ao atualizar cotação obsoleta.")
+            finally:
+                get_correios_cache().delete_many([request.cache_keys[cod_servico] + ":refresh"
+                                                  for cod_servico in stale])
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @classmethod
+    def get_cached_preco_prazo(cls,
+                               cep_destino,
+                               cep_origem,
+                               cod_servico,
+                               package,
+                               cod_empresa=None,
+                               senha=None,
+                               mao_propria=False,
+                               valor_declarado=0.0,
+                               aviso_recebimento=False,
+                               min_package_width=Decimal(),
+                               min_package_length=Decimal(),
+                               min_package_height=Decimal()):
+        """
+        Obtém o resultado de `get_preco_prazo` apenas do cache, sem acessar o webservice.
+        Os parâmetros são os mesmos de `get_preco_prazo`.
+
+        :return: Resultado do serviço dos correios ou None se não estiver no cache
+        :rtype: shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult|None
+        """
+        request = cls.PrecoPrazoRequest(cep_destino, cep_origem, [cod_servico], package,
+                                        cod_empresa, senha, mao_propria, valor_declarado,
+                                        aviso_recebimento, min_package_width,
+                                        min_package_length, min_package_height)
+        instrumented = preco_prazo_requested.has_listeners(cls)
+        start = default_timer() if instrumented else None
+
+        request.load_cached()
+        cls.refresh_stale(request)
+
+        if instrumented:
+            cls._send_preco_prazo_requested(request, True, start)
+
+        return request.results[cod_servico]
+
+    @classmethod
+    def get_cached_preco_prazo_many(cls,
+                                    cep_destino,
+                                    cep_origem,
+                                    cod_servico,
+                                    packages,
+                                    cod_empresa=None,
+                                    senha=None,
+                                    mao_propria=False,
+                                    valor_declarado=0.0,
+                                    aviso_recebimento=False,
+                                    min_package_width=Decimal(),
+                                    min_package_length=Decimal(),
+                                    min_package_height=Decimal(),
+                                    servicos_adicionais=None,
+                                    batch=None):
+        """
+        Obtém apenas do cache os resultados de vários pacotes, lendo as chaves de todos
+        os pacotes e serviços (`cod_servico` e `servicos_adicionais`) de uma só vez.
+        Os resultados dos `servicos_adicionais` ficam disponíveis em `batch`.
+
+        Os parâmetros são os mesmos de `get_preco_prazo`, exceto:
+
+        :type packages: list[shuup_correios.packing.AbstractPackage]
+        :param packages: pacotes a serem cotados
+        :return: Resultado de cada pacote, na ordem de `packages`, ou None se não estiver no cache
+        :rtype: list[shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult|None]
+        """
+        if batch is None:
+            batch = QuoteCacheBatch(quote_cache)
+
+        cod_servicos = _get_cod_servicos(cod_servico, servicos_adicionais)
+        requests = [cls.PrecoPrazoRequest(cep_destino, cep_origem, cod_servicos, package,
+                                          cod_empresa, senha, mao_propria, valor_declarado,
+                                          aviso_recebimento, min_package_width,
+                                          min_package_length, min_package_height, batch)
+                    for package in packages]
+
+        instrumented = preco_prazo_requested.has_listeners(cls)
+        start = default_timer() if instrumented else None
+
+        batch.load([cache_key for request in requests for cache_key in request.cache_keys.values()])
+
+        results = []
+        for request in requests:
+            request.load_cached()
+            cls.refresh_stale(request)
+
+            if instrumented:
+                cls._send_preco_prazo_requested(request, True, start)
+
+            results.append(request.results[cod_servico])
+
+        return results
+
+    class PrecoPrazoRequest(object):
+        """
+        Requisição de preço e prazo de um pacote para um ou mais serviços.
+
+        Concentra as chaves de cache, a montagem dos parâmetros e o tratamento
+        do retorno do webservice, compartilhados pelo cliente síncrono
+        (`CorreiosWS`) e pelo assíncrono (`shuup_correios.aio`).
+        Os parâmetros são os mesmos de `CorreiosWS.get_preco_prazo_servicos`.
+        """
+
+        def __init__(self,
+                     cep_destino,
+                     cep_origem,
+                     cod_servicos,
+                     package,
+                     cod_empresa=None,
+                     senha=None,
+                     mao_propria=False,
+                     valor_declarado=0.0,
+                     aviso_recebimento=False,
+                     min_package_width=Decimal(),
+                     min_package_length=Decimal(),
+                     min_package_height=Decimal(),
+                     batch=None,
+                     deadline=None):
+            self.cep_destino = normalize_cep(cep_destino)
+            self.cep_origem = normalize_cep(cep_origem)
+            self.package = package
+            self.cod_empresa = cod_empresa
+            self.senha = senha
+            self.mao_propria = bool(mao_propria)
+            self.valor_declarado = _quantize(valor_declarado, CENTS)
+            self.aviso_recebimento = bool(aviso_recebimento)
+            self.batch = batch
+            self.deadline = deadline
+
+            weight = package.weight
+            width = max(package.width, min_package_width)
+            length = max(package.length, min_package_length)
+            height = max(package.height, min_package_height)
+
+            # peso tarifado (g), utilizado pela contingência e pelo agrupamento por faixa de peso
+            self.billable_weight = None
+            if settings.CORREIOS_BILLABLE_WEIGHT_BUCKETING or settings.CORREIOS_FALLBACK_PROVIDERS:
+                self.billable_weight = get_billable_weight(weight, width, length, height)
+
+            if settings.CORREIOS_BILLABLE_WEIGHT_BUCKETING:
+                # o preço só depende da faixa de peso tarifado: envia o peso máximo
+                # da faixa com as dimensões mínimas, já consideradas no peso cúbico
+                weight = self.billable_weight
+                width = max(min_package_width, CORREIOS_MIN_WIDTH)
+                length = max(min_package_length, CORREIOS_MIN_LENGTH)
+                height = max(min_package_height, CORREIOS_MIN_HEIGHT)
+
+            # valores nas unidades enviadas ao webservice (kg e cm)
+            self.peso = _to_kg(weight)
+            self.largura = _to_cm(width)
+            self.comprimento = _to_cm(length)
+            self.altura = _to_cm(height)
+
+            self.results = OrderedDict((cod_servico, None) for cod_servico in cod_servicos)
+            self.cache_keys = dict((cod_servico, self.get_cache_key(cod_servico)) for cod_servico in cod_servicos)
+            self.stale = []
+            self.cached = []
+
+        @property
+        def missing(self):
+            """ Códigos dos serviços que ainda não possuem resultado """
+            return [cod_servico for cod_servico, result in self.results.items() if not result]
+
+        def get_cache_key(self, cod_servico):
+            """ Gera a chave do cache para o resultado de um serviço """
+            return build_cache_key(self.cep_destino, self.cep_origem, cod_servico, self.cod_empresa,
+                                   self.mao_propria, self.valor_declarado, self.aviso_recebimento,
+                                   self.peso, self.comprimento, self.altura, self.largura)
+
+        def get_fallback_key(self, cod_servico, cep_digits, weight=None):
+            """
+            Gera a chave das cotações conhecidas utilizadas pela contingência (`shuup_correios.fallback`)
+
+            :param cep_digits: quantidade de dígitos iniciais dos CEPs que identificam a região
+            :param weight: peso tarifado (g), utiliza o do pacote se não informado
+            """
+            return build_fallback_key(self.cep_destino[:cep_digits], self.cep_origem[:cep_digits], cod_servico,
+                                      self.cod_empresa, self.mao_propria, self.aviso_recebimento,
+                                      self.billable_weight if weight is None else weight)
+
+        def load_cached(self, skip_batch=False):
+            """
+            Preenche os resultados que estão no cache, lendo todos os serviços de uma só vez
+
+            :param skip_batch: lê diretamente do cache, ignorando os valores já lidos em `batch`
+            :return: Códigos dos serviços que não estão no cache
+            :rtype: list[str]
+            """
+            missing = self.missing
+            cache_keys = [self.cache_keys[cod_servico] for cod_servico in missing]
+
+            if self.batch is not None and not skip_batch:
+                self.batch.load(cache_keys)
+                values = self.batch.values
+            else:
+                values = quote_cache.get_many(cache_keys)
+
+            for cod_servico, cache_key in zip(missing, cache_keys):
+                entry = QuoteCacheEntry.loads(values.get(cache_key))
+                if entry:
+                    logger.debug("Correios: Using cached value")
+                    self.cached.append(cod_servico)
+                    self.results[cod_servico] = entry.result
+
+                    if entry.is_stale():
+                        self.stale.append(cod_servico)
+
+            return self.missing
+
+        def get_refresh_request(self, cod_servicos):
+            """
+            Cria uma requisição com os mesmos parâmetros para atualizar os serviços informados
+            :rtype: CorreiosWS.PrecoPrazoRequest
+            """
+            request = copy.copy(self)
+            request.results = OrderedDict((cod_servico, None) for cod_servico in cod_servicos)
+            request.stale = []
+            request.cached = []
+            # a atualização termina depois do pedido, então grava diretamente no cache
+            request.batch = None
+            request.deadline = None
+            return request
+
+        def get_payload(self):
+            """ Parâmetros da requisição ao webservice para os serviços sem resultado """
+            return {
+                "nCdEmpresa": self.cod_empresa or '',
+                "sDsSenha": self.senha or '',
+                "nCdServico": ",".join(self.missing),
+                "sCepOrigem": self.cep_origem or '',
+                "sCepDestino": self.cep_destino or '',
+                "nVlPeso": self.peso,
+                "nCdFormato": CorreiosFormatoEncomenda.CAIXA_PACOTE,
+                "nVlComprimento": self.comprimento,
+                "nVlAltura": self.altura,
+                "nVlLargura": self.largura,
+                "nVlDiametro": 0,
+                "sCdMaoPropria": 'S' if self.mao_propria else 'N',
+                "nVlValorDeclarado": self.valor_declarado,
+                "sCdAvisoRecebimento": 'S' if self.aviso_recebimento else 'N',
+                "strRetorno": 'xml'
+            }
+
+        def process_response(self, status_code, content):
+            """
+            Trata o retorno do webservice, preenchendo os resultados e o cache
+
+            :raises CorreiosWSServerErrorException: se o status HTTP for diferente de 200
+            :rtype: collections.OrderedDict[str, shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult]
+            """
+            if status_code != 200:
+                logger.error("Erro do servidor de WS dos Correios.")
+                raise CorreiosWSServerErrorException(status_code, content)
+
+            servicos = CorreiosWS._parse_servicos(content)
+            writes = {}
+
+            for cod_servico, result in _match_servicos(self.missing, servicos).items():
+                if result.erro == 0:
+                    # sem erros, salva no cache
+                    writes.setdefault(settings.CORREIOS_CACHE_HARD_TTL, {})[self.cache_keys[cod_servico]] = \
+                        QuoteCacheEntry(result, settings.CORREIOS_CACHE_SOFT_TTL).dumps()
+
+                    if self.billable_weight is not None and not self.valor_declarado \
+                            and settings.CORREIOS_FALLBACK_PROVIDERS and settings.CORREIOS_FALLBACK_TTL:
+                        # registra o preço e o prazo para a contingência, apenas das cotações
+                        # sem valor declarado, cuja taxa não é estimada pelos provedores
+                        fallback_writes = writes.setdefault(settings.CORREIOS_FALLBACK_TTL, {})
+                        known_quote = (force_text(result.valor), result.prazo_entrega)
+
+                        for cep_digits in (settings.CORREIOS_FALLBACK_NEARBY_CEP_DIGITS,
+                                           settings.CORREIOS_FALLBACK_CURVE_CEP_DIGITS):
+                            fallback_writes[self.get_fallback_key(cod_servico, cep_digits)] = known_quote
+                else:
+                    # erros são armazenados conforme a sua classe, sem atualização em segundo plano
+                    error_ttl = settings.CORREIOS_ERROR_CACHE_TTL.get(CorreiosErro.get_class(result.erro))
+                    if error_ttl:
+                        writes.setdefault(error_ttl, {})[self.cache_keys[cod_servico]] = \
+                            QuoteCacheEntry(result, error_ttl).dumps()
+
+                self.results[cod_servico] = result
+
+            # uma única escrita por tempo de expiração
+            for timeout, values in writes.items():
+                if self.batch is not None:
+                    for cache_key, value in values.items():
+                        self.batch.set(cache_key, value, timeout)
+                else:
+                    quote_cache.set_many(values, timeout)
+
+            return self.results
+
+    @classmethod
+    def _parse_servicos(cls, content):
+        """
+        Converte o XML de retorno do webservice em uma lista de resultados
+        :type content: bytes|str
+        :rtype: list[shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult]
+        """
+        servicos = parse_servicos(content)
+
+        if servicos is None:
+            # formato inesperado, utiliza o parser completo
+            result = xmltodict.parse(content)
+            servicos = result["Servicos"]["cServico"]
+
+            if not isinstance(servicos, list):
+                servicos = [servicos]
+
+        return [CorreiosWS.CorreiosWSServiceResult.from_service(servico) for servico in servicos]
+
+
+def get_correios_cache():
+    """
+    Obtém o cache dos Correios (`CORREIOS_CACHE_NAME`) da thread atual. O cache é obtido
+    a cada uso, pois as instâncias do Django são por thread e alguns clientes (ex: pylibmc)
+    não podem ser compartilhados entre threads.
+    """
+    return caches[settings.CORREIOS_CACHE_NAME]
+
+
+def get_hedge_executor():
+    """
+    Obtém o executor das requisições duplicadas (`CORREIOS_WEBSERVICE_HEDGE`), criado
+    uma única vez por processo com uma thread por conexão do pool do transporte
+
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _hedge_executor, _hedge_slots
+
+    if _hedge_executor is None:
+        with _hedge_executor_lock:
+            if _hedge_executor is None:
+                _hedge_slots = threading.BoundedSemaphore(settings.CORREIOS_WEBSERVICE_POOL_MAXSIZE)
+                _hedge_executor = ThreadPoolExecutor(max_workers=settings.CORREIOS_WEBSERVICE_POOL_MAXSIZE)
+
+    return _hedge_executor
+
+
+def _submit_hedge_task(func, *args):
+    """
+    Executa `func` no executor das requisições duplicadas, apenas se houver uma thread livre,
+    assim as requisições nunca aguardam na fila do executor
+    :return: o future da execução ou None se todas as threads estiverem ocupadas
+    :rtype: concurrent.futures.Future|None
+    """
+    executor = get_hedge_executor()
+
+    if not _hedge_slots.acquire(False):
+        return None
+
+    def run():
+        try:
+            return func(*args)
+        finally:
+            _hedge_slots.release()
+
+    try:
+        return executor.submit(run)
+    except Exception:
+        _hedge_slots.release()
+        raise
+
+
+def _get_cod_servicos(cod_servico, servicos_adicionais):
+    return [cod_servico] + [cod for cod in (servicos_adicionais or []) if cod != cod_servico]
+
+
+def _get_flight_lock_key(cache_keys):
+    return "correios:flight:{0}".format(hashlib.md5(force_bytes("|".join(cache_keys))).hexdigest())
+
+
+def normalize_cep(cep):
+    """
+    Normaliza um CEP para o formato "12345678", apenas com dígitos,
+    restaurando os zeros à esquerda perdidos (ex: 1310100 -> 01310100)
+    """
+    cep = "".join([d for d in force_text(cep or '') if d.isdigit()])
+    return cep.zfill(8) if cep else ''
+
+
+def build_cache_key(cep_destino, cep_origem, cod_servico, cod_empresa, mao_propria,
+                    valor_declarado, aviso_recebimento, peso, comprimento, altura, largura):
+    """
+    Gera a chave canônica do cache para o resultado de um serviço.
+
+    Requisições equivalentes geram a mesma chave: os CEPs são normalizados,
+    o valor declarado, o peso (kg) e as dimensões (cm) são quantizados na
+    precisão enviada ao webservice e os códigos de serviço perdem os zeros
+    à esquerda. A senha nunca faz parte da chave, a conta é identificada
+    apenas por um hash do código da empresa.
+
+    :rtype: str
+    """
+    cod_empresa = force_text(cod_empresa or '').strip()
+    conta = hashlib.sha1(force_bytes(cod_empresa)).hexdigest()[:16] if cod_empresa else ''
+
+    params = (
+        normalize_cep(cep_destino),
+        normalize_cep(cep_origem),
+        force_text(cod_servico or '').strip().lstrip('0'),
+        conta,
+        'S' if mao_propria else 'N',
+        force_text(_quantize(valor_declarado, CENTS)),
+        'S' if aviso_recebimento else 'N',
+        force_text(_quantize(peso, GRAMS_IN_KG)),
+        force_text(_quantize(comprimento, MM_IN_CM)),
+        force_text(_quantize(altura, MM_IN_CM)),
+        force_text(_quantize(largura, MM_IN_CM)),
+    )
+    digest = hashlib.md5(force_bytes("|".join(params))).hexdigest()
+    return "correios:v{0}:{1}".format(CACHE_KEY_VERSION, digest)
+
+
+def build_fallback_key(cep_destino, cep_origem, cod_servico, cod_empresa, mao_propria,
+                       aviso_recebimento, billable_weight):
+    """
+    Gera a chave de uma cotação conhecida para a contingência, por região (CEPs já
+    reduzidos aos dígitos iniciais) e peso tarifado (g). O valor declarado não faz
+    parte da chave, ele é descontado do preço registrado.
+
+    :rtype: str
+    """
+    cod_empresa = force_text(cod_empresa or '').strip()
+    conta = hashlib.sha1(force_bytes(cod_empresa)).hexdigest()[:16] if cod_empresa else ''
+
+    params = (
+        force_text(cep_destino or ''),
+        force_text(cep_origem or ''),
+        force_text(cod_servico or '').strip().lstrip('0'),
+        conta,
+        'S' if mao_propria else 'N',
+        'S' if aviso_recebimento else 'N',
+        force_text(Decimal(billable_weight).to_integral_value()),
+    )
+    digest = hashlib.md5(force_bytes("|".join(params))).hexdigest()
+    return "correios:v{0}:fallback:{1}".format(CACHE_KEY_VERSION, digest)
+
+
+def get_package_weight(weight, width, length, height):
+    """
+    Obtém o peso considerado para tarifar um pacote, sem arredondar para as faixas de peso:
+    o maior valor entre o peso real e o peso cúbico, quando este ultrapassa
+    `CORREIOS_CUBIC_WEIGHT_THRESHOLD`. Os parâmetros são os mesmos de `get_billable_weight`.
+
+    :return: peso em gramas
+    :rtype: decimal.Decimal
+    """
+    weight = Decimal(force_text(weight or 0))
+    volume = Decimal(force_text(width or 0)) * Decimal(force_text(length or 0)) * Decimal(force_text(height or 0))
+
+    # mm³ / fator = peso cúbico em gramas
+    cubic_weight = volume / Decimal(settings.CORREIOS_CUBIC_WEIGHT_FACTOR)
+    if cubic_weight > settings.CORREIOS_CUBIC_WEIGHT_THRESHOLD:
+        weight = max(weight, cubic_weight)
+
+    return weight
+
+
+def get_billable_weight(weight, width, length, height):
+    """
+    Obtém o peso tarifado de um pacote: o limite superior da faixa de peso
+    (`CORREIOS_WEIGHT_BRACKETS`) do maior valor entre o peso real e o peso cúbico,
+    quando este ultrapassa `CORREIOS_CUBIC_WEIGHT_THRESHOLD`.
+
+    :param weight: peso em gramas
+    :param width: largura em milímetros
+    :param length: comprimento em milímetros
+    :param height: altura em milímetros
+    :return: peso tarifado em gramas
+    :rtype: decimal.Decimal
+    """
+    weight = get_package_weight(weight, width, length, height)
+
+    for bracket in settings.CORREIOS_WEIGHT_BRACKETS:
+        if weight <= bracket:
+            return Decimal(bracket)
+
+    # acima da última faixa, arredonda para o próximo quilo
+    return (weight / KG_IN_GRAMS).to_integral_value(rounding=ROUND_CEILING) * KG_IN_GRAMS
+
+
+def _quantize(value, exp):
+    """ Converte um valor em Decimal na precisão `exp` """
+    return Decimal(force_text(value or 0)).quantize(exp, rounding=ROUND_HALF_UP)
+
+
+def _to_kg(weight):
+    """ Converte um peso em gramas para quilogramas """
+    return _quantize(Decimal(force_text(weight or 0)) * GRAMS_IN_KG, GRAMS_IN_KG)
+
+
+def _to_cm(dimension):
+    """ Converte uma dimensão em milímetros para centímetros """
+    return _quantize(Decimal(force_text(dimension or 0)) * MM_IN_CM, MM_IN_CM)
+
+
+def _match_servicos(cod_servicos, servicos):
+    """
+    Associa cada código de serviço requisitado ao respectivo resultado do webservice.
+
+    Os Correios podem omitir zeros à esquerda do código retornado. Quando um
+    serviço não é encontrado pelo código, utiliza-se o resultado na mesma posição
+    da requisição, desde que ele não pertença a outro serviço requisitado. Os
+    serviços sem resultado ficam fora do retorno.
+
+    :rtype: collections.OrderedDict
+    """
+    by_codigo = dict(((servico.codigo or '').lstrip('0'), servico) for servico in servicos)
+    requested = set(cod_servico.lstrip('0') for cod_servico in cod_servicos)
+    matched = OrderedDict()
+
+    for index, cod_servico in enumerate(cod_servicos):
+        result = by_codigo.get(cod_servico.lstrip('0'))
+
+        if result is None and index < len(servicos):
+            result = servicos[index]
+            if len(cod_servicos) > 1 and (result.codigo or '').lstrip('0') in requested:
+                # o resultado é de outro serviço requisitado, ex: PAC omitido e SEDEX na posição
+                result = None
+
+        if result is not None:
+            matched[cod_servico] = result
+
+    return matched
+
 
 def _convert_to_int(value):
     """
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Contingência para quando o webservice dos Correios falhar.
+
+Os provedores configurados em `CORREIOS_FALLBACK_PROVIDERS` são consultados em
+ordem e o primeiro que atender o pacote fornece um preço estimado. Os provedores
+apenas consultam o cache ou as configurações, nunca o webservice, então a resposta
+é imediata.
+
+As cotações obtidas do webservice são registradas junto com o cache de cotações
+(`CorreiosWS.PrecoPrazoRequest.process_response`), por localidade próxima e por
+região, para o peso tarifado do pacote. Encomendas com valor declarado não são
+registradas nem estimadas.
+"""
+
+import logging
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils.encoding import force_text
+
+from shuup.utils.importing import load
+from shuup_correios.correios import CENTS, CorreiosWS, quote_cache
+
+logger = logging.getLogger(__name__)
+
+# observação incluída nos resultados estimados
+FALLBACK_OBS = "Valor estimado: webservice dos Correios indisponível."
+
+_providers = None
+_providers_lock = threading.Lock()
+
+
+class FallbackProvider(object):
+    """ Interface dos provedores de contingência """
+
+    def get_preco_prazo(self,
+                        cep_destino,
+                        cep_origem,
+                        cod_servico,
+                        package,
+                        cod_empresa=None,
+                        senha=None,
+                        mao_propria=False,
+                        valor_declarado=0.0,
+                        aviso_recebimento=False,
+                        min_package_width=Decimal(),
+                        min_package_length=Decimal(),
+                        min_package_height=Decimal()):
+        """
+        Estima o preço e prazo da encomenda, com os mesmos parâmetros de `CorreiosWS.get_preco_prazo`
+
+        :return: Resultado estimado ou None se o provedor não atender a consulta
+        :rtype: shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult|None
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def get_request(cls, cod_servico, **kwargs):
+        """
+        Cria a requisição equivalente, para obter os parâmetros normalizados e as chaves
+        :rtype: shuup_correios.correios.CorreiosWS.PrecoPrazoRequest
+        """
+        return CorreiosWS.PrecoPrazoRequest(cod_servicos=[cod_servico], **kwargs)
+
+    @classmethod
+    def build_result(cls, cod_servico, valor, prazo_entrega):
+        """
+        Resultado estimado de um serviço
+        :rtype: shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult
+        """
+        result = CorreiosWS.CorreiosWSServiceResult()
+        result.codigo = cod_servico
+        result.valor = Decimal(valor).quantize(CENTS)
+        result.valor_sem_adicionais = result.valor
+        result.prazo_entrega = int(prazo_entrega)
+        result.entrega_sabado = False
+        result.obs_fim = FALLBACK_OBS
+        return result
+
+
+class LastKnownQuoteProvider(FallbackProvider):
+    """
+    Última cotação do webservice para a mesma faixa de peso e CEPs próximos,
+    com os mesmos `CORREIOS_FALLBACK_NEARBY_CEP_DIGITS` dígitos iniciais
+    """
+
+    def get_preco_prazo(self, cep_destino, cep_origem, cod_servico, package, **kwargs):
+        request = self.get_request(cod_servico, cep_destino=cep_destino, cep_origem=cep_origem,
+                                   package=package, **kwargs)
+        if request.billable_weight is None:
+            return None
+
+        known_quote = quote_cache.get(request.get_fallback_key(cod_servico,
+                                                               settings.CORREIOS_FALLBACK_NEARBY_CEP_DIGITS))
+        if not known_quote:
+            return None
+
+        valor, prazo_entrega = known_quote
+        return self.build_result(cod_servico, valor, prazo_entrega)
+
+
+class PriceCurveProvider(FallbackProvider):
+    """
+    Curva de preço por peso tarifado da região (`CORREIOS_FALLBACK_CURVE_CEP_DIGITS`
+    dígitos iniciais dos CEPs), formada pelas cotações conhecidas de cada faixa de peso
+    (`CORREIOS_WEIGHT_BRACKETS`). O preço é interpolado entre as faixas conhecidas mais
+    próximas ou extrapolado a partir das duas últimas.
+
+    Os pontos da curva são lidos do cache de uma só vez.
+    """
+
+    def get_preco_prazo(self, cep_destino, cep_origem, cod_servico, package, **kwargs):
+        request = self.get_request(cod_servico, cep_destino=cep_destino, cep_origem=cep_origem,
+                                   package=package, **kwargs)
+        if request.billable_weight is None:
+            return None
+
+        weight = Decimal(request.billable_weight)
+        weights = sorted(set([Decimal(bracket) for bracket in settings.CORREIOS_WEIGHT_BRACKETS] + [weight]))
+        keys = dict((request.get_fallback_key(cod_servico, settings.CORREIOS_FALLBACK_CURVE_CEP_DIGITS, w), w)
+                    for w in weights)
+
+        points = sorted((keys[key], Decimal(force_text(valor)), prazo_entrega)
+                        for key, (valor, prazo_entrega) in quote_cache.get_many(list(keys.keys())).items())
+
+        estimate = estimate_price(points, weight)
+        if estimate is None:
+            return None
+
+        valor, prazo_entrega = estimate
+        return self.build_result(cod_servico, valor, prazo_entrega)
+
+
+class FlatRateProvider(FallbackProvider):
+    """ Preço e prazo fixos por serviço, configurados em `CORREIOS_FALLBACK_FLAT_RATES` """
+
+    def get_preco_prazo(self, cep_destino, cep_origem, cod_servico, package, **kwargs):
+        rates = dict((force_text(servico).lstrip("0"), rate)
+                     for servico, rate in settings.CORREIOS_FALLBACK_FLAT_RATES.items())
+        rate = rates.get(force_text(cod_servico or "").strip().lstrip("0"))
+        if not rate:
+            return None
+
+        valor, prazo_entrega = rate
+        return self.build_result(cod_servico, Decimal(force_text(valor)), prazo_entrega)
+
+
+def estimate_price(points, weight):
+    """
+    Estima o preço e o prazo para um peso a partir dos pontos conhecidos da curva
+
+    :param points: pontos (peso, valor, prazo) ordenados pelo peso
+    :type points: list[tuple[decimal.Decimal, decimal.Decimal, int]]
+    :return: tupla com o valor e o prazo ou None se não houver pontos suficientes
+    :rtype: tuple[decimal.Decimal, int]|None
+    """
+    lower = [point for point in points if point[0] <= weight]
+    upper = [point for point in points if point[0] >= weight]
+
+    if lower and lower[-1][0] == weight:
+        return lower[-1][1], lower[-1][2]
+
+    if upper and not lower:
+        # abaixo da primeira faixa conhecida: o preço da faixa conhecida mais leve
+        return upper[0][1], upper[0][2]
+
+    if upper:
+        # entre duas faixas conhecidas
+        (weight0, valor0, prazo0), (weight1, valor1, prazo1) = lower[-1], upper[0]
+        valor = valor0 + (valor1 - valor0) * (weight - weight0) / (weight1 - weight0)
+        return valor, max(prazo0, prazo1)
+
+    if len(lower) < 2:
+        return None
+
+    # acima da última faixa conhecida: extrapola a partir das duas últimas, sem reduzir o preço
+    (weight0, valor0, prazo0), (weight1, valor1, prazo1) = lower[-2], lower[-1]
+    valor = valor1 + (valor1 - valor0) * (weight - weight1) / (weight1 - weight0)
+    return max(valor, valor1), prazo1
+
+
+def get_fallback_providers():
+    """
+    Obtém as instâncias dos provedores de `CORREIOS_FALLBACK_PROVIDERS`, criadas uma única vez por processo
+    :rtype: list[FallbackProvider]
+    """
+    global _providers
+
+    if _providers is None:
+        with _providers_lock:
+            if _providers is None:
+                _providers = [load(spec, "Correios fallback provider")()
+                              for spec in settings.CORREIOS_FALLBACK_PROVIDERS]
+
+    return _providers
+
+
+def reset_fallback_providers():
+    """ Descarta os provedores criados, que serão recriados na próxima utilização """
+    global _providers
+
+    with _providers_lock:
+        _providers = None
+
+
+def get_fallback_preco_prazo(**kwargs):
+    """
+    Consulta os provedores de contingência em ordem, com os mesmos parâmetros de
+    `CorreiosWS.get_preco_prazo`
+
+    Encomendas com valor declarado não são estimadas, pois a taxa do valor
+    declarado não faz parte das cotações conhecidas nem dos preços fixos.
+
+    :return: Resultado do primeiro provedor que atender a consulta ou None
+    :rtype: shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult|None
+    """
+    if kwargs.get("valor_declarado"):
+        return None
+
+    for provider in get_fallback_providers():
+        try:
+            result = provider.get_preco_prazo(**kwargs)
+        except Exception:
+            logger.exception("Correios: erro no provedor de contingência %r.", provider)
+            continue
+
+        if result is not None:
+            logger.warning("Correios: utilizando o valor estimado por %s.", provider.__class__.__name__)
+            return result
+
+    return None
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import random
+import threading
+from collections import deque
+from timeit import default_timer
+
+from django.conf import settings
+
+
+class LatencyTracker(object):
+    """
+    Latências recentes das requisições ao webservice, no próprio processo.
+
+    Mantém as últimas `CORREIOS_WEBSERVICE_LATENCY_WINDOW` durações e calcula os
+    percentis a partir delas, utilizados para o timeout adaptativo e para as
+    requisições duplicadas (hedging).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = deque()
+
+    def record(self, duration):
+        """ Registra a duração, em segundos, de uma requisição """
+        with self._lock:
+            self._samples.append(duration)
+
+            while len(self._samples) > settings.CORREIOS_WEBSERVICE_LATENCY_WINDOW:
+                self._samples.popleft()
+
+    def percentile(self, percent):
+        """
+        Calcula um percentil das latências recentes
+
+        :param percent: percentil, de 0 a 100
+        :return: a latência em segundos ou None se ainda não houver
+            `CORREIOS_WEBSERVICE_LATENCY_MIN_SAMPLES` amostras
+        :rtype: float|None
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+
+        if not samples or len(samples) < settings.CORREIOS_WEBSERVICE_LATENCY_MIN_SAMPLES:
+            return None
+
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+    def get_timeout(self):
+        """
+        Obtém o timeout das próximas requisições: o p99 recente multiplicado por
+        `CORREIOS_WEBSERVICE_TIMEOUT_FACTOR`, limitado entre
+        `CORREIOS_WEBSERVICE_MIN_TIMEOUT` e `CORREIOS_WEBSERVICE_TIMEOUT`
+
+        :rtype: float
+        """
+        max_timeout = settings.CORREIOS_WEBSERVICE_TIMEOUT
+
+        if not settings.CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT:
+            return max_timeout
+
+        p99 = self.percentile(99)
+        if p99 is None:
+            return max_timeout
+
+        return min(max(p99 * settings.CORREIOS_WEBSERVICE_TIMEOUT_FACTOR,
+                       settings.CORREIOS_WEBSERVICE_MIN_TIMEOUT), max_timeout)
+
+    def get_hedge_delay(self, timeout):
+        """
+        Obtém após quanto tempo sem resposta uma requisição duplicada deve ser enviada
+
+        :return: o p95 recente ou None se as requisições duplicadas estiverem desabilitadas,
+            ainda não houver amostras suficientes ou o p95 não for menor que o timeout
+        :rtype: float|None
+        """
+        if not settings.CORREIOS_WEBSERVICE_HEDGE:
+            return None
+
+        p95 = self.percentile(95)
+        if p95 is None or p95 >= timeout:
+            return None
+
+        return p95
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+class Deadline(object):
+    """
+    Prazo total para as requisições ao webservice de um pedido, compartilhado
+    por todos os pacotes e serviços cotados, ex: `CORREIOS_QUOTE_DEADLINE`.
+
+    As requisições têm o timeout limitado ao tempo restante e não são
+    feitas depois que o prazo termina.
+    """
+
+    def __init__(self, seconds):
+        """
+        :param seconds: duração do prazo, em segundos, a partir de agora
+        """
+        self.seconds = seconds
+        self.expires_at = default_timer() + seconds
+
+    def remaining(self):
+        """
+        Tempo restante, em segundos
+        :rtype: float
+        """
+        return max(self.expires_at - default_timer(), 0.0)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def get_timeout(self, timeout):
+        """
+        Limita o timeout de uma requisição ao tempo restante
+        :rtype: float
+        """
+        return min(timeout, self.remaining())
+
+    def __repr__(self):
+        return "<Deadline: {0}s, {1:.3f}s restantes>".format(self.seconds, self.remaining())
+
+
+def get_retry_delay(attempt):
+    """
+    Tempo de espera antes de uma nova tentativa, com recuo exponencial e variação
+    aleatória completa (full jitter) para que os clientes não tentem ao mesmo tempo
+
+    :param attempt: número da nova tentativa, a partir de 1
+    :rtype: float
+    """
+    return random.uniform(0, settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF * (2 ** (attempt - 1)))
+
+
+def get_max_request_time():
+    """
+    Tempo máximo, em segundos, para obter uma resposta do webservice com todas as
+    tentativas (`CORREIOS_WEBSERVICE_RETRIES`) e as esperas máximas entre elas
+    :rtype: float
+    """
+    retries = settings.CORREIOS_WEBSERVICE_RETRIES
+    backoff = sum(settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF * (2 ** (attempt - 1))
+                  for attempt in range(1, retries + 1))
+    return (retries + 1) * settings.CORREIOS_WEBSERVICE_TIMEOUT + backoff
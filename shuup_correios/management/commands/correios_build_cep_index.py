@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shuup_correios.cep_index import CepIndex
+
+
+class Command(BaseCommand):
+    help = ("Compila um arquivo CSV de faixas de CEP, com as colunas uf, cep_inicial e cep_final, "
+            "no índice utilizado pela configuração CORREIOS_CEP_INDEX_PATH.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="Arquivo CSV das faixas de CEP.")
+        parser.add_argument("output", help="Arquivo do índice a ser gerado.")
+
+    def handle(self, *args, **options):
+        try:
+            size = CepIndex.compile(options["input"], options["output"])
+        except (IOError, KeyError, ValueError) as exc:
+            raise CommandError("Não foi possível compilar o índice de CEPs: {0}".format(exc))
+
+        self.stdout.write("Índice de CEPs gerado com {0} faixas.".format(size))
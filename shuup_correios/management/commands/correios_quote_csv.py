@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+import csv
+import io
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import force_text
+from requests.exceptions import ConnectionError
+
+from shuup_correios.cep_index import validate_cep
+from shuup_correios.correios import (CORREIOS_MIN_HEIGHT, CORREIOS_MIN_LENGTH,
+                                     CORREIOS_MIN_WIDTH, CorreiosServico,
+                                     CorreiosWS, CorreiosWSCircuitOpenException,
+                                     CorreiosWSServerErrorException,
+                                     CorreiosWSServerTimeoutException)
+from shuup_correios.management.utils import parse_package
+
+REQUIRED_COLUMNS = ("cep_origem", "cep_destino", "peso", "largura", "comprimento", "altura", "servicos")
+
+OUTPUT_COLUMNS = ("linha", "cep_origem", "cep_destino", "servico", "valor", "prazo_entrega",
+                  "valor_sem_adicionais", "erro", "msg_erro")
+
+
+def parse_servicos(value):
+    """
+    Converte uma lista de serviços separados por ";" ou espaços. Aceita os códigos
+    ou os nomes de `CorreiosServico`, ex: "PAC;40010"
+    """
+    cod_servicos = []
+
+    for servico in value.replace(";", " ").split():
+        cod_servico = getattr(CorreiosServico, servico.upper(), servico)
+        if not cod_servico.isdigit():
+            raise CommandError("Serviço inválido: {0}".format(servico))
+
+        if cod_servico not in cod_servicos:
+            cod_servicos.append(cod_servico)
+
+    if not cod_servicos:
+        raise CommandError("Informe ao menos um serviço.")
+
+    return cod_servicos
+
+
+def parse_bool(value):
+    return (value or "").strip().upper() in ("S", "SIM", "1", "TRUE")
+
+
+class QuoteRow(object):
+    """ Linha do arquivo de entrada e a cotação dos seus serviços """
+
+    def __init__(self, line, values):
+        self.line = line
+        self.cep_origem = values.get("cep_origem", "")
+        self.cep_destino = values.get("cep_destino", "")
+        self.cod_servicos = []
+        self.key = None
+        self.future = None
+        self.error = None
+
+    def get_results(self):
+        """
+        Aguarda a cotação e retorna os resultados de cada serviço
+        :rtype: collections.OrderedDict[str, shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult]
+        """
+        return self.future.result()
+
+
+class Command(BaseCommand):
+    help = ("Cota os pacotes de um arquivo CSV, com uma linha por pacote e as colunas "
+            "cep_origem, cep_destino, peso (g), largura, comprimento e altura (mm) e servicos "
+            "(códigos ou nomes separados por ';'). As colunas valor_declarado, mao_propria e "
+            "aviso_recebimento são opcionais. O resultado é gravado em CSV, uma linha por serviço, "
+            "na ordem do arquivo de entrada. O arquivo é lido e gravado aos poucos, sem ser "
+            "carregado na memória, e as cotações repetidas são reaproveitadas do cache.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="Arquivo CSV de entrada ou - para a entrada padrão.")
+        parser.add_argument("--output", dest="output", default="-",
+                            help="Arquivo CSV de saída. Utiliza a saída padrão se não informado.")
+        parser.add_argument("--delimiter", dest="delimiter", default=",",
+                            help="Separador de colunas dos arquivos CSV.")
+        parser.add_argument("--encoding", dest="encoding", default="utf-8",
+                            help="Codificação do arquivo de entrada.")
+        parser.add_argument("--workers", type=int, dest="workers",
+                            default=settings.CORREIOS_WEBSERVICE_MAX_WORKERS,
+                            help="Quantidade máxima de requisições simultâneas ao webservice.")
+        parser.add_argument("--window", type=int, dest="window", default=None,
+                            help="Quantidade máxima de linhas em andamento (padrão: 10 vezes --workers).")
+        parser.add_argument("--cod-empresa", dest="cod_empresa", default=None,
+                            help="Código da empresa para cotar com os preços do contrato.")
+        parser.add_argument("--senha", dest="senha", default=None,
+                            help="Senha do código da empresa.")
+
+    def handle(self, *args, **options):
+        workers = max(1, options["workers"])
+        window = max(workers, options["window"] or workers * 10)
+
+        input_file = self._open(options["input"], "r", options["encoding"], sys.stdin)
+        output_file = self._open(options["output"], "w", "utf-8", sys.stdout)
+
+        try:
+            reader = csv.DictReader(input_file, delimiter=options["delimiter"])
+            missing_columns = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+            if missing_columns:
+                raise CommandError("Colunas ausentes no arquivo de entrada: {0}".format(", ".join(missing_columns)))
+
+            writer = csv.writer(output_file, delimiter=options["delimiter"], lineterminator="\n")
+            writer.writerow(OUTPUT_COLUMNS)
+
+            stats = self._run(reader, writer, workers, window, options["cod_empresa"], options["senha"])
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+            if output_file is not sys.stdout:
+                output_file.close()
+
+        self.stderr.write("{rows} linhas, {requests} cotações, {reused} reaproveitadas, "
+                          "{failures} falharam.".format(**stats))
+
+    def _open(self, path, mode, encoding, default):
+        if path == "-":
+            return default
+
+        try:
+            return io.open(path, mode, encoding=encoding, newline="")
+        except IOError as exc:
+            raise CommandError("Não foi possível abrir {0}: {1}".format(path, exc))
+
+    def _run(self, reader, writer, workers, window, cod_empresa, senha):
+        """
+        Cota as linhas mantendo no máximo `window` linhas em andamento e grava os
+        resultados na ordem da entrada, à medida que ficam prontos.
+
+        Linhas com os mesmos parâmetros em andamento compartilham a mesma cotação;
+        as demais repetições são obtidas do cache por `get_preco_prazo_servicos`.
+        """
+        stats = {"rows": 0, "requests": 0, "reused": 0, "failures": 0}
+        executor = ThreadPoolExecutor(max_workers=workers)
+        rows = deque()
+        in_flight = {}
+
+        try:
+            for line, values in enumerate(reader, 2):
+                row = QuoteRow(line, values)
+                rows.append(row)
+                stats["rows"] += 1
+
+                try:
+                    kwargs = self._get_preco_prazo_kwargs(values, cod_empresa, senha)
+                except CommandError as exc:
+                    row.error = force_text(exc)
+                else:
+                    row.cod_servicos = kwargs["cod_servicos"]
+                    row.key = self._get_key(kwargs)
+                    row.future = in_flight.get(row.key)
+
+                    if row.future is None:
+                        row.future = executor.submit(CorreiosWS.get_preco_prazo_servicos, **kwargs)
+                        in_flight[row.key] = row.future
+                        stats["requests"] += 1
+                    else:
+                        stats["reused"] += 1
+
+                while len(rows) >= window:
+                    self._write_row(writer, rows.popleft(), in_flight, stats)
+
+            while rows:
+                self._write_row(writer, rows.popleft(), in_flight, stats)
+        finally:
+            for row in rows:
+                if row.future:
+                    row.future.cancel()
+            executor.shutdown(wait=False)
+
+        return stats
+
+    def _get_preco_prazo_kwargs(self, values, cod_empresa, senha):
+        """ Converte uma linha nos parâmetros de `CorreiosWS.get_preco_prazo_servicos` """
+        package = parse_package(",".join(values.get(column) or "" for column in
+                                         ("peso", "largura", "comprimento", "altura")))
+
+        try:
+            valor_declarado = Decimal((values.get("valor_declarado") or "0").replace(",", "."))
+        except InvalidOperation:
+            raise CommandError("Valor declarado inválido: {0}".format(values.get("valor_declarado")))
+
+        try:
+            # restaura o zero à esquerda perdido (ex: planilhas) e, se houver índice local,
+            # rejeita os CEPs inexistentes sem enviá-los aos Correios
+            cep_origem = validate_cep(values.get("cep_origem"), "CEP de origem")
+            cep_destino = validate_cep(values.get("cep_destino"), "CEP de destino")
+        except ValidationError as error:
+            raise CommandError(error.message)
+
+        return {
+            "cep_origem": cep_origem,
+            "cep_destino": cep_destino,
+            "cod_servicos": parse_servicos(values.get("servicos") or ""),
+            "package": package,
+            "cod_empresa": cod_empresa,
+            "senha": senha,
+            "mao_propria": parse_bool(values.get("mao_propria")),
+            "valor_declarado": valor_declarado,
+            "aviso_recebimento": parse_bool(values.get("aviso_recebimento")),
+            "min_package_width": CORREIOS_MIN_WIDTH,
+            "min_package_length": CORREIOS_MIN_LENGTH,
+            "min_package_height": CORREIOS_MIN_HEIGHT
+        }
+
+    def _get_key(self, kwargs):
+        return tuple((name, tuple(value) if isinstance(value, list) else value)
+                     for name, value in sorted(kwargs.items()))
+
+    def _write_row(self, writer, row, in_flight, stats):
+        if row.future is not None and in_flight.get(row.key) is row.future:
+            # concluída, as próximas linhas iguais obtêm a cotação do cache
+            del in_flight[row.key]
+
+        if row.error is None:
+            try:
+                results = row.get_results()
+            except CorreiosWSCircuitOpenException:
+                raise CommandError("O webservice dos Correios está indisponível. As linhas até a {0} "
+                                   "foram gravadas.".format(row.line - 1))
+            except (CorreiosWSServerTimeoutException, CorreiosWSServerErrorException, ConnectionError) as exc:
+                row.error = repr(exc)
+            else:
+                for cod_servico in row.cod_servicos:
+                    result = results.get(cod_servico)
+                    if result is None:
+                        stats["failures"] += 1
+                        writer.writerow((row.line, row.cep_origem, row.cep_destino, cod_servico,
+                                         "", "", "", "", "Serviço não retornado pelo webservice"))
+                        continue
+
+                    writer.writerow((row.line, row.cep_origem, row.cep_destino, cod_servico,
+                                     result.valor, result.prazo_entrega, result.valor_sem_adicionais,
+                                     result.erro, result.msg_erro or ""))
+                return
+
+        stats["failures"] += 1
+        writer.writerow((row.line, row.cep_origem, row.cep_destino, ";".join(row.cod_servicos),
+                         "", "", "", "", row.error))
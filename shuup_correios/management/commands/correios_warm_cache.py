@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from requests.exceptions import ConnectionError
+
+from shuup.core.models import Order, OrderLineType
+from shuup.core.order_creator import OrderSource
+from shuup_correios.correios import (CorreiosWS, CorreiosWSCircuitOpenException,
+                                     CorreiosWSServerErrorException,
+                                     CorreiosWSServerTimeoutException)
+from shuup_correios.management.utils import parse_cep, parse_package
+from shuup_correios.models import CorreiosBehaviorComponent
+from shuup_correios.rate_table import get_rate_table
+
+
+class WarmTask(object):
+    """ Cotação de um pacote para um ou mais serviços com os mesmos parâmetros """
+
+    def __init__(self, params, package):
+        self.params = params
+        self.package = package
+        self.cod_servicos = []
+
+    def get_request(self):
+        """ :rtype: shuup_correios.correios.CorreiosWS.PrecoPrazoRequest """
+        return CorreiosWS.PrecoPrazoRequest(cod_servicos=self.cod_servicos, package=self.package, **self.params)
+
+
+def get_order_source(order):
+    """
+    Recria o carrinho de um pedido para que ele seja empacotado como no checkout
+    :rtype: shuup.core.order_creator.OrderSource
+    """
+    source = OrderSource(order.shop)
+    source.shipping_address = order.shipping_address
+    source.billing_address = order.billing_address
+
+    for line in order.lines.products():
+        source.add_line(
+            type=OrderLineType.PRODUCT,
+            product=line.product,
+            supplier=line.supplier,
+            quantity=line.quantity,
+            base_unit_price=line.base_unit_price,
+            discount_amount=line.discount_amount)
+
+    return source
+
+
+class Command(BaseCommand):
+    help = ("Preenche o cache dos Correios para todos os serviços habilitados. "
+            "As cotações que já estão no cache são ignoradas, assim o comando pode "
+            "ser executado novamente para continuar de onde parou.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cep", action="append", dest="ceps", default=[],
+                            help="CEP de destino completo. Pode ser informado várias vezes.")
+        parser.add_argument("--package", action="append", dest="packages", default=[],
+                            help="Pacote no formato peso,largura,comprimento,altura (g e mm). "
+                                 "Pode ser informado várias vezes.")
+        parser.add_argument("--from-orders", type=int, dest="days", default=None,
+                            help="Utiliza os endereços e carrinhos dos pedidos dos últimos N dias.")
+        parser.add_argument("--max-orders", type=int, dest="max_orders", default=1000,
+                            help="Quantidade máxima de pedidos utilizados com --from-orders.")
+        parser.add_argument("--workers", type=int, dest="workers",
+                            default=settings.CORREIOS_WEBSERVICE_MAX_WORKERS,
+                            help="Quantidade máxima de requisições simultâneas ao webservice.")
+        parser.add_argument("--force", action="store_true", dest="force", default=False,
+                            help="Requisita novamente as cotações que já estão no cache.")
+
+    def handle(self, *args, **options):
+        ceps = [parse_cep(cep) for cep in options["ceps"]]
+        packages = [parse_package(package) for package in options["packages"]]
+
+        if bool(ceps) != bool(packages):
+            raise CommandError("Informe --cep e --package juntos.")
+
+        if not ceps and options["days"] is None:
+            raise CommandError("Informe --cep e --package ou --from-orders.")
+
+        components = list(
+            CorreiosBehaviorComponent.objects.filter(shippingmethod__enabled=True)
+            .exclude(pricing_mode=CorreiosBehaviorComponent.PRICING_MODE_TABLE)
+            .distinct()
+        )
+
+        tasks = OrderedDict()
+
+        for component in components:
+            if component.valor_declarado:
+                # o valor declarado depende do carrinho, apenas os pedidos podem ser utilizados
+                continue
+
+            for cep in ceps:
+                params = component._build_preco_prazo_params(cep)
+                for package in packages:
+                    self._add_task(tasks, component, params, package)
+
+        if options["days"] is not None:
+            self._add_order_tasks(tasks, components, options["days"], options["max_orders"])
+
+        self._run(list(tasks.values()), options["workers"], options["force"], options["verbosity"])
+
+    def _add_task(self, tasks, component, params, package):
+        if params["cep_destino"] == "" or params["cep_origem"] == "":
+            return
+
+        rate_table = get_rate_table()
+        if (component.pricing_mode == CorreiosBehaviorComponent.PRICING_MODE_TABLE_WS and
+                rate_table and rate_table.get_preco_prazo(package=package, **params)):
+            # já é cotado pela tabela de preços, não utiliza o webservice
+            return
+
+        params = dict(params)
+        cod_servico = params.pop("cod_servico")
+        key = (tuple(sorted(params.items())), package.weight, package.width, package.length, package.height)
+
+        task = tasks.get(key)
+        if task is None:
+            task = tasks[key] = WarmTask(params, package)
+
+        if cod_servico not in task.cod_servicos:
+            task.cod_servicos.append(cod_servico)
+
+    def _add_order_tasks(self, tasks, components, days, max_orders):
+        orders = Order.objects.filter(
+            created_on__gte=timezone.now() - timedelta(days=days),
+            shipping_address__isnull=False
+        ).select_related("shop", "shipping_address", "billing_address").order_by("-created_on")[:max_orders]
+
+        shop_ids = dict(
+            (component.pk, set(component.shippingmethod_set.filter(enabled=True).values_list("shop_id", flat=True)))
+            for component in components
+        )
+
+        for order in orders:
+            source = get_order_source(order)
+
+            for component in components:
+                if order.shop_id not in shop_ids[component.pk]:
+                    continue
+
+                params = component._get_preco_prazo_params(source)
+                packages = component._get_packages(source)
+
+                if not params or not packages:
+                    continue
+
+                for package in packages:
+                    self._add_task(tasks, component, params, package)
+
+    def _run(self, tasks, workers, force, verbosity):
+        pending = []
+        skipped = 0
+
+        for task in tasks:
+            request = task.get_request()
+            missing = list(request.results.keys()) if force else request.load_cached() + request.stale
+
+            if missing:
+                pending.append(request.get_refresh_request(missing))
+            else:
+                skipped += 1
+
+        self.stdout.write("{0} cotações, {1} já estão no cache.".format(len(tasks), skipped))
+
+        if not pending:
+            return
+
+        failures = 0
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        futures = dict((executor.submit(CorreiosWS._fetch, request), request) for request in pending)
+
+        try:
+            for index, future in enumerate(as_completed(futures), 1):
+                request = futures[future]
+                description = "[{0}/{1}] {2} {3}".format(index, len(pending), request.cep_destino,
+                                                         ",".join(request.results.keys()))
+                try:
+                    results = future.result()
+                except CorreiosWSCircuitOpenException:
+                    raise CommandError("O webservice dos Correios está indisponível. "
+                                       "Execute o comando novamente mais tarde para continuar.")
+                except (CorreiosWSServerTimeoutException, CorreiosWSServerErrorException, ConnectionError) as exc:
+                    failures += 1
+                    self.stderr.write("{0}: falhou ({1!r})".format(description, exc))
+                    continue
+
+                if verbosity >= 1:
+                    erros = [str(result.erro) for result in results.values() if result and result.erro]
+                    self.stdout.write("{0}: {1}".format(description, "erro " + ",".join(erros) if erros else "ok"))
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        self.stdout.write("{0} cotações requisitadas, {1} falharam.".format(len(pending) - failures, failures))
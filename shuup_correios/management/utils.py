@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import unicode_literals
+
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import CommandError
+
+from shuup_correios.correios import normalize_cep
+from shuup_correios.packing import PackageDimensions
+
+
+def parse_cep(value):
+    """
+    Converte um CEP completo no formato "12345678", restaurando o zero à esquerda perdido
+    (ex: 1310100 é 01310100). Prefixos não são aceitos: as cotações são armazenadas pelo
+    CEP completo, então um CEP completado com zeros não seria utilizado pelos clientes.
+    """
+    cep = "".join([d for d in value if d.isdigit()])
+
+    if len(cep) not in (7, 8):
+        raise CommandError("CEP inválido: {0}. Informe o CEP completo.".format(value))
+
+    return normalize_cep(cep)
+
+
+def parse_package(value):
+    """ Converte um pacote no formato "peso,largura,comprimento,altura" (g e mm) """
+    try:
+        values = [Decimal(part.strip()) for part in value.split(",")]
+    except InvalidOperation:
+        values = []
+
+    if len(values) != 4 or any(part <= 0 for part in values):
+        raise CommandError("Pacote inválido: {0}. Utilize peso,largura,comprimento,altura".format(value))
+
+    return PackageDimensions(*values)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shuup_correios', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='correiosbehaviorcomponent',
+            name='pricing_mode',
+            field=models.CharField(help_text='Indica como os preços e prazos são calculados: apenas pelo webservice dos Correios, apenas pela tabela local de preços ou pela tabela, consultando o webservice quando a tabela não atender o pedido.', choices=[('ws', 'Webservice'), ('table', 'Tabela'), ('table_ws', 'Tabela e webservice')], default='ws', max_length=10, verbose_name='Modo de cálculo'),
+        ),
+    ]
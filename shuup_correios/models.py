@@ -11,11 +11,14 @@ from __future__ import unicode_literals
 
 import logging
 from decimal import Decimal
+from timeit import default_timer
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
+from requests.exceptions import ConnectionError
 
 from shuup.core.fields import MeasurementField
 from shuup.core.models._service_base import (ServiceBehaviorComponent,
@@ -23,8 +26,18 @@ from shuup.core.models._service_base import (ServiceBehaviorComponent,
 from shuup.core.models._service_shipping import Carrier
 from shuup.utils.dates import DurationRange
 from shuup.utils.importing import cached_load
+from shuup_correios.cache import QuoteCacheBatch
+from shuup_correios.cep_index import validate_cep
 from shuup_correios.correios import (CorreiosServico, CorreiosWS,
-                                     CorreiosWSServerTimeoutException)
+                                     CorreiosWSServerErrorException,
+                                     CorreiosWSServerTimeoutException,
+                                     quote_cache)
+from shuup_correios.fallback import get_fallback_preco_prazo
+from shuup_correios.latency import Deadline
+from shuup_correios.packing import get_packages
+from shuup_correios.rate_table import RateTable, get_rate_table
+from shuup_correios.signals import quote_calculated
+from shuup_correios.utils import run_concurrently
 from shuup_order_packager.constraints import (SimplePackageDimensionConstraint,
                                               WeightPackageConstraint)
 
@@ -32,6 +45,18 @@ logger = logging.getLogger(__name__)
 KG_TO_G = Decimal(1000)
 
 
+class CorreiosQuote(object):
+    """ Pacotes e resultados dos Correios obtidos para um pedido """
+
+    def __init__(self, packages, results=None, timeout=False, cep_error=None, fallback=False):
+        self.packages = packages
+        self.results = results or []
+        self.timeout = timeout
+        self.cep_error = cep_error
+        # indica que algum resultado foi estimado pela contingência
+        self.fallback = fallback
+
+
 class CorreiosCarrier(Carrier):
     CORREIOS_SERVICES_MAP = {
         'PAC': CorreiosServico.PAC,
@@ -77,6 +102,15 @@ class CorreiosBehaviorComponent(ServiceBehaviorComponent):
         (CorreiosServico.ESEDEX, '({0}) eSedex'.format(CorreiosServico.ESEDEX)),
     )
 
+    PRICING_MODE_WS = "ws"
+    PRICING_MODE_TABLE = "table"
+    PRICING_MODE_TABLE_WS = "table_ws"
+    PRICING_MODE_CHOICES = (
+        (PRICING_MODE_WS, 'Webservice'),
+        (PRICING_MODE_TABLE, 'Tabela'),
+        (PRICING_MODE_TABLE_WS, 'Tabela e webservice'),
+    )
+
     name = _("Serviço dos Correios")
     help_text = _("Configurações do serviço")
 
@@ -124,6 +158,14 @@ class CorreiosBehaviorComponent(ServiceBehaviorComponent):
                                             help_text="Indica se a encomenda será entregue "
                                                       "com o serviço adicional aviso de recebimento.")
 
+    pricing_mode = models.CharField("Modo de cálculo",
+                                    max_length=10, default=PRICING_MODE_WS,
+                                    choices=PRICING_MODE_CHOICES,
+                                    help_text="Indica como os preços e prazos são calculados: "
+                                              "apenas pelo webservice dos Correios, apenas pela "
+                                              "tabela local de preços ou pela tabela, consultando "
+                                              "o webservice quando a tabela não atender o pedido.")
+
     additional_delivery_time = models.PositiveIntegerField("Prazo adicional",
                                                            blank=True,
                                                            default=0,
@@ -205,20 +247,23 @@ class CorreiosBehaviorComponent(ServiceBehaviorComponent):
         """
 
         errors = []
-        packages = self._pack_source(source)
+        quote = self._get_quote(source)
 
-        if packages:
-            try:
-                results = self._get_correios_results(source, packages)
+        if quote.cep_error:
+            errors.append(quote.cep_error)
+
+        elif quote.packages:
+            if quote.timeout:
+                # sem resposta a tempo, circuito aberto ou prazo do pedido esgotado
+                errors.append(ValidationError("Os serviços dos Correios estão temporariamente indisponíveis.",
+                                              code="correios_unavailable"))
 
-                if results:
-                    for result in results:
-                        if result.erro != 0:
-                            logger.warn("{0}: {1}".format(result.erro, result.msg_erro))
-                            errors.append(ValidationError("Alguns itens não poderão ser "
-                                                          "entregues pelos Correios.", code=result.erro))
-            except CorreiosWSServerTimeoutException:
-                errors.append(ValidationError("Não foi possível contatar os serviços dos Correios."))
+            elif quote.results:
+                for result in quote.results:
+                    if result.erro != 0:
+                        logger.warn("{0}: {1}".format(result.erro, result.msg_erro))
+                        errors.append(ValidationError("Alguns itens não poderão ser "
+                                                      "entregues pelos Correios.", code=result.erro))
 
         else:
             errors.append(ValidationError("Alguns itens não puderam ser empacotados nos requisitos dos Correios."))
@@ -235,28 +280,27 @@ class CorreiosBehaviorComponent(ServiceBehaviorComponent):
         :type source: shuup.core.order_creator.OrderSource
         :rtype: Iterable[ServiceCost]
         """
-        packages = self._pack_source(source)
+        quote = self._get_quote(source)
+        self._mark_fallback(service, source, quote.fallback)
 
-        try:
-            results = self._get_correios_results(source, packages)
-            total_price = Decimal()
-
-            for result in results:
-                if result.erro == 0:
-                    total_price = total_price + result.valor
-                else:
-                    total_price = 0
-                    logger.critical("CorreiosWS: Erro {0} ao calcular "
-                                    "preço e prazo para {2}: {1}".format(result.erro,
-                                                                         result.msg_erro,
-                                                                         source))
-                    break
-
-            if total_price > 0:
-                yield ServiceCost(source.create_price(total_price + self.additional_price))
-
-        except CorreiosWSServerTimeoutException:
-            pass
+        if quote.timeout or quote.cep_error:
+            return
+
+        total_price = Decimal()
+
+        for result in quote.results:
+            if result.erro == 0:
+                total_price = total_price + result.valor
+            else:
+                total_price = 0
+                logger.critical("CorreiosWS: Erro {0} ao calcular "
+                                "preço e prazo para {2}: {1}".format(result.erro,
+                                                                     result.msg_erro,
+                                                                     source))
+                break
+
+        if total_price > 0:
+            yield ServiceCost(source.create_price(total_price + self.additional_price))
 
     def get_delivery_time(self, service, source):
         """
@@ -265,17 +309,15 @@ class CorreiosBehaviorComponent(ServiceBehaviorComponent):
         :rtype: shuup.utils.dates.DurationRange|None
         """
 
-        packages = self._pack_source(source)
+        quote = self._get_quote(source)
 
-        try:
-            results = self._get_correios_results(source, packages)
-        except CorreiosWSServerTimeoutException:
+        if quote.timeout or quote.cep_error:
             return None
 
         max_days = 1
         min_days = 0
 
-        for result in results:
+        for result in quote.results:
             if result.erro == 0:
                 max_days = max(max_days, result.prazo_entrega)
                 min_days = result.prazo_entrega if not min_days else min(min_days, result.prazo_entrega)
@@ -290,6 +332,145 @@ class CorreiosBehaviorComponent(ServiceBehaviorComponent):
         return DurationRange.from_days(min_days + self.additional_delivery_time,
                                        max_days + self.additional_delivery_time)
 
+    def _mark_fallback(self, service, source, fallback):
+        """
+        Marca o pedido para revisão (`shipping_data["correios_fallback"]`, gravado no pedido)
+        quando o frete do serviço selecionado foi estimado pela contingência
+        """
+        shipping_data = getattr(source, "shipping_data", None)
+
+        if shipping_data is None or service is None or getattr(source, "shipping_method_id", None) != service.pk:
+            return
+
+        if fallback:
+            shipping_data["correios_fallback"] = True
+        else:
+            shipping_data.pop("correios_fallback", None)
+
+    def _get_quote(self, source):
+        """
+        Obtém os pacotes e os resultados dos Correios para o pedido.
+
+        O resultado é memorizado no próprio `source`, indexado pela impressão
+        digital do pedido e pela configuração deste componente, assim
+        `get_unavailability_reasons`, `get_costs` e `get_delivery_time`
+        empacotam e consultam os Correios uma única vez por requisição.
+
+        :type source: shuup.core.order_creator.OrderSource
+        :rtype: CorreiosQuote
+        """
+        quote_key = self._get_quote_key(source)
+        quotes = getattr(source, "_correios_quotes", None)
+
+        if quote_key is not None and quotes is not None and quote_key in quotes:
+            return quotes[quote_key]
+
+        instrumented = quote_calculated.has_listeners(CorreiosBehaviorComponent)
+        start = default_timer() if instrumented else None
+
+        cep_error = self._validate_ceps(source)
+
+        if cep_error:
+            # CEP inválido ou inexistente: não empacota nem consulta os Correios
+            quote = CorreiosQuote(None, cep_error=cep_error)
+        else:
+            quote = CorreiosQuote(self._get_packages(source))
+
+        if instrumented:
+            packing_duration = default_timer() - start
+            start = default_timer()
+
+        if quote.packages:
+            try:
+                quote.results = self._get_correios_results(source, quote.packages, self._get_deadline(source))
+            except (CorreiosWSServerTimeoutException, CorreiosWSServerErrorException, ConnectionError) as exc:
+                logger.warning("Correios: webservice indisponível: {0!r}".format(exc))
+                quote.results, quote.fallback = self._get_fallback_results(source, quote.packages)
+                quote.timeout = not quote.results
+
+        if instrumented:
+            quote_calculated.send(
+                sender=CorreiosBehaviorComponent,
+                component=self,
+                source=source,
+                package_count=len(quote.packages or []),
+                packing_duration=packing_duration,
+                results_duration=default_timer() - start,
+                timeout=quote.timeout,
+                fallback=quote.fallback,
+                erros=[result.erro for result in quote.results if result]
+            )
+
+        if quote_key is not None:
+            if quotes is None:
+                quotes = source._correios_quotes = {}
+            quotes[quote_key] = quote
+
+        return quote
+
+    def _validate_ceps(self, source):
+        """
+        Valida os CEPs de origem e destino, localmente, antes de qualquer consulta aos Correios
+        :rtype: django.core.exceptions.ValidationError|None
+        :return: o erro do primeiro CEP inválido ou None
+        """
+        if source is None:
+            return None
+
+        address = source.shipping_address or source.billing_address
+        if not address:
+            return None
+
+        try:
+            validate_cep(self.cep_origem, "CEP de origem")
+            validate_cep(address.postal_code, "CEP de destino")
+        except ValidationError as error:
+            logger.warn("Correios: {0}".format(error.message))
+            return error
+
+        return None
+
+    def _get_quote_key(self, source):
+        """
+        Gera a chave que identifica a cotação de um pedido para este componente
+        ou None caso não seja possível identificá-la
+        """
+        if source is None:
+            return None
+
+        lines = tuple(sorted(
+            (line.product.pk, line.quantity)
+            for line in source.get_lines() if line.product
+        ))
+
+        address = source.shipping_address or source.billing_address
+        postal_code = address.postal_code if address else None
+
+        return (self._get_config_key(), lines, postal_code, source.total_price_of_products.value)
+
+    def _get_config_key(self):
+        """ Retorna uma tupla com as configurações que afetam a cotação """
+        return (self.pk, self.pricing_mode, self.cod_servico, self.cod_servico_contrato,
+                self.cep_origem, self.cod_empresa, self.senha, self.mao_propria,
+                self.valor_declarado, self.aviso_recebimento, self.min_width,
+                self.min_length, self.min_height) + self._get_packing_key()
+
+    def _get_packing_key(self):
+        """ Retorna uma tupla com as restrições que afetam o empacotamento """
+        return (self.max_weight, self.max_width, self.max_length, self.max_height, self.max_edges_sum)
+
+    def _get_packages(self, source):
+        """
+        Obtém os pacotes do pedido, reutilizando o empacotamento do mesmo carrinho
+        com as mesmas restrições, da requisição atual ou do cache
+        :rtype: list[shuup_correios.packing.PackageDimensions]|None
+        :return: Lista de pacotes ou None se for impossível empacotar pedido
+        """
+        if source is None:
+            return self._pack_source(source)
+
+        return get_packages(source, self._get_packing_key(), self._pack_source)
+
     def _pack_source(self, source):
         """
         Empacota itens do pedido
@@ -305,38 +486,253 @@ class CorreiosBehaviorComponent(ServiceBehaviorComponent):
         packager.add_constraint(WeightPackageConstraint(self.max_weight * KG_TO_G))
         return packager.pack_source(source)
 
-    def _get_correios_results(self, source, packages):
+    def _get_correios_results(self, source, packages, deadline=None):
         """
         Obtém uma lista dos resultados obtidos dos correios para determinado pedido
         :type source: shuup.core.order_creator.OrderSource
+        :type deadline: shuup_correios.latency.Deadline|None
+        :param deadline: prazo total das requisições ao webservice
+        :raises shuup_correios.correios.CorreiosWSDeadlineExceededException: se o prazo terminar
         :rtype: list of shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult
         """
+        params = self._get_preco_prazo_params(source)
+
+        if not params:
+            return []
+
+        results = self._get_rate_table_results(params, packages)
+        if self.pricing_mode == self.PRICING_MODE_TABLE:
+            return results
+
+        servicos_adicionais = self._get_servicos_adicionais(source)
+        batch = self._get_cache_batch(source)
+
+        # os pacotes que já estão no cache não precisam ocupar uma thread. Todos os pacotes e
+        # serviços adicionais são lidos de uma só vez, assim os demais componentes do pedido
+        # também encontram os seus resultados em `batch`
+        pending = [index for index, result in enumerate(results) if not result]
+        if pending:
+            cached = CorreiosWS.get_cached_preco_prazo_many(packages=[packages[index] for index in pending],
+                                                            servicos_adicionais=servicos_adicionais,
+                                                            batch=batch,
+                                                            **params)
+            for index, result in zip(pending, cached):
+                results[index] = result
+
+        missing = [index for index, result in enumerate(results) if not result]
+        if not missing:
+            return results
+
+        def get_preco_prazo(package):
+            return CorreiosWS.get_preco_prazo(package=package, servicos_adicionais=servicos_adicionais,
+                                              batch=batch, deadline=deadline, **params)
+
+        try:
+            fetched = run_concurrently(get_preco_prazo,
+                                       [packages[index] for index in missing],
+                                       settings.CORREIOS_WEBSERVICE_MAX_WORKERS)
+        finally:
+            # grava de uma só vez os resultados de todos os pacotes requisitados
+            batch.flush()
+
+        for index, result in zip(missing, fetched):
+            results[index] = result
+
+        return results
+
+    def _get_rate_table_results(self, params, packages):
+        """
+        Obtém os resultados dos pacotes da tabela local de preços, conforme o modo de cálculo.
+        No modo "Tabela", os pacotes não atendidos pela tabela recebem um resultado com erro.
+        :param params: parâmetros de `CorreiosWS.get_preco_prazo` comuns a todos os pacotes
+        :type params: dict
+        :return: Resultado de cada pacote ou None para os pacotes que devem ser consultados no webservice
+        :rtype: list[shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult|None]
+        """
+        if self.pricing_mode == self.PRICING_MODE_WS:
+            return [None] * len(packages)
+
+        rate_table = get_rate_table()
+        results = [rate_table.get_preco_prazo(package=package, **params) if rate_table else None
+                   for package in packages]
+
+        if self.pricing_mode == self.PRICING_MODE_TABLE:
+            return [result or RateTable.get_not_found_result(params["cod_servico"]) for result in results]
+
+        return results
+
+    def _get_fallback_results(self, source, packages):
+        """
+        Obtém os resultados dos pacotes sem consultar o webservice, quando ele falha: do cache
+        de cotações, da tabela de preços ou dos provedores de contingência
+        (`CORREIOS_FALLBACK_PROVIDERS`), nesta ordem
+
+        :type source: shuup.core.order_creator.OrderSource
+        :return: tupla com os resultados de todos os pacotes, ou uma lista vazia se algum
+            pacote não for atendido, e se algum resultado foi estimado pelos provedores
+        :rtype: tuple[list[shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult], bool]
+        """
+        params = self._get_preco_prazo_params(source)
+        if not params:
+            return [], False
+
+        rate_table = get_rate_table() if self.pricing_mode != self.PRICING_MODE_WS else None
+        cached = CorreiosWS.get_cached_preco_prazo_many(packages=packages,
+                                                        batch=self._get_cache_batch(source),
+                                                        **params)
         results = []
+        estimated = False
+
+        for package, result in zip(packages, cached):
+            if not result and rate_table:
+                result = rate_table.get_preco_prazo(package=package, **params)
+
+            if not result and settings.CORREIOS_FALLBACK_PROVIDERS:
+                result = get_fallback_preco_prazo(package=package, **params)
+                estimated = True
+
+            if not result:
+                return [], False
+
+            results.append(result)
+
+        return results, estimated
 
-        cep_origem = "".join([d for d in self.cep_origem if d.isdigit()])
-        pedido_total = source.total_price_of_products.value
+    def _get_cache_batch(self, source):
+        """
+        Obtém as leituras e gravações agrupadas do cache de cotações, compartilhadas
+        por todos os componentes durante a requisição
+        :rtype: shuup_correios.cache.QuoteCacheBatch
+        """
+        batch = getattr(source, "_correios_cache_batch", None)
+
+        if batch is None:
+            batch = QuoteCacheBatch(quote_cache)
+            if source is not None:
+                source._correios_cache_batch = batch
+
+        return batch
+
+    def _get_deadline(self, source):
+        """
+        Obtém o prazo das requisições ao webservice (`CORREIOS_QUOTE_DEADLINE`), iniciado na
+        primeira cotação e compartilhado por todos os componentes durante a requisição
+        :rtype: shuup_correios.latency.Deadline|None
+        """
+        if settings.CORREIOS_QUOTE_DEADLINE is None:
+            return None
+
+        deadline = getattr(source, "_correios_deadline", None)
+
+        if deadline is None:
+            deadline = Deadline(settings.CORREIOS_QUOTE_DEADLINE)
+            if source is not None:
+                source._correios_deadline = deadline
+
+        return deadline
+
+    def _get_preco_prazo_params(self, source):
+        """
+        Obtém os parâmetros de `CorreiosWS.get_preco_prazo` comuns a todos os pacotes do pedido
+        :type source: shuup.core.order_creator.OrderSource
+        :rtype: dict|None
+        :return: Parâmetros ou None se o pedido não possuir endereço de entrega
+        """
         shipping_address = source.shipping_address
 
         if not shipping_address:
             shipping_address = source.billing_address
 
         if not shipping_address:
+            return None
+
+        return self._build_preco_prazo_params(shipping_address.postal_code,
+                                              source.total_price_of_products.value)
+
+    def _build_preco_prazo_params(self, postal_code, total_price_of_products=0):
+        """
+        Monta os parâmetros de `CorreiosWS.get_preco_prazo` para um CEP de destino
+        :param total_price_of_products: Valor dos produtos, utilizado no serviço de valor declarado
+        :rtype: dict
+        """
+        return {
+            "cep_destino": "".join([d for d in postal_code if d.isdigit()]),
+            "cep_origem": "".join([d for d in self.cep_origem if d.isdigit()]),
+            "cod_servico": self._get_cod_servico(),
+            "cod_empresa": self.cod_empresa,
+            "senha": self.senha,
+            "mao_propria": self.mao_propria,
+            "valor_declarado": total_price_of_products if self.valor_declarado else 0.0,
+            "aviso_recebimento": self.aviso_recebimento,
+            "min_package_width": self.min_width,
+            "min_package_length": self.min_length,
+            "min_package_height": self.min_height
+        }
+
+    def _get_cod_servico(self):
+        """ Código do serviço a ser enviado aos Correios """
+        return self.cod_servico_contrato if self.cod_servico_contrato else self.cod_servico
+
+    def _get_servicos_adicionais(self, source):
+        """
+        Obtém os códigos de serviço dos outros componentes dos Correios habilitados
+        na loja que geram exatamente os mesmos pacotes e parâmetros de cotação.
+
+        Esses serviços são cotados na mesma requisição ao webservice e ficam
+        no cache, assim os demais métodos de envio da página não precisam
+        fazer uma nova chamada para cada pacote.
+
+        :rtype: list[str]
+        """
+        shop = getattr(source, "shop", None)
+        if not shop:
             return []
 
-        cep_destino = "".join([d for d in shipping_address.postal_code if d.isdigit()])
-
-        for package in packages:
-            results.append(CorreiosWS.get_preco_prazo(cep_destino,
-                                                      cep_origem,
-                                                      self.cod_servico_contrato if self.cod_servico_contrato else self.cod_servico,
-                                                      package,
-                                                      self.cod_empresa,
-                                                      self.senha,
-                                                      self.mao_propria,
-                                                      pedido_total if self.valor_declarado else 0.0,
-                                                      self.aviso_recebimento,
-                                                      self.min_width,
-                                                      self.min_length,
-                                                      self.min_height))
+        return [cod_servico for cod_servico in self._get_servicos_loja(source, shop)
+                if cod_servico != self._get_cod_servico()]
 
-        return results
+    def _get_servicos_loja(self, source, shop):
+        """
+        Obtém os códigos de serviço dos componentes habilitados na loja com os mesmos
+        parâmetros deste, inclusive o próprio. O resultado é memorizado no `source`
+        para que os demais componentes do grupo não repitam a consulta.
+
+        :rtype: list[str]
+        """
+        group_key = (shop.pk, self.cep_origem, self.cod_empresa, self.senha, self.mao_propria,
+                     self.valor_declarado, self.aviso_recebimento, self.min_width, self.min_length,
+                     self.min_height) + self._get_packing_key()
+        groups = getattr(source, "_correios_servicos", None)
+
+        if groups is None:
+            groups = source._correios_servicos = {}
+        elif group_key in groups:
+            return groups[group_key]
+
+        components = CorreiosBehaviorComponent.objects.filter(
+            shippingmethod__shop=shop,
+            shippingmethod__enabled=True,
+            cep_origem=self.cep_origem,
+            cod_empresa=self.cod_empresa,
+            senha=self.senha,
+            mao_propria=self.mao_propria,
+            valor_declarado=self.valor_declarado,
+            aviso_recebimento=self.aviso_recebimento,
+            max_weight=self.max_weight,
+            max_width=self.max_width,
+            max_length=self.max_length,
+            max_height=self.max_height,
+            max_edges_sum=self.max_edges_sum,
+            min_width=self.min_width,
+            min_length=self.min_length,
+            min_height=self.min_height
+        ).distinct()
+
+        cod_servicos = []
+        for component in components:
+            cod_servico = component._get_cod_servico()
+            if cod_servico not in cod_servicos:
+                cod_servicos.append(cod_servico)
+
+        groups[group_key] = cod_servicos
+        return cod_servicos
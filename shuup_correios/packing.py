@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Memorização do empacotamento dos pedidos.
+
+O resultado do empacotamento depende apenas dos produtos do carrinho (ids,
+quantidades e dimensões), das restrições do componente e do empacotador, então
+é armazenado por requisição no próprio pedido e no cache dos Correios,
+indexado por uma impressão digital desses valores.
+"""
+
+import hashlib
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.encoding import force_bytes, force_text
+
+from shuup_correios import correios
+
+# versão do formato das entradas de empacotamento no cache
+PACKING_CACHE_VERSION = 1
+
+#: Dimensões de um pacote: peso em gramas e dimensões em milímetros
+PackageDimensions = namedtuple("PackageDimensions", "weight width length height")
+
+
+def get_basket_fingerprint(source):
+    """
+    Gera a impressão digital dos produtos de um pedido que afetam o empacotamento
+
+    :type source: shuup.core.order_creator.OrderSource
+    :rtype: tuple
+    """
+    return tuple(sorted(
+        (line.product.pk, force_text(line.quantity), force_text(line.product.width),
+         force_text(line.product.depth), force_text(line.product.height),
+         force_text(line.product.gross_weight))
+        for line in source.get_lines() if line.product
+    ))
+
+
+def get_packing_cache_key(fingerprint, packing_key):
+    """
+    Gera a chave do cache para o empacotamento de um carrinho com as restrições informadas
+    :rtype: str
+    """
+    value = repr((settings.CORREIOS_PRODUCTS_PACKAGER_CLASS, tuple(force_text(v) for v in packing_key), fingerprint))
+    return "correios:packing:v{0}:{1}".format(PACKING_CACHE_VERSION, hashlib.md5(force_bytes(value)).hexdigest())
+
+
+def get_packages(source, packing_key, pack):
+    """
+    Obtém os pacotes do pedido, empacotando apenas se o mesmo carrinho ainda
+    não foi empacotado com as mesmas restrições
+
+    :type source: shuup.core.order_creator.OrderSource
+    :param packing_key: restrições que afetam o empacotamento
+    :param pack: função que empacota o pedido, ex: `CorreiosBehaviorComponent._pack_source`
+    :return: Lista de pacotes ou None se for impossível empacotar pedido
+    :rtype: list[PackageDimensions]|None
+    """
+    fingerprint = get_basket_fingerprint(source)
+    memo_key = (packing_key, fingerprint)
+    packings = getattr(source, "_correios_packings", None)
+
+    if packings is None:
+        packings = source._correios_packings = {}
+    elif memo_key in packings:
+        return packings[memo_key]
+
+    cache_key = None
+    entry = None
+
+    if settings.CORREIOS_PACKING_CACHE_TTL:
+        cache_key = get_packing_cache_key(fingerprint, packing_key)
+        entry = correios.get_correios_cache().get(cache_key)
+
+    if isinstance(entry, tuple) and entry and entry[0] == PACKING_CACHE_VERSION:
+        packages = [PackageDimensions(*package) for package in entry[1]] if entry[1] is not None else None
+    else:
+        packages = pack(source)
+
+        if packages is not None:
+            packages = [PackageDimensions(package.weight, package.width, package.length, package.height)
+                        for package in packages]
+
+        if cache_key:
+            value = tuple(tuple(package) for package in packages) if packages is not None else None
+            correios.get_correios_cache().set(cache_key, (PACKING_CACHE_VERSION, value),
+                                              settings.CORREIOS_PACKING_CACHE_TTL)
+
+    packings[memo_key] = packages
+    return packages
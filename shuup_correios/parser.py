@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Leitura do XML de retorno do CalcPrecoPrazo.
+
+O retorno possui sempre a mesma estrutura, uma lista de `cServico` com campos
+simples, então os campos são extraídos diretamente dos bytes da resposta, sem
+decodificar o corpo inteiro nem montar a árvore do documento.
+"""
+
+import re
+from xml.etree import ElementTree
+
+SERVICO_RE = re.compile(br"<cServico\s*>(.*?)</cServico\s*>", re.S)
+CAMPO_RE = re.compile(br"<(\w+)\s*(?:/>|>(.*?)</\1\s*>)", re.S)
+ENCODING_RE = re.compile(br"""^\s*<\?xml[^>]*encoding\s*=\s*["']([\w.:-]+)["']""")
+
+
+def parse_servicos(content):
+    """
+    Extrai os campos de cada `cServico` do retorno do webservice.
+
+    Os campos vazios são retornados como None, assim como no `xmltodict`.
+
+    :type content: bytes|str
+    :return: lista com um dicionário de campos por serviço ou None se o
+        conteúdo não possuir nenhum `cServico` no formato esperado
+    :rtype: list[dict]|None
+    """
+    if isinstance(content, bytes):
+        match = ENCODING_RE.match(content)
+        encoding = match.group(1).decode("ascii") if match else "utf-8"
+    else:
+        content = content.encode("utf-8")
+        encoding = "utf-8"
+
+    blocos = SERVICO_RE.findall(content)
+    if not blocos:
+        return None
+
+    servicos = []
+    for bloco in blocos:
+        servico = {}
+        for nome, valor in CAMPO_RE.findall(bloco):
+            servico[nome.decode("ascii")] = _decode_valor(valor, encoding)
+        servicos.append(servico)
+
+    return servicos
+
+
+def _decode_valor(valor, encoding):
+    valor = valor.strip()
+    if not valor:
+        return None
+
+    valor = valor.decode(encoding)
+
+    if "&" in valor or "<" in valor:
+        # entidades e CDATA são raros no retorno, delega ao parser XML
+        valor = (ElementTree.fromstring("<v>{0}</v>".format(valor)).text or "").strip() or None
+
+    return valor
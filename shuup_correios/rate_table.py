@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import csv
+import io
+import logging
+import threading
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+from django.conf import settings
+
+from shuup_correios.correios import (CorreiosWS, _convert_currency_to_decimal,
+                                     get_package_weight, normalize_cep)
+
+logger = logging.getLogger(__name__)
+
+# código de erro dos Correios para "Erro ao calcular a tarifa"
+RATE_NOT_FOUND_ERROR = -888
+
+_rate_table = None
+_rate_table_lock = threading.Lock()
+
+
+class _RangeIndex(object):
+    """ Índice de faixas [inicial, final] não sobrepostas com busca binária """
+
+    def __init__(self, ranges):
+        """
+        :type ranges: list[tuple[int, int, object]]
+        """
+        ranges = sorted(ranges, key=lambda item: item[0])
+        self.starts = [item[0] for item in ranges]
+        self.ends = [item[1] for item in ranges]
+        self.values = [item[2] for item in ranges]
+
+    def find(self, key):
+        pos = bisect_right(self.starts, key) - 1
+        if pos >= 0 and key <= self.ends[pos]:
+            return self.values[pos]
+        return None
+
+
+class _WeightIndex(object):
+    """ Faixas de peso de um trecho, indexadas pelo limite superior (g) """
+
+    def __init__(self, brackets):
+        """
+        :type brackets: list[tuple[decimal.Decimal, tuple]]
+        """
+        brackets = sorted(brackets, key=lambda item: item[0])
+        self.weights = [item[0] for item in brackets]
+        self.rates = [item[1] for item in brackets]
+
+    def find(self, weight):
+        pos = bisect_left(self.weights, weight)
+        if pos < len(self.weights):
+            return self.rates[pos]
+        return None
+
+
+class RateTable(object):
+    """
+    Tabela local de preços e prazos dos Correios, indexada em memória.
+
+    A tabela é carregada de um arquivo CSV com cabeçalho e as colunas::
+
+        servico,cep_origem_inicial,cep_origem_final,cep_destino_inicial,cep_destino_final,peso,valor,prazo
+
+    e opcionalmente `valor_mao_propria` e `valor_aviso_recebimento`. O `peso` é o limite
+    superior da faixa, em gramas, e os valores, em reais, aceitam vírgula ou ponto decimal.
+
+    As consultas são resolvidas com buscas binárias por serviço, faixa de CEP
+    de origem, faixa de CEP de destino e faixa de peso.
+    """
+
+    def __init__(self, rows=()):
+        """
+        :param rows: linhas da tabela, no formato das colunas do arquivo CSV
+        :type rows: Iterable[dict]
+        """
+        servicos = {}
+
+        for row in rows:
+            servico = row["servico"].strip().lstrip("0")
+            origem = (_to_int_cep(row["cep_origem_inicial"]), _to_int_cep(row["cep_origem_final"]))
+            destino = (_to_int_cep(row["cep_destino_inicial"]), _to_int_cep(row["cep_destino_final"]))
+            rate = (_to_decimal(row["valor"]),
+                    int(row["prazo"]),
+                    _to_decimal(row.get("valor_mao_propria")),
+                    _to_decimal(row.get("valor_aviso_recebimento")))
+
+            destinos = servicos.setdefault(servico, {}).setdefault(origem, {})
+            destinos.setdefault(destino, []).append((Decimal(row["peso"]), rate))
+
+        self._index = {}
+        self.size = 0
+
+        for servico, origens in servicos.items():
+            origem_ranges = []
+            for origem, destinos in origens.items():
+                destino_ranges = []
+                for destino, brackets in destinos.items():
+                    destino_ranges.append(destino + (_WeightIndex(brackets),))
+                    self.size += len(brackets)
+                origem_ranges.append(origem + (_RangeIndex(destino_ranges),))
+            self._index[servico] = _RangeIndex(origem_ranges)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Carrega a tabela de um arquivo CSV
+
+        :rtype: RateTable
+        """
+        with io.open(path, encoding="utf-8", newline="") as csv_file:
+            table = cls(csv.DictReader(csv_file))
+
+        logger.info("Correios: tabela de preços %s carregada com %d faixas", path, table.size)
+        return table
+
+    def get_preco_prazo(self,
+                        cep_destino,
+                        cep_origem,
+                        cod_servico,
+                        package,
+                        cod_empresa=None,
+                        senha=None,
+                        mao_propria=False,
+                        valor_declarado=0.0,
+                        aviso_recebimento=False,
+                        min_package_width=Decimal(),
+                        min_package_length=Decimal(),
+                        min_package_height=Decimal(),
+                        servicos_adicionais=None):
+        """
+        Calcula o preço e prazo da encomenda através da tabela, com os mesmos
+        parâmetros de `CorreiosWS.get_preco_prazo`.
+
+        O serviço de valor declarado não é suportado pela tabela.
+
+        :return: Resultado do serviço ou None se a tabela não atender a consulta
+        :rtype: shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult|None
+        """
+        if valor_declarado:
+            return None
+
+        origens = self._index.get((cod_servico or "").strip().lstrip("0"))
+        if origens is None:
+            return None
+
+        destinos = origens.find(_to_int_cep(cep_origem))
+        if destinos is None:
+            return None
+
+        weights = destinos.find(_to_int_cep(cep_destino))
+        if weights is None:
+            return None
+
+        # a faixa é escolhida pelos limites da própria tabela, não por `CORREIOS_WEIGHT_BRACKETS`
+        weight = get_package_weight(package.weight,
+                                    max(package.width, min_package_width),
+                                    max(package.length, min_package_length),
+                                    max(package.height, min_package_height))
+        rate = weights.find(weight)
+        if rate is None:
+            return None
+
+        valor, prazo, valor_mao_propria, valor_aviso_recebimento = rate
+
+        result = CorreiosWS.CorreiosWSServiceResult()
+        result.codigo = cod_servico
+        result.prazo_entrega = prazo
+        result.valor_sem_adicionais = valor
+        result.valor_mao_propria = valor_mao_propria if mao_propria else Decimal()
+        result.valor_aviso_recebimento = valor_aviso_recebimento if aviso_recebimento else Decimal()
+        result.valor = valor + result.valor_mao_propria + result.valor_aviso_recebimento
+        result.entrega_domiciliar = True
+        result.entrega_sabado = False
+        return result
+
+    @classmethod
+    def get_not_found_result(cls, cod_servico):
+        """
+        Resultado com erro para as consultas não atendidas pela tabela
+
+        :rtype: shuup_correios.correios.CorreiosWS.CorreiosWSServiceResult
+        """
+        result = CorreiosWS.CorreiosWSServiceResult()
+        result.codigo = cod_servico
+        result.erro = RATE_NOT_FOUND_ERROR
+        result.msg_erro = "Trecho ou faixa de peso não encontrado na tabela de preços."
+        return result
+
+
+def get_rate_table():
+    """
+    Obtém a tabela configurada em `CORREIOS_RATE_TABLE_PATH`, carregada uma única vez por processo
+
+    :rtype: RateTable|None
+    :return: A tabela ou None se não houver tabela configurada
+    """
+    global _rate_table
+
+    if _rate_table is None and settings.CORREIOS_RATE_TABLE_PATH:
+        with _rate_table_lock:
+            if _rate_table is None:
+                _rate_table = RateTable.load(settings.CORREIOS_RATE_TABLE_PATH)
+
+    return _rate_table
+
+
+def reset_rate_table():
+    """ Descarta a tabela carregada, que será recarregada na próxima utilização """
+    global _rate_table
+
+    with _rate_table_lock:
+        _rate_table = None
+
+
+def _to_int_cep(cep):
+    return int(normalize_cep(cep) or 0)
+
+
+def _to_decimal(value):
+    """ Converte valores como "1.234,56" ou "1234.56" em Decimal """
+    value = (value or "").strip()
+    if "," in value:
+        return _convert_currency_to_decimal(value)
+    return Decimal(value or 0)
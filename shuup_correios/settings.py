@@ -20,6 +20,249 @@ CORREIOS_PRODUCTS_PACKAGER_CLASS = ("shuup_order_packager.algorithms.simple:Simp
 CORREIOS_CACHE_NAME = 'default'
 
 #
-# Quantidade de tempo, em segundos, para estourar timetout na requisição com o webservice
+# Quantidade de tempo, em segundos, para estourar timetout na requisição com o webservice.
+# Com o timeout adaptativo, é o timeout máximo.
 #
 CORREIOS_WEBSERVICE_TIMEOUT = 5.0
+
+#
+# Indica se o timeout das requisições deve ser calculado a partir das latências recentes
+# do webservice: o p99 multiplicado por `CORREIOS_WEBSERVICE_TIMEOUT_FACTOR`, limitado entre
+# `CORREIOS_WEBSERVICE_MIN_TIMEOUT` e `CORREIOS_WEBSERVICE_TIMEOUT`
+#
+CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT = True
+
+#
+# Multiplicador do p99 das latências recentes utilizado como timeout adaptativo
+#
+CORREIOS_WEBSERVICE_TIMEOUT_FACTOR = 3
+
+#
+# Timeout mínimo, em segundos, do timeout adaptativo
+#
+CORREIOS_WEBSERVICE_MIN_TIMEOUT = 1.0
+
+#
+# Quantidade de latências recentes mantidas por processo para o cálculo dos percentis
+#
+CORREIOS_WEBSERVICE_LATENCY_WINDOW = 200
+
+#
+# Quantidade mínima de latências registradas para que os percentis sejam utilizados
+#
+CORREIOS_WEBSERVICE_LATENCY_MIN_SAMPLES = 20
+
+#
+# Quantidade de novas tentativas após erros de conexão ou respostas HTTP 5xx do webservice.
+# Timeouts não são repetidos. Utilize 0 para desabilitar.
+#
+CORREIOS_WEBSERVICE_RETRIES = 2
+
+#
+# Tempo base, em segundos, do recuo exponencial entre as tentativas. A espera é aleatória,
+# entre zero e o tempo base multiplicado por 2 a cada nova tentativa.
+#
+CORREIOS_WEBSERVICE_RETRY_BACKOFF = 0.1
+
+#
+# Indica se uma requisição duplicada deve ser enviada quando a primeira não responder
+# dentro do p95 das latências recentes, utilizando a resposta que chegar primeiro.
+# As requisições são feitas em um executor com `CORREIOS_WEBSERVICE_POOL_MAXSIZE` threads;
+# quando todas estão ocupadas, a requisição é feita sem duplicação.
+#
+CORREIOS_WEBSERVICE_HEDGE = False
+
+#
+# Prazo total, em segundos, para todas as requisições ao webservice de um pedido
+# (todos os pacotes, serviços e tentativas). As requisições têm o timeout reduzido
+# ao tempo restante e deixam de ser feitas quando o prazo termina, então o serviço
+# é informado como temporariamente indisponível. Utilize None para não limitar.
+#
+CORREIOS_QUOTE_DEADLINE = None
+
+#
+# Provedores de contingência consultados, em ordem, quando o webservice falhar (timeout,
+# erro de conexão, erro do servidor, circuito aberto ou prazo esgotado). O primeiro que
+# atender o pacote fornece um preço estimado, sem acessar o webservice, e o pedido é
+# marcado para revisão. Encomendas com valor declarado não são estimadas.
+# Vazio desabilita os provedores. Provedores disponíveis:
+#   shuup_correios.fallback.LastKnownQuoteProvider: última cotação para CEPs próximos
+#   shuup_correios.fallback.PriceCurveProvider: curva de preço por peso aprendida na região
+#   shuup_correios.fallback.FlatRateProvider: preço fixo de `CORREIOS_FALLBACK_FLAT_RATES`
+#
+CORREIOS_FALLBACK_PROVIDERS = ()
+
+#
+# Tempo, em segundos, que as cotações obtidas do webservice são mantidas para os provedores
+# de contingência. As cotações só são registradas se houver provedores configurados.
+#
+CORREIOS_FALLBACK_TTL = 60 * 60 * 24 * 30
+
+#
+# Quantidade de dígitos iniciais dos CEPs que definem as localidades próximas
+# (`LastKnownQuoteProvider`) e as regiões das curvas de preço (`PriceCurveProvider`)
+#
+CORREIOS_FALLBACK_NEARBY_CEP_DIGITS = 5
+CORREIOS_FALLBACK_CURVE_CEP_DIGITS = 3
+
+#
+# Preço (R$) e prazo (dias) fixos por pacote utilizados pelo `FlatRateProvider`,
+# indexados pelo código do serviço, ex: {"41106": ("45.00", 10)}
+#
+CORREIOS_FALLBACK_FLAT_RATES = {}
+
+#
+# Quantidade máxima de requisições simultâneas ao webservice para cotar os pacotes de um pedido.
+# Utilize 1 para cotar os pacotes sequencialmente.
+#
+CORREIOS_WEBSERVICE_MAX_WORKERS = 4
+
+#
+# Classe do transporte HTTP utilizado para se comunicar com o webservice.
+# Deve implementar a interface `shuup_correios.transport.CorreiosTransport`
+#
+CORREIOS_WEBSERVICE_TRANSPORT_CLASS = "shuup_correios.transport:RequestsSessionTransport"
+
+#
+# Quantidade de hosts com pool de conexões mantido pelo transporte padrão
+#
+CORREIOS_WEBSERVICE_POOL_CONNECTIONS = 2
+
+#
+# Quantidade máxima de conexões keep-alive mantidas por host pelo transporte padrão
+#
+CORREIOS_WEBSERVICE_POOL_MAXSIZE = 10
+
+#
+# Indica se as requisições devem aguardar uma conexão livre quando o pool
+# estiver cheio, limitando as conexões simultâneas por host
+#
+CORREIOS_WEBSERVICE_POOL_BLOCK = False
+
+#
+# Classe do transporte HTTP assíncrono utilizado por `shuup_correios.aio`.
+# Utilize "shuup_correios.aio:AiohttpTransport" para um transporte nativo do asyncio (requer aiohttp)
+#
+CORREIOS_WEBSERVICE_ASYNC_TRANSPORT_CLASS = "shuup_correios.aio:ExecutorAsyncTransport"
+
+#
+# Agrupa os pacotes pela faixa de peso tarifado (peso real ou cúbico) antes de consultar
+# o webservice e o cache, assim pacotes com pesos e dimensões ligeiramente diferentes para
+# o mesmo destino compartilham a mesma cotação. O pacote é enviado com o peso máximo
+# da faixa e com as dimensões mínimas.
+#
+CORREIOS_BILLABLE_WEIGHT_BUCKETING = False
+
+#
+# Faixas de peso (g) utilizadas pelos Correios para tarifar as encomendas.
+# Acima da última faixa, o peso é arredondado para o próximo quilo.
+#
+CORREIOS_WEIGHT_BRACKETS = (300,) + tuple(range(1000, 30001, 1000))
+
+#
+# Fator de cubagem dos Correios: peso cúbico (kg) = C x L x A (cm) / fator
+#
+CORREIOS_CUBIC_WEIGHT_FACTOR = 6000
+
+#
+# O peso cúbico (g) só é considerado quando ultrapassa este valor
+#
+CORREIOS_CUBIC_WEIGHT_THRESHOLD = 5000
+
+#
+# Caminho do arquivo CSV da tabela local de preços e prazos, utilizada pelos
+# componentes com o modo de cálculo "Tabela" ou "Tabela e webservice".
+# Veja `shuup_correios.rate_table.RateTable` para o formato do arquivo.
+#
+CORREIOS_RATE_TABLE_PATH = None
+
+#
+# Caminho do índice das faixas de CEP válidas, compilado com o comando
+# `correios_build_cep_index`. Quando configurado, os CEPs de origem e destino
+# que não pertencem a nenhuma faixa são rejeitados sem consultar os Correios.
+# Veja `shuup_correios.cep_index.CepIndex` para o formato do arquivo.
+#
+CORREIOS_CEP_INDEX_PATH = None
+
+#
+# Tempo, em segundos, após o qual uma cotação em cache é considerada obsoleta.
+# A cotação obsoleta continua sendo utilizada enquanto é atualizada em segundo plano.
+#
+CORREIOS_CACHE_SOFT_TTL = 60 * 60 * 6
+
+#
+# Tempo, em segundos, que uma cotação permanece no cache. Após este tempo,
+# a próxima consulta aguarda uma nova requisição ao webservice.
+#
+CORREIOS_CACHE_HARD_TTL = 60 * 60 * 24
+
+#
+# Tempo máximo, em segundos, da trava que garante uma única atualização em segundo plano por cotação
+#
+CORREIOS_CACHE_REFRESH_TIMEOUT = 60
+
+#
+# Tempo, em segundos, que as cotações com erro permanecem no cache, por classe de erro
+# (veja `shuup_correios.correios.CorreiosErro`). Utilize 0 para não armazenar a classe.
+#
+CORREIOS_ERROR_CACHE_TTL = {
+    # CEP inválido, trecho não atendido pelo serviço, limites excedidos...
+    'indisponivel': 60 * 60 * 24,
+    # instabilidade do sistema dos Correios
+    'temporario': 60,
+    'desconhecido': 60 * 5,
+}
+
+#
+# Quantidade de falhas consecutivas (timeout ou erro HTTP 5xx) do webservice que abre o
+# circuito: as requisições seguintes falham imediatamente. Utilize 0 para desabilitar.
+#
+CORREIOS_CIRCUIT_BREAKER_THRESHOLD = 5
+
+#
+# Tempo, em segundos, que o circuito permanece aberto antes de liberar uma requisição de teste
+#
+CORREIOS_CIRCUIT_BREAKER_COOLDOWN = 30
+
+#
+# Agrupa as requisições simultâneas para as mesmas cotações no processo: apenas uma
+# requisição é feita ao webservice e as demais threads aguardam o seu resultado.
+#
+CORREIOS_SINGLE_FLIGHT = True
+
+#
+# Utiliza também uma trava no cache para agrupar as requisições entre processos
+# diferentes. Os processos que não obtêm a trava aguardam as cotações no cache.
+# A trava expira após o tempo máximo da requisição, com todas as tentativas
+# (`CORREIOS_WEBSERVICE_RETRIES`) e esperas entre elas, limitado ao prazo do pedido.
+#
+CORREIOS_SINGLE_FLIGHT_CACHE_LOCK = False
+
+#
+# Intervalo, em segundos, entre as verificações do cache enquanto outro processo obtém as cotações
+#
+CORREIOS_SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+
+#
+# Mantém as cotações mais utilizadas também na memória de cada processo, evitando
+# o acesso ao cache compartilhado (CORREIOS_CACHE_NAME) a cada consulta.
+#
+CORREIOS_LOCAL_CACHE_ENABLED = False
+
+#
+# Quantidade máxima de cotações mantidas na memória de cada processo
+#
+CORREIOS_LOCAL_CACHE_CAPACITY = 10000
+
+#
+# Tempo, em segundos, que uma cotação permanece na memória do processo. Cotações
+# atualizadas por outros processos só são vistas após este tempo.
+#
+CORREIOS_LOCAL_CACHE_TTL = 60
+
+#
+# Tempo, em segundos, que o empacotamento de um carrinho fica armazenado no cache
+# dos Correios, indexado pelos produtos, quantidades, dimensões e restrições do serviço.
+# Utilize 0 para memorizar o empacotamento apenas durante a requisição.
+#
+CORREIOS_PACKING_CACHE_TTL = 3600
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Sinais de instrumentação das cotações.
+
+Os sinais só são enviados, e as durações só são medidas, quando existe algum
+receptor conectado. As durações são em segundos.
+"""
+
+from django.dispatch import Signal
+
+#: Enviado ao obter os resultados de um pacote, do cache ou do webservice. O `sender` é sempre
+#: `CorreiosWS`, inclusive nas consultas do cliente assíncrono (`shuup_correios.aio`).
+#: `cache_only` indica uma consulta apenas ao cache (`get_cached_preco_prazo` e
+#: `get_cached_preco_prazo_many`).
+#: `exception` é a exceção lançada ou None.
+preco_prazo_requested = Signal(providing_args=[
+    "request", "cache_hits", "cache_misses", "cache_only", "duration", "exception"
+])
+
+#: Enviado a cada requisição ao webservice, também com `sender` `CorreiosWS`.
+#: `status_code` é None se a requisição não foi concluída (timeout ou circuito aberto).
+#: `erros` contém o código de erro retornado para cada serviço.
+ws_request_finished = Signal(providing_args=[
+    "request", "status_code", "http_duration", "parse_duration", "erros", "exception"
+])
+
+#: Enviado por `CorreiosBehaviorComponent` ao calcular a cotação de um pedido
+#: (empacotamento e resultados de todos os pacotes).
+#: `timeout` indica que o webservice falhou sem contingência e `fallback` que
+#: algum resultado foi estimado pelos provedores de contingência.
+quote_calculated = Signal(providing_args=[
+    "component", "source", "package_count", "packing_duration", "results_duration", "timeout", "fallback",
+    "erros"
+])
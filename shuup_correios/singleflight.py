@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """
+    Agrupa chamadas simultâneas com a mesma chave: apenas a primeira thread
+    executa a função, as demais aguardam e recebem o mesmo resultado (ou exceção).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout=None):
+        """
+        Executa `func` ou aguarda a execução em andamento para a mesma chave
+
+        :param timeout: tempo máximo, em segundos, para aguardar a execução em andamento
+        :raises concurrent.futures.TimeoutError: se a execução em andamento não terminar a tempo
+        :return: tupla com o resultado de `func` e se ele veio de outra thread
+        :rtype: tuple[object, bool]
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise FutureTimeoutError()
+            if call.exception is not None:
+                raise call.exception
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as exc:
+            call.exception = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result, False
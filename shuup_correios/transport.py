@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from shuup.utils.importing import cached_load
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+class CorreiosTransport(object):
+    """
+    Interface do transporte HTTP utilizado para se comunicar com o WebService dos Correios.
+
+    A mesma instância é compartilhada por todas as threads do processo,
+    portanto as implementações devem ser thread-safe.
+    """
+
+    def post(self, url, params=None, timeout=None):
+        """
+        Executa uma requisição POST
+
+        :rtype: requests.Response
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """ Libera as conexões abertas pelo transporte """
+        pass
+
+
+class RequestsSessionTransport(CorreiosTransport):
+    """
+    Transporte que mantém as conexões abertas (keep-alive) em um pool
+    através de uma `requests.Session`, evitando uma nova conexão TCP e
+    resolução de DNS a cada requisição.
+    """
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, pool_block=None):
+        """
+        :param pool_connections: quantidade de hosts com pool de conexões mantido
+        :param pool_maxsize: quantidade máxima de conexões abertas por host
+        :param pool_block: bloqueia a requisição até que uma conexão do pool fique livre,
+            ao invés de abrir uma conexão extra que não será reaproveitada
+        """
+        if pool_connections is None:
+            pool_connections = settings.CORREIOS_WEBSERVICE_POOL_CONNECTIONS
+        if pool_maxsize is None:
+            pool_maxsize = settings.CORREIOS_WEBSERVICE_POOL_MAXSIZE
+        if pool_block is None:
+            pool_block = settings.CORREIOS_WEBSERVICE_POOL_BLOCK
+
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, url, params=None, timeout=None):
+        return self.session.post(url, params=params, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+def get_transport():
+    """
+    Obtém a instância do transporte configurado em `CORREIOS_WEBSERVICE_TRANSPORT_CLASS`,
+    criada uma única vez por processo
+
+    :rtype: CorreiosTransport
+    """
+    global _transport
+
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = cached_load("CORREIOS_WEBSERVICE_TRANSPORT_CLASS")()
+
+    return _transport
+
+
+def reset_transport():
+    """ Fecha e descarta o transporte atual, que será recriado na próxima utilização """
+    global _transport
+
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+        _transport = None
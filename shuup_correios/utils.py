@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def run_concurrently(func, items, max_workers):
+    """
+    Executa `func` para cada item utilizando no máximo `max_workers` threads
+    e retorna os resultados na mesma ordem dos itens.
+
+    Na primeira exceção, as tarefas que ainda não iniciaram são canceladas
+    e a exceção é relançada sem aguardar as que estão em andamento.
+
+    :type func: callable
+    :type items: Iterable
+    :type max_workers: int
+    :rtype: list
+    """
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    futures = [executor.submit(func, item) for item in items]
+
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+
+    return [future.result() for future in futures]
@@ -10,6 +10,17 @@
 from shuup_correios.correios import CorreiosWS
 from decimal import Decimal
 
+from shuup_order_packager.package import SimplePackage
+
+
+def create_package(weight=4000, width=400, length=400, height=400):
+    package = SimplePackage()
+    package._weight = weight
+    package._width = width
+    package._length = length
+    package._height = height
+    return package
+
 
 def create_mock_ws_result(with_error=False, mock_data={}):
     ws_result = CorreiosWS.CorreiosWSServiceResult()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Benchmarks do Shuup Correios.
+
+Cada módulo `bench_*` pode ser executado diretamente, por exemplo::
+
+    python -m shuup_correios_tests.benchmarks.bench_transport
+
+Os módulos não são coletados pelo py.test.
+"""
+
+import json
+import os
+import timeit
+
+
+def setup_django():
+    """ Configura o Django com as configurações de testes, se ainda não configurado """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "shuup_correios_tests.settings")
+
+    import django
+    django.setup()
+
+
+def measure(func, repeat, setup=None):
+    """
+    Executa `func` `repeat` vezes e retorna a duração de cada execução, em segundos
+
+    :param setup: função executada antes de cada execução, fora da medição.
+        O seu retorno é passado como argumento para `func`.
+    :rtype: list[float]
+    """
+    durations = []
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = timeit.default_timer()
+        func(*args)
+        durations.append(timeit.default_timer() - start)
+    return durations
+
+
+def percentile(values, pct):
+    """ Obtém o percentil `pct` (0-100) de uma lista de valores """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round((pct / 100.0) * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(durations):
+    """ Resume uma lista de durações em latência (ms) e vazão """
+    total = sum(durations)
+    return {
+        "n": len(durations),
+        "mean_ms": 1000 * total / max(len(durations), 1),
+        "p50_ms": 1000 * percentile(durations, 50),
+        "p95_ms": 1000 * percentile(durations, 95),
+        "p99_ms": 1000 * percentile(durations, 99),
+        "ops_s": len(durations) / total if total else 0.0
+    }
+
+
+def save_results(path, results):
+    """ Grava os resultados (nome do cenário -> `summarize`) em JSON """
+    with open(path, "w") as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+
+
+def format_comparison(baseline_path, results):
+    """
+    Compara os resultados com os gravados por `save_results` em outro commit
+    :rtype: list[str]
+    """
+    with open(baseline_path) as fp:
+        baseline = json.load(fp)
+
+    lines = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before, after = baseline[name], results[name]
+        lines.append("{0:<60} p50 {1:8.3f}ms -> {2:8.3f}ms ({3:+6.1f}%)  p95 {4:8.3f}ms -> {5:8.3f}ms ({6:+6.1f}%)".format(
+            name,
+            before["p50_ms"], after["p50_ms"], _variation(before["p50_ms"], after["p50_ms"]),
+            before["p95_ms"], after["p95_ms"], _variation(before["p95_ms"], after["p95_ms"])
+        ))
+    return lines
+
+
+def _variation(before, after):
+    return 100.0 * (after - before) / before if before else 0.0
+
+
+def format_summary(name, durations):
+    """ Formata a latência (ms) e vazão de uma lista de durações """
+    summary = summarize(durations)
+    return "{0:<40} n={1:<6} mean={2:8.3f}ms p50={3:8.3f}ms p95={4:8.3f}ms p99={5:8.3f}ms {6:10.1f} ops/s".format(
+        name, summary["n"], summary["mean_ms"], summary["p50_ms"], summary["p95_ms"], summary["p99_ms"],
+        summary["ops_s"]
+    )
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compara o tamanho e o tempo de gravação/leitura de uma entrada do cache de
+cotações serializada como objeto (pickle da instância, com o nome da classe e
+dos atributos) e como tupla (`QuoteCacheEntry.dumps`).
+
+O pickle é o mesmo utilizado pelos backends de cache do Django.
+
+    python -m shuup_correios_tests.benchmarks.bench_cache_entry [--calls 20000]
+"""
+
+import argparse
+import pickle
+
+from shuup_correios_tests.benchmarks import format_summary, measure, setup_django
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+def run(calls):
+    from shuup_correios.correios import CorreiosServico, CorreiosWS, QuoteCacheEntry
+
+    result = CorreiosWS._parse_servicos(build_response([CorreiosServico.SEDEX]).encode("iso-8859-1"))[0]
+    entry = QuoteCacheEntry(result, 3600)
+
+    def store_object():
+        return pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+
+    def store_tuple():
+        return pickle.dumps(entry.dumps(), pickle.HIGHEST_PROTOCOL)
+
+    pickled_object = store_object()
+    pickled_tuple = store_tuple()
+
+    def load_object():
+        return pickle.loads(pickled_object)
+
+    def load_tuple():
+        return QuoteCacheEntry.loads(pickle.loads(pickled_tuple))
+
+    print("objeto: {0} bytes por entrada".format(len(pickled_object)))
+    print("tupla:  {0} bytes por entrada".format(len(pickled_tuple)))
+
+    for name, func in (("gravação objeto", store_object),
+                       ("gravação tupla", store_tuple),
+                       ("leitura objeto", load_object),
+                       ("leitura tupla", load_tuple)):
+        print(format_summary(name, measure(func, calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    setup_django()
+    run(args.calls)
+
+
+if __name__ == "__main__":
+    main()
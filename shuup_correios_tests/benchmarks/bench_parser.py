@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compara a leitura do retorno do webservice com o `xmltodict` (decodificando
+o corpo da resposta antes) com a leitura direta dos bytes, de 1 a 6 serviços.
+
+    python -m shuup_correios_tests.benchmarks.bench_parser [--calls 5000]
+"""
+
+import argparse
+
+from shuup_correios_tests.benchmarks import format_summary, measure, setup_django
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+def run(calls):
+    import xmltodict
+
+    from shuup_correios.correios import CorreiosServico, CorreiosWS
+
+    cod_servicos = [CorreiosServico.PAC, CorreiosServico.SEDEX, CorreiosServico.SEDEX_10,
+                    CorreiosServico.SEDEX_A_COBRAR, CorreiosServico.SEDEX_HOJE, CorreiosServico.ESEDEX]
+
+    for quantidade in range(1, len(cod_servicos) + 1):
+        content = build_response(cod_servicos[:quantidade]).encode("iso-8859-1")
+
+        def parse_xmltodict():
+            servicos = xmltodict.parse(content.decode("iso-8859-1"))["Servicos"]["cServico"]
+            if not isinstance(servicos, list):
+                servicos = [servicos]
+            return [CorreiosWS.CorreiosWSServiceResult.from_service(servico) for servico in servicos]
+
+        def parse_bytes():
+            return CorreiosWS._parse_servicos(content)
+
+        for name, func in (("xmltodict ({0} serviços, {1} bytes)", parse_xmltodict),
+                           ("parse_servicos ({0} serviços, {1} bytes)", parse_bytes)):
+            func()
+            print(format_summary(name.format(quantidade, len(content)), measure(func, calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+
+    setup_django()
+    run(args.calls)
+
+
+if __name__ == "__main__":
+    main()
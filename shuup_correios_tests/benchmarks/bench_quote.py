@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Mede `get_unavailability_reasons`, `get_costs` e `get_delivery_time` do
+`CorreiosBehaviorComponent` contra um webservice local, variando a quantidade
+de itens no carrinho, de pacotes, de serviços habilitados e a taxa de acertos
+do cache.
+
+Cada cenário mede os métodos isoladamente, sempre com um carrinho novo, e o
+checkout completo (os três métodos para todos os serviços no mesmo carrinho).
+
+    python -m shuup_correios_tests.benchmarks.bench_quote [--iterations 100]
+        [--basket-sizes 1,5,20] [--packages 1,3] [--services 1,3,6]
+        [--hit-ratios 0,0.5,0.9,1] [--latency 0.0]
+        [--save resultados.json] [--compare resultados-anteriores.json]
+
+Grave os resultados com `--save` em um commit e utilize `--compare` em outro
+para ver a variação de cada cenário.
+"""
+
+import argparse
+import random
+from decimal import Decimal
+
+from mock import patch
+
+from shuup_correios_tests.benchmarks import (format_comparison, format_summary, measure,
+                                             save_results, setup_django, summarize)
+from shuup_correios_tests.benchmarks.server import CorreiosStandInServer
+
+SERVICES = ["PAC", "SEDEX", "SEDEX_10", "ESEDEX", "SEDEX_HOJE", "SEDEX_A_COBRAR"]
+
+# peso de cada produto (g)
+PRODUCT_WEIGHT = 500
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def _float_list(value):
+    return [float(item) for item in value.split(",")]
+
+
+class QuoteScenario(object):
+    """ Loja, serviços e carrinhos de um cenário do benchmark """
+
+    def __init__(self, index, basket_size, packages, services, hit_ratio, seed=0):
+        from shuup.testing.factories import get_default_shop, get_default_tax_class
+        from shuup_correios.models import CorreiosCarrier
+
+        self.index = index
+        self.basket_size = basket_size
+        self.hit_ratio = hit_ratio
+        self.random = random.Random(seed)
+        self.warm_ceps = ["0{0:07d}".format(index) for index in range(50)]
+        self.cold_ceps = ("9{0:07d}".format(index) for index in range(10 ** 7))
+        self.shop = get_default_shop()
+
+        carrier = CorreiosCarrier.objects.create(name="Correios")
+        self.components = []
+
+        # limita o peso de cada pacote para que o carrinho seja dividido em `packages` pacotes
+        max_weight = Decimal(PRODUCT_WEIGHT * basket_size) / packages / 1000
+
+        for identifier in SERVICES[:services]:
+            service = carrier.create_service(identifier,
+                                             shop=self.shop,
+                                             enabled=True,
+                                             tax_class=get_default_tax_class(),
+                                             name="Correios " + identifier)
+            component = service.behavior_components.first()
+            component.cep_origem = "89070400"
+            component.max_weight = max_weight
+            component.save()
+            self.components.append((service, component))
+
+        self.products = self._create_products()
+
+    def _create_products(self):
+        from shuup.testing.factories import create_product, get_default_supplier
+
+        return [
+            create_product("correios-bench-{0}-{1}".format(self.index, index),
+                           shop=self.shop,
+                           supplier=get_default_supplier(),
+                           width=100,
+                           depth=100,
+                           height=100,
+                           gross_weight=PRODUCT_WEIGHT)
+            for index in range(self.basket_size)
+        ]
+
+    def create_source(self, cep=None):
+        """
+        Cria um carrinho novo, com destino a um CEP já cotado ou não conforme a taxa de acertos
+        :rtype: shuup.core.order_creator.OrderSource
+        """
+        from shuup.core.models import OrderLineType
+        from shuup.testing.factories import get_address, get_default_supplier
+        from shuup_tests.utils.basketish_order_source import BasketishOrderSource
+
+        if cep is None:
+            if self.random.random() < self.hit_ratio:
+                cep = self.random.choice(self.warm_ceps)
+            else:
+                cep = next(self.cold_ceps)
+
+        source = BasketishOrderSource(self.shop)
+        for product in self.products:
+            source.add_line(type=OrderLineType.PRODUCT,
+                            product=product,
+                            supplier=get_default_supplier(),
+                            quantity=1,
+                            base_unit_price=source.create_price(10))
+
+        address = get_address(name="Destino", country="BR")
+        address.postal_code = cep
+        source.shipping_address = address
+        return source
+
+    def warm(self):
+        """ Cota os CEPs utilizados como acertos do cache """
+        for cep in self.warm_ceps:
+            self.checkout(self.create_source(cep))
+
+    def count_packages(self):
+        return len(self.components[0][1]._pack_source(self.create_source(self.warm_ceps[0])) or [])
+
+    def close(self):
+        """ Desabilita os serviços do cenário para que não sejam cotados junto com os próximos """
+        for service, component in self.components:
+            service.enabled = False
+            service.save()
+
+    def checkout(self, source):
+        """ Chamadas feitas na página de métodos de envio para todos os serviços """
+        for service, component in self.components:
+            component.get_unavailability_reasons(service, source)
+            list(component.get_costs(service, source))
+            component.get_delivery_time(service, source)
+
+    def get_methods(self):
+        service, component = self.components[0]
+        return (
+            ("get_unavailability_reasons", lambda source: component.get_unavailability_reasons(service, source)),
+            ("get_costs", lambda source: list(component.get_costs(service, source))),
+            ("get_delivery_time", lambda source: component.get_delivery_time(service, source)),
+            ("checkout", self.checkout),
+        )
+
+
+def run(args):
+    from django.core.cache import caches
+
+    import shuup_correios.correios
+
+    results = {}
+    cache = caches["default"]
+    scenarios = 0
+
+    with CorreiosStandInServer(latency=args.latency) as server, \
+            patch.object(shuup_correios.correios, "CORREIOS_WS_PRECO_PRAZO_URL", server.url), \
+            patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+
+        for basket_size in args.basket_sizes:
+            for packages in args.packages:
+                for services in args.services:
+                    for hit_ratio in args.hit_ratios:
+                        cache.clear()
+                        scenarios += 1
+                        scenario = QuoteScenario(scenarios, basket_size, packages, services, hit_ratio)
+                        scenario.warm()
+
+                        name = "itens={0} pacotes={1} servicos={2} acertos={3:.0%}".format(
+                            basket_size, scenario.count_packages(), services, hit_ratio)
+                        print(name)
+
+                        for method, func in scenario.get_methods():
+                            server.reset_counters()
+                            durations = measure(func, args.iterations, setup=scenario.create_source)
+                            results["{0} {1}".format(name, method)] = dict(summarize(durations),
+                                                                           ws_requests=server.requests)
+                            print("  " + format_summary(method, durations),
+                                  "requisições={0}".format(server.requests))
+
+                        scenario.close()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--basket-sizes", type=_int_list, default=[1, 5, 20])
+    parser.add_argument("--packages", type=_int_list, default=[1, 3])
+    parser.add_argument("--services", type=_int_list, default=[1, 3, 6])
+    parser.add_argument("--hit-ratios", type=_float_list, default=[0, 0.5, 0.9, 1])
+    parser.add_argument("--latency", type=float, default=0.0, help="latência simulada do webservice (s)")
+    parser.add_argument("--save", help="grava os resultados em JSON")
+    parser.add_argument("--compare", help="compara com resultados gravados com --save")
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    database_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+
+    try:
+        results = run(args)
+    finally:
+        connection.creation.destroy_test_db(database_name, verbosity=0)
+
+    if args.save:
+        save_results(args.save, results)
+
+    if args.compare:
+        print()
+        for line in format_comparison(args.compare, results):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
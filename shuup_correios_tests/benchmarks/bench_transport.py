@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Compara a latência por requisição do `requests.post` (uma conexão por chamada)
+com o transporte com pool de conexões keep-alive.
+
+    python -m shuup_correios_tests.benchmarks.bench_transport [--calls 500]
+"""
+
+import argparse
+
+import requests
+
+from shuup_correios_tests.benchmarks import format_summary, measure, setup_django
+from shuup_correios_tests.benchmarks.server import CorreiosStandInServer
+
+
+def run(calls, latency):
+    from shuup_correios.transport import RequestsSessionTransport
+
+    params = {"nCdServico": "40010", "strRetorno": "xml"}
+
+    with CorreiosStandInServer(latency=latency) as server:
+        def plain_post():
+            requests.post(server.url, params=params, timeout=5).content
+
+        transport = RequestsSessionTransport(pool_connections=1, pool_maxsize=4, pool_block=False)
+
+        def pooled_post():
+            transport.post(server.url, params=params, timeout=5).content
+
+        # aquecimento
+        plain_post()
+        pooled_post()
+
+        for name, func in (("requests.post", plain_post),
+                           ("RequestsSessionTransport.post", pooled_post)):
+            server.reset_counters()
+            durations = measure(func, calls)
+            print(format_summary(name, durations), "connections={0}".format(server.connections))
+
+        transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="latência simulada do servidor (s)")
+    args = parser.parse_args()
+
+    setup_django()
+    run(args.calls, args.latency)
+
+
+if __name__ == "__main__":
+    main()
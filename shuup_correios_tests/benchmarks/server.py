@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+SERVICO_XML = """<cServico>
+    <Codigo>{codigo}</Codigo>
+    <Valor>{valor}</Valor>
+    <PrazoEntrega>{prazo}</PrazoEntrega>
+    <ValorMaoPropria>0,00</ValorMaoPropria>
+    <ValorAvisoRecebimento>0,00</ValorAvisoRecebimento>
+    <ValorValorDeclarado>0,00</ValorValorDeclarado>
+    <EntregaDomiciliar>S</EntregaDomiciliar>
+    <EntregaSabado>N</EntregaSabado>
+    <Erro>{erro}</Erro>
+    <MsgErro>{msg_erro}</MsgErro>
+    <ValorSemAdicionais>{valor}</ValorSemAdicionais>
+    <obsFim></obsFim>
+</cServico>"""
+
+
+def build_response(cod_servicos, erro=0):
+    """
+    Monta o XML de retorno do CalcPrecoPrazo com um `cServico` para cada código
+
+    :rtype: str
+    """
+    servicos = []
+    for index, codigo in enumerate(cod_servicos):
+        servicos.append(SERVICO_XML.format(
+            codigo=codigo,
+            valor="{0},{1:02d}".format(20 + index * 7, index * 13 % 100),
+            prazo=2 + index,
+            erro=erro,
+            msg_erro="Erro simulado" if erro else ""
+        ))
+    return ('<?xml version="1.0" encoding="ISO-8859-1" ?>\n'
+            '<Servicos>{0}</Servicos>'.format("".join(servicos)))
+
+
+class _CorreiosStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # evita o atraso do algoritmo de Nagle nas respostas em conexões keep-alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count_connection()
+
+    def do_POST(self):
+        self.server.count_request()
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        query = parse_qs(urlparse(self.path).query)
+        cod_servicos = query.get("nCdServico", [""])[0].split(",")
+        body = build_response(cod_servicos, self.server.erro).encode("latin-1")
+
+        self.send_response(self.server.status_code)
+        self.send_header("Content-Type", "text/xml; charset=ISO-8859-1")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CorreiosStandInServer(ThreadingMixIn, HTTPServer):
+    """
+    Servidor HTTP local que simula o CalcPrecoPrazo dos Correios, com latência configurável.
+
+    Utilização::
+
+        with CorreiosStandInServer(latency=0.05) as server:
+            requests.post(server.url, params={"nCdServico": "40010"})
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, status_code=200, erro=0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _CorreiosStandInHandler)
+        self.latency = latency
+        self.status_code = status_code
+        self.erro = erro
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/calculador/CalcPrecoPrazo.aspx".format(*self.server_address)
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.connections = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import sys
+
+collect_ignore = []
+
+if sys.version_info < (3, 5):
+    # o cliente assíncrono utiliza async/await (Python 3.5+)
+    collect_ignore.append("test_aio.py")
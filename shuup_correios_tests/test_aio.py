@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import asyncio
+import threading
+from decimal import Decimal
+
+import pytest
+import requests
+from mock import Mock, patch
+
+from shuup_correios.aio import (AsyncCorreiosWS, AsyncResponse,
+                                ExecutorAsyncTransport, get_async_transport,
+                                get_correios_results)
+from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+                                     CorreiosWSServerErrorException,
+                                     CorreiosWSServerTimeoutException,
+                                     circuit_breaker)
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def _mock_post(status_code=200, calls=None):
+    async def post(url, params=None, timeout=None):
+        if calls is not None:
+            calls.append(params)
+        await asyncio.sleep(0)
+        return AsyncResponse(status_code, build_response(params["nCdServico"].split(",")))
+    return post
+
+
+def test_async_get_preco_prazo():
+    calls = []
+
+    with patch.object(get_async_transport(), "post", new=_mock_post(calls=calls)):
+        result = _run(AsyncCorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.PAC,
+                                                      create_package(),
+                                                      servicos_adicionais=[CorreiosServico.SEDEX]))
+        assert result.codigo == CorreiosServico.PAC
+        assert result.erro == 0
+        assert calls[0]["nCdServico"] == "41106,40010"
+
+        results = _run(AsyncCorreiosWS.get_preco_prazo_servicos('89070210', '89070400',
+                                                                [CorreiosServico.SEDEX, CorreiosServico.SEDEX_10],
+                                                                create_package()))
+        assert list(results.keys()) == [CorreiosServico.SEDEX, CorreiosServico.SEDEX_10]
+
+    with patch.object(get_async_transport(), "post", new=_mock_post(status_code=500)):
+        with pytest.raises(CorreiosWSServerErrorException):
+            _run(AsyncCorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.PAC, create_package()))
+
+
+def test_executor_transport():
+    transport = ExecutorAsyncTransport()
+    response_mock = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+
+    with patch.object(get_transport(), "post", return_value=response_mock):
+        response = _run(transport.post("http://ws.correios.com.br/", params={}, timeout=1))
+        assert response.status_code == 200
+        assert b"41106" in response.content
+
+    with patch.object(get_transport(), "post", side_effect=requests.exceptions.Timeout()):
+        with patch("shuup_correios.aio.get_async_transport", return_value=transport):
+            with pytest.raises(CorreiosWSServerTimeoutException):
+                _run(AsyncCorreiosWS.get_preco_prazo('89070210', '89070400',
+                                                     CorreiosServico.PAC, create_package()))
+
+
+def test_async_get_correios_results():
+    def get_component(cod_servico, cep_origem='89070400', packages=2):
+        component = Mock()
+        component._get_preco_prazo_params.return_value = {
+            "cep_destino": '89070210',
+            "cep_origem": cep_origem,
+            "cod_servico": cod_servico,
+            "cod_empresa": None,
+            "senha": None,
+            "mao_propria": False,
+            "valor_declarado": 0.0,
+            "aviso_recebimento": False,
+            "min_package_width": Decimal(),
+            "min_package_length": Decimal(),
+            "min_package_height": Decimal()
+        }
+        component._get_packing_key.return_value = (Decimal(30), Decimal(800))
+        component._get_packages.return_value = [create_package(1000 * (i + 1)) for i in range(packages)]
+        component._get_deadline.return_value = None
+        component._get_rate_table_results.side_effect = lambda params, packages: [None] * len(packages)
+        component.pricing_mode = "ws"
+        return component
+
+    pac = get_component(CorreiosServico.PAC)
+    sedex = get_component(CorreiosServico.SEDEX)
+    other = get_component(CorreiosServico.PAC, cep_origem='88220000', packages=1)
+    no_address = get_component(CorreiosServico.PAC)
+    no_address._get_preco_prazo_params.return_value = None
+
+    calls = []
+    with patch.object(get_async_transport(), "post", new=_mock_post(calls=calls)):
+        results = _run(get_correios_results(None, [pac, sedex, other, no_address]))
+
+    # PAC e SEDEX compartilham os pacotes e as requisições: 2 + 1
+    assert len(calls) == 3
+    assert pac._get_packages.call_count == 1
+    assert sedex._get_packages.call_count == 0
+
+    # o empacotamento e a tabela de preços não bloqueiam o event loop
+    threads = []
+    pac = get_component(CorreiosServico.PAC)
+    pac._get_packages.side_effect = lambda source: threads.append(threading.current_thread()) or [create_package()]
+    with patch.object(get_async_transport(), "post", new=_mock_post()):
+        _run(get_correios_results(None, [pac]))
+    assert len(threads) == 1
+    assert threads[0] is not threading.current_thread()
+
+    assert [len(r) for r in results] == [2, 2, 1, 0]
+    assert all(result.codigo == CorreiosServico.PAC for result in results[0])
+    assert all(result.codigo == CorreiosServico.SEDEX for result in results[1])
+
+    # apenas os pacotes não atendidos pela tabela de preços são cotados no webservice
+    table_result = Mock(codigo=CorreiosServico.PAC, erro=0)
+    pac = get_component(CorreiosServico.PAC)
+    sedex = get_component(CorreiosServico.SEDEX)
+    pac._get_rate_table_results.side_effect = lambda params, packages: [table_result, None]
+    calls = []
+    with patch.object(get_async_transport(), "post", new=_mock_post(calls=calls)):
+        results = _run(get_correios_results(None, [pac, sedex]))
+
+    assert len(calls) == 2
+    assert [call["nCdServico"] for call in calls] == [CorreiosServico.SEDEX, "{0},{1}".format(CorreiosServico.PAC,
+                                                                                               CorreiosServico.SEDEX)]
+    assert results[0][0] is table_result
+    assert results[0][1].codigo == CorreiosServico.PAC
+    assert all(result.codigo == CorreiosServico.SEDEX for result in results[1])
+
+    # modo "Tabela": o webservice não é consultado
+    pac = get_component(CorreiosServico.PAC)
+    sedex = get_component(CorreiosServico.SEDEX)
+    pac.pricing_mode = sedex.pricing_mode = "table"
+    pac._get_rate_table_results.side_effect = lambda params, packages: [table_result] * len(packages)
+    sedex._get_rate_table_results.side_effect = lambda params, packages: [table_result] * len(packages)
+    calls = []
+    with patch.object(get_async_transport(), "post", new=_mock_post(calls=calls)):
+        results = _run(get_correios_results(None, [pac, sedex]))
+
+    assert calls == []
+    assert results == [[table_result] * 2, [table_result] * 2]
+
+
+def test_async_retries(settings):
+    settings.CORREIOS_WEBSERVICE_RETRIES = 2
+    settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF = 0
+    calls = []
+    success = _mock_post()
+
+    async def post(url, params=None, timeout=None):
+        calls.append(params)
+        if len(calls) == 1:
+            raise requests.exceptions.ConnectionError()
+        if len(calls) == 2:
+            return AsyncResponse(502, b"")
+        return await success(url, params, timeout)
+
+    with patch.object(get_async_transport(), "post", new=post):
+        result = _run(AsyncCorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.PAC,
+                                                      create_package(weight=4100)))
+        assert result.erro == 0
+        assert len(calls) == 3
+
+
+def test_async_cache_access_in_executor():
+    threads = {}
+
+    def track(name, func):
+        def wrapper(*args, **kwargs):
+            threads[name] = threading.current_thread()
+            return func(*args, **kwargs)
+        return wrapper
+
+    load_cached = CorreiosWS.PrecoPrazoRequest.load_cached
+    process_response = CorreiosWS.PrecoPrazoRequest.process_response
+
+    with patch.object(get_async_transport(), "post", new=_mock_post()), \
+            patch.object(CorreiosWS.PrecoPrazoRequest, "load_cached", new=track("load_cached", load_cached)), \
+            patch.object(CorreiosWS.PrecoPrazoRequest, "process_response",
+                         new=track("process_response", process_response)), \
+            patch.object(circuit_breaker, "allow_request", new=track("allow_request", circuit_breaker.allow_request)):
+        result = _run(AsyncCorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.PAC,
+                                                      create_package(weight=4200)))
+        assert result.erro == 0
+
+    # o acesso ao cache não bloqueia o event loop
+    assert set(threads.keys()) == set(["load_cached", "process_response", "allow_request"])
+    assert all(thread is not threading.current_thread() for thread in threads.values())
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+
+from django.core.cache import caches
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.cache import LRUCache, QuoteCache, QuoteCacheBatch
+from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+                                     QuoteCacheEntry, get_correios_cache)
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+def test_lru_cache():
+    cache = LRUCache(capacity=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    # "b" é o item utilizado há mais tempo
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.counter.get_stats() == {"hits": 3, "misses": 1}
+
+    # o tempo de expiração é limitado ao ttl do cache
+    cache.set("d", 4, timeout=10)
+    cache.set("e", 5, timeout=600)
+    with patch.object(time, "time", return_value=time.time() + 30):
+        assert cache.get("d") is None
+        assert cache.get("e") == 5
+    with patch.object(time, "time", return_value=time.time() + 61):
+        assert cache.get("e") is None
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lru_cache_threads():
+    cache = LRUCache(capacity=50, ttl=60)
+
+    def run(offset):
+        for i in range(1000):
+            cache.set((offset, i % 80), i)
+            cache.get((offset, (i * 7) % 80))
+
+    threads = [threading.Thread(target=run, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(cache) == 50
+    stats = cache.counter.get_stats()
+    assert stats["hits"] + stats["misses"] == 4000
+
+
+def test_quote_cache(settings):
+    shared = caches["default"]
+    shared.clear()
+    quote_cache = QuoteCache(lambda: shared)
+
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = False
+    quote_cache.set("chave", (1, 2), 60)
+    assert quote_cache.get("chave") == (1, 2)
+    assert quote_cache.get("outra") is None
+    assert quote_cache.get_stats() == {"local": None, "shared": {"hits": 1, "misses": 1}}
+
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = True
+    settings.CORREIOS_LOCAL_CACHE_CAPACITY = 10
+    settings.CORREIOS_LOCAL_CACHE_TTL = 60
+    quote_cache.reset()
+
+    # a primeira leitura vem do cache compartilhado e preenche o local
+    assert quote_cache.get("chave") == (1, 2)
+    with patch.object(shared, "get") as shared_get:
+        assert quote_cache.get("chave") == (1, 2)
+        assert not shared_get.called
+
+    assert quote_cache.get_stats() == {"local": {"hits": 1, "misses": 1}, "shared": {"hits": 1, "misses": 0}}
+
+    # gravações atualizam os dois níveis
+    quote_cache.set("nova", (3, 4), 60)
+    assert shared.get("nova") == (3, 4)
+    assert quote_cache.get_local_cache().get("nova") == (3, 4)
+
+    quote_cache.reset()
+    shared.clear()
+
+
+def test_quote_cache_many(settings):
+    shared = caches["default"]
+    shared.clear()
+    quote_cache = QuoteCache(lambda: shared)
+
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = True
+    settings.CORREIOS_LOCAL_CACHE_CAPACITY = 10
+    settings.CORREIOS_LOCAL_CACHE_TTL = 60
+    quote_cache.reset()
+
+    quote_cache.set_many({"a": (1,), "b": (2,)}, 60)
+    assert shared.get_many(["a", "b"]) == {"a": (1,), "b": (2,)}
+    shared.set("c", (3,), 60)
+
+    # apenas as chaves ausentes no cache local são lidas, todas de uma só vez
+    with patch.object(shared, "get_many", wraps=shared.get_many) as shared_get_many:
+        assert quote_cache.get_many(["a", "b", "c", "d"]) == {"a": (1,), "b": (2,), "c": (3,)}
+        shared_get_many.assert_called_once_with(["c", "d"])
+
+    assert quote_cache.get_stats()["shared"] == {"hits": 1, "misses": 1}
+    assert quote_cache.get_local_cache().get("c") == (3,)
+
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = False
+    quote_cache.reset()
+    shared.clear()
+
+
+def test_quote_cache_local_ttl(settings):
+    shared = caches["default"]
+    shared.clear()
+    quote_cache = QuoteCache(lambda: shared, QuoteCacheEntry.get_remaining_ttl)
+
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = True
+    settings.CORREIOS_LOCAL_CACHE_CAPACITY = 10
+    settings.CORREIOS_LOCAL_CACHE_TTL = 60
+    quote_cache.reset()
+
+    result = CorreiosWS.CorreiosWSServiceResult()
+    result.codigo = CorreiosServico.PAC
+    shared.set("erro", QuoteCacheEntry(result, 5).dumps(), 5)
+    shared.set("obsoleta", QuoteCacheEntry(result, stale_at=int(time.time()) - 1).dumps(), 60)
+    shared.set("outra", ("20.00", 3), 60)
+
+    assert len(quote_cache.get_many(["erro", "obsoleta", "outra"])) == 3
+    local = quote_cache.get_local_cache()
+
+    # a cópia local não sobrevive à entrada do cache compartilhado
+    with patch.object(time, "time", return_value=time.time() + 10):
+        assert local.get("erro") is None
+        assert local.get("outra") == ("20.00", 3)
+
+    # a entrada obsoleta é sempre lida do cache compartilhado, que recebe a atualização
+    assert local.get("obsoleta") is None
+    assert quote_cache.get("obsoleta") is not None
+    assert local.get("obsoleta") is None
+
+    # as gravações também limitam a cópia local ao tempo de vida restante da entrada
+    quote_cache.set("nova", QuoteCacheEntry(result, 5).dumps(), 3600)
+    quote_cache.set_many({"lote": QuoteCacheEntry(result, 5).dumps(),
+                          "vencida": QuoteCacheEntry(result, stale_at=int(time.time()) - 1).dumps()}, 3600)
+    assert local.get("vencida") is None
+
+    with patch.object(time, "time", return_value=time.time() + 10):
+        assert local.get("nova") is None
+        assert local.get("lote") is None
+    assert shared.get("nova") is not None
+
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = False
+    quote_cache.reset()
+    shared.clear()
+
+
+def test_quote_cache_batch():
+    shared = caches["default"]
+    shared.clear()
+    shared.set("a", (1,), 60)
+    batch = QuoteCacheBatch(QuoteCache(lambda: shared))
+
+    with patch.object(shared, "get_many", wraps=shared.get_many) as shared_get_many:
+        batch.load(["a", "b"])
+        # valores e ausências ficam memorizados
+        assert batch.get("a") == (1,)
+        assert batch.get("b") is None
+        batch.load(["a", "b", "c"])
+        assert shared_get_many.call_count == 2
+        assert shared_get_many.call_args[0][0] == ["c"]
+
+    # as gravações só chegam ao cache com flush, agrupadas por tempo de expiração
+    batch.set("b", (2,), 60)
+    batch.set("c", (3,), 60)
+    batch.set("d", (4,), 10)
+    assert batch.get("b") == (2,)
+    assert shared.get("b") is None
+
+    with patch.object(shared, "set_many", wraps=shared.set_many) as shared_set_many:
+        batch.flush()
+        batch.flush()
+        assert shared_set_many.call_count == 2
+
+    assert shared.get_many(["b", "c", "d"]) == {"b": (2,), "c": (3,), "d": (4,)}
+
+    # apenas as chaves informadas, as demais continuam acumuladas
+    batch.set("e", (5,), 60)
+    batch.set("f", (6,), 10)
+    batch.flush(["e"])
+    assert shared.get("e") == (5,)
+    assert shared.get("f") is None
+    batch.flush()
+    assert shared.get("f") == (6,)
+    shared.clear()
+
+
+def test_get_preco_prazo_local_cache(settings):
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = True
+    settings.CORREIOS_LOCAL_CACHE_TTL = 60
+
+    args = ('89070210', '89070400', CorreiosServico.PAC, create_package())
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+    shared = caches["default"]
+    shared.clear()
+    shuup_correios.correios.quote_cache.reset()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=shared):
+        with patch.object(get_transport(), "post", return_value=response) as mock:
+            CorreiosWS.get_preco_prazo(*args)
+
+            with patch.object(shared, "get_many") as shared_get_many:
+                result = CorreiosWS.get_preco_prazo(*args)
+                assert not shared_get_many.called
+
+            assert mock.call_count == 1
+            assert result.codigo == CorreiosServico.PAC
+
+    stats = shuup_correios.correios.quote_cache.get_stats()
+    assert stats["local"]["hits"] == 1
+
+    settings.CORREIOS_LOCAL_CACHE_ENABLED = False
+    shuup_correios.correios.quote_cache.reset()
+    shared.clear()
+
+
+def test_get_correios_cache(settings):
+    settings.CORREIOS_CACHE_NAME = "default"
+    assert get_correios_cache() is caches["default"]
+
+    # cada thread utiliza a sua instância do cache
+    handles = []
+    thread = threading.Thread(target=lambda: handles.append(get_correios_cache()))
+    thread.start()
+    thread.join(5)
+    assert handles[0] is not get_correios_cache()
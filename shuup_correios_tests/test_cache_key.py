@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from decimal import Decimal
+
+from mock import patch
+from shuup_correios import correios
+from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+                                     build_cache_key, get_billable_weight,
+                                     normalize_cep)
+from shuup_correios_tests import create_package
+
+
+def _get_key(cod_servico=CorreiosServico.PAC, package=None, **kwargs):
+    params = {
+        "cep_destino": "89070210",
+        "cep_origem": "89070400",
+        "cod_empresa": None,
+        "senha": None,
+        "mao_propria": False,
+        "valor_declarado": 0.0,
+        "aviso_recebimento": False
+    }
+    params.update(kwargs)
+    package = package or create_package(Decimal(1250), Decimal(400), Decimal(300), Decimal(200))
+    request = CorreiosWS.PrecoPrazoRequest(cod_servicos=[cod_servico], package=package, **params)
+    return request.cache_keys[cod_servico]
+
+
+def test_normalize_cep():
+    assert normalize_cep("89070-210") == "89070210"
+    assert normalize_cep(" 89.070-210 ") == "89070210"
+    assert normalize_cep("1310100") == "01310100"
+    assert normalize_cep(1310100) == "01310100"
+    assert normalize_cep("") == ""
+    assert normalize_cep(None) == ""
+
+
+def test_equivalent_ceps():
+    assert _get_key() == _get_key(cep_destino="89070-210", cep_origem=" 89.070-400")
+    assert _get_key(cep_destino="01310100") == _get_key(cep_destino="1310100")
+    assert _get_key() != _get_key(cep_destino="89070211")
+
+
+def test_equivalent_measures():
+    key = _get_key()
+
+    # mesmos valores com representações diferentes
+    assert key == _get_key(package=create_package(Decimal("1250.000000"), 400, 300.0, Decimal("200.00")))
+    assert key == _get_key(package=create_package(1250.0001, Decimal("400.04"), 300, 200))
+
+    # diferenças abaixo da precisão do webservice não geram outra chave,
+    # mas um grama ou um milímetro sim
+    assert key != _get_key(package=create_package(1251, 400, 300, 200))
+    assert key != _get_key(package=create_package(1250, 401, 300, 200))
+
+    # as dimensões mínimas são aplicadas antes de gerar a chave
+    small = create_package(1250, 100, 300, 200)
+    assert key == _get_key(package=small, min_package_width=Decimal(400))
+
+
+def test_equivalent_valor_declarado():
+    assert _get_key(valor_declarado=0.0) == _get_key(valor_declarado=Decimal())
+    assert _get_key(valor_declarado=0.0) == _get_key(valor_declarado=None)
+    assert _get_key(valor_declarado=Decimal("10.5")) == _get_key(valor_declarado=Decimal("10.500000"))
+    assert _get_key(valor_declarado=Decimal("10.50")) != _get_key(valor_declarado=Decimal("10.51"))
+
+
+def test_equivalent_flags_and_services():
+    assert _get_key(mao_propria=0, aviso_recebimento=None) == _get_key()
+    assert _get_key(mao_propria=True) != _get_key()
+    assert _get_key(aviso_recebimento=True) != _get_key()
+    assert _get_key(cod_servico="04510") == _get_key(cod_servico="4510")
+    assert _get_key(cod_servico=CorreiosServico.PAC) != _get_key(cod_servico=CorreiosServico.SEDEX)
+
+
+def test_secrets_not_in_key():
+    key = _get_key(cod_empresa="08082650", senha="564321")
+
+    # a senha não influencia nem aparece na chave
+    assert key == _get_key(cod_empresa="08082650", senha="outra")
+    assert "564321" not in key
+    assert "08082650" not in key
+
+    # contas diferentes possuem chaves diferentes
+    assert key != _get_key(cod_empresa="08082651", senha="564321")
+    assert key != _get_key()
+
+
+def test_key_version():
+    key = build_cache_key("89070210", "89070400", "41106", None, False, 0, False,
+                          Decimal("1.25"), Decimal(30), Decimal(20), Decimal(40))
+    assert key.startswith("correios:v{0}:".format(correios.CACHE_KEY_VERSION))
+
+    with patch.object(correios, "CACHE_KEY_VERSION", 99):
+        new_key = build_cache_key("89070210", "89070400", "41106", None, False, 0, False,
+                                  Decimal("1.25"), Decimal(30), Decimal(20), Decimal(40))
+        assert new_key.startswith("correios:v99:")
+        assert new_key.split(":")[-1] == key.split(":")[-1]
+
+
+def test_billable_weight():
+    # abaixo do limite do peso cúbico vale o peso real
+    assert get_billable_weight(Decimal(120), 100, 100, 100) == Decimal(300)
+    assert get_billable_weight(Decimal(300), 100, 100, 100) == Decimal(300)
+    assert get_billable_weight(Decimal(301), 100, 100, 100) == Decimal(1000)
+    assert get_billable_weight(Decimal(1250), 400, 300, 200) == Decimal(2000)
+
+    # 500 x 500 x 500 mm = 20.833 kg de peso cúbico
+    assert get_billable_weight(Decimal(1250), 500, 500, 500) == Decimal(21000)
+
+    # acima da última faixa arredonda para o próximo quilo
+    assert get_billable_weight(Decimal(30001), 100, 100, 100) == Decimal(31000)
+
+
+def test_billable_weight_bucketing(settings):
+    settings.CORREIOS_BILLABLE_WEIGHT_BUCKETING = True
+
+    key = _get_key(package=create_package(Decimal(1250), Decimal(400), Decimal(300), Decimal(200)))
+
+    # pesos e dimensões diferentes na mesma faixa compartilham a cotação
+    assert key == _get_key(package=create_package(Decimal(1900), Decimal(380), Decimal(310), Decimal(150)))
+    assert key == _get_key(package=create_package(Decimal(1001), Decimal(160), Decimal(110), Decimal(20)))
+    assert key != _get_key(package=create_package(Decimal(2001), Decimal(400), Decimal(300), Decimal(200)))
+
+    # o peso cúbico muda a faixa
+    assert key != _get_key(package=create_package(Decimal(1250), Decimal(500), Decimal(500), Decimal(500)))
+
+    request = CorreiosWS.PrecoPrazoRequest("89070210", "89070400", [CorreiosServico.PAC],
+                                           create_package(Decimal(1250), Decimal(400), Decimal(300), Decimal(200)),
+                                           min_package_width=Decimal(160),
+                                           min_package_length=Decimal(110),
+                                           min_package_height=Decimal(20))
+    payload = request.get_payload()
+    assert payload["nVlPeso"] == Decimal("2.000")
+    assert payload["nVlLargura"] == Decimal("16.0")
+    assert payload["nVlComprimento"] == Decimal("16.0")
+    assert payload["nVlAltura"] == Decimal("2.0")
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import io
+import os
+
+import pytest
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from shuup_correios.cep_index import (RECORD, CepIndex, get_cep_index,
+                                      reset_cep_index, validate_cep)
+from shuup_correios.management.commands.correios_build_cep_index import \
+    Command
+
+CEP_RANGES_PATH = os.path.join(os.path.dirname(__file__), "data", "cep_ranges.csv")
+
+
+def build_cep_index(tmpdir):
+    """ Compila o índice de testes e retorna o caminho do arquivo """
+    path = str(tmpdir.join("ceps.idx"))
+    CepIndex.compile(CEP_RANGES_PATH, path)
+    return path
+
+
+def test_cep_index_lookup(tmpdir):
+    index = CepIndex.open(build_cep_index(tmpdir))
+
+    # as faixas contíguas de SP e SC são unidas
+    assert index.size == 5
+
+    assert index.find("01310-100") == "SP"
+    assert index.find("07123000") == "SP"
+    assert index.find("08499999") == "SP"
+    assert index.find("70000000") == "DF"
+    assert index.find("89070210") == "SC"
+    assert index.find("89230000") == "SC"
+    assert index.find("89265000") == "SC"
+
+    assert index.find("00999999") is None
+    assert index.find("06000000") is None
+    assert index.find("89100000") is None
+    assert index.find("89270000") is None
+    assert index.find("99999999") is None
+    assert index.find("") is None
+    index.close()
+
+
+def test_cep_index_build():
+    # zeros à esquerda omitidos pela planilha
+    content = CepIndex.build([{"uf": "sp", "cep_inicial": "1000000", "cep_final": "1999999"}])
+    assert len(content) - RECORD.size == len(CepIndex.build([]))
+    assert CepIndex(content).find("01500000") == "SP"
+
+    with pytest.raises(ValueError):
+        CepIndex.build([{"uf": "SP", "cep_inicial": "02000000", "cep_final": "01000000"}])
+
+    with pytest.raises(ValueError):
+        CepIndex.build([{"uf": "SP", "cep_inicial": "01000000", "cep_final": "02000000"},
+                        {"uf": "RJ", "cep_inicial": "01500000", "cep_final": "03000000"}])
+
+    with pytest.raises(ValueError):
+        CepIndex(b"invalido")
+
+    with pytest.raises(ValueError):
+        CepIndex(content[:-1])
+
+
+def test_validate_cep(settings, tmpdir):
+    settings.CORREIOS_CEP_INDEX_PATH = None
+    reset_cep_index()
+    assert get_cep_index() is None
+
+    assert validate_cep("89070-210") == "89070210"
+    assert validate_cep("99999999") == "99999999"
+    # o zero à esquerda perdido é restaurado
+    assert validate_cep("1310100") == "01310100"
+
+    for cep in ("", None, "890702", "890702100", "abc"):
+        with pytest.raises(ValidationError) as exc:
+            validate_cep(cep)
+        assert exc.value.code == "invalid_cep"
+
+    settings.CORREIOS_CEP_INDEX_PATH = build_cep_index(tmpdir)
+    assert get_cep_index().size == 5
+    assert validate_cep("89070-210") == "89070210"
+    assert validate_cep("1310100") == "01310100"
+
+    with pytest.raises(ValidationError) as exc:
+        validate_cep("99999999", "CEP de destino")
+    assert exc.value.code == "unknown_cep"
+    assert "CEP de destino" in exc.value.message
+
+    settings.CORREIOS_CEP_INDEX_PATH = None
+    reset_cep_index()
+
+
+def test_build_cep_index_command(tmpdir):
+    path = str(tmpdir.join("ceps.idx"))
+    stdout = io.StringIO()
+    call_command(Command(), CEP_RANGES_PATH, path, stdout=stdout)
+    assert "5 faixas" in stdout.getvalue()
+    assert CepIndex.open(path).find("70000000") == "DF"
+
+    invalid_path = tmpdir.join("invalido.csv")
+    invalid_path.write("uf,cep_inicial\nSP,01000000\n")
+    with pytest.raises(CommandError):
+        call_command(Command(), str(invalid_path), path)
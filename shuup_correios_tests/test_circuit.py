@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import time
+
+import pytest
+import requests
+from django.core.cache import caches
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.circuit import CircuitBreaker
+from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+                                     CorreiosWSCircuitOpenException,
+                                     CorreiosWSServerErrorException,
+                                     CorreiosWSServerTimeoutException)
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+def test_circuit_breaker_states(settings):
+    settings.CORREIOS_CIRCUIT_BREAKER_THRESHOLD = 3
+    settings.CORREIOS_CIRCUIT_BREAKER_COOLDOWN = 30
+
+    cache = caches["default"]
+    cache.clear()
+    breaker = CircuitBreaker("test", lambda: cache)
+    other_process = CircuitBreaker("test", lambda: cache)
+
+    assert breaker.get_state() == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow_request()
+
+    # um sucesso zera as falhas consecutivas
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.get_state() == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.get_state() == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert not other_process.allow_request()
+
+    # passado o tempo de espera, apenas uma requisição de teste é liberada
+    with patch.object(time, "time", return_value=time.time() + 31):
+        assert breaker.get_state() == CircuitBreaker.HALF_OPEN
+        assert breaker.allow_request()
+        assert not other_process.allow_request()
+
+        # a requisição de teste falhou: abre novamente
+        breaker.record_failure()
+
+    with patch.object(time, "time", return_value=time.time() + 32):
+        assert breaker.get_state() == CircuitBreaker.OPEN
+
+    with patch.object(time, "time", return_value=time.time() + 62):
+        assert other_process.allow_request()
+        other_process.record_success()
+
+    assert breaker.get_state() == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+    cache.clear()
+
+
+def test_circuit_breaker_disabled(settings):
+    settings.CORREIOS_CIRCUIT_BREAKER_THRESHOLD = 0
+
+    cache = caches["default"]
+    cache.clear()
+    breaker = CircuitBreaker("test", lambda: cache)
+
+    for _ in range(10):
+        breaker.record_failure()
+
+    assert breaker.allow_request()
+    cache.clear()
+
+
+def test_get_preco_prazo_circuit_breaker(settings):
+    settings.CORREIOS_CIRCUIT_BREAKER_THRESHOLD = 2
+    settings.CORREIOS_CIRCUIT_BREAKER_COOLDOWN = 30
+
+    package = create_package(0, width=0, length=0, height=0)
+    args = ("89070210", "89070400", CorreiosServico.PAC, package)
+    cache = caches["default"]
+    cache.clear()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        with patch.object(get_transport(), "post") as mock:
+            mock.side_effect = requests.exceptions.Timeout()
+            with pytest.raises(CorreiosWSServerTimeoutException):
+                CorreiosWS.get_preco_prazo(*args)
+
+            mock.side_effect = None
+            mock.return_value = Mock(status_code=503, content=b"")
+            with pytest.raises(CorreiosWSServerErrorException):
+                CorreiosWS.get_preco_prazo(*args)
+
+            assert mock.call_count == 2
+
+            # circuito aberto: falha imediatamente, sem requisição
+            with pytest.raises(CorreiosWSCircuitOpenException):
+                CorreiosWS.get_preco_prazo(*args)
+            assert mock.call_count == 2
+
+            # tratada como timeout pelos componentes
+            assert issubclass(CorreiosWSCircuitOpenException, CorreiosWSServerTimeoutException)
+
+            # a requisição de teste com sucesso fecha o circuito
+            mock.return_value = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+            with patch.object(time, "time", return_value=time.time() + 31):
+                assert CorreiosWS.get_preco_prazo(*args).erro == 0
+
+            assert mock.call_count == 3
+            assert shuup_correios.correios.circuit_breaker.get_state() == CircuitBreaker.CLOSED
+
+    cache.clear()
@@ -13,13 +13,15 @@ from mock import patch, Mock
 
 import pytest
 import xmltodict
-from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+from shuup_correios.correios import (CorreiosErro, CorreiosServico, CorreiosWS,
                                      CorreiosWSServerErrorException,
                                      CorreiosWSServerTimeoutException,
                                      _convert_currency_to_decimal,
-                                     _convert_to_bool, _convert_to_int)
+                                     _convert_to_bool, _convert_to_int,
+                                     _match_servicos)
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
 from django.core.cache import caches
-from shuup_order_packager.package import SimplePackage
 
 
 def test_convert_service():
@@ -104,11 +106,7 @@ def test_get_preco_prazo_success():
     _CEP_ORIGEM = '89070400'
     _CEP_DESTINO = '89070210'
 
-    _PACKAGE = SimplePackage()
-    _PACKAGE._weight = 4000
-    _PACKAGE._height = 400
-    _PACKAGE._width = 400
-    _PACKAGE._length = 400
+    _PACKAGE = create_package(4000, width=400, length=400, height=400)
 
     _COD_EMPRESA = ''
     _SENHA = ''
@@ -142,12 +140,12 @@ def test_get_preco_prazo_success():
                _VALORSEMADICIONAIS,
                _OBSFIM)
 
-    response_mock = Mock(status_code=200, text=xml_text)
+    response_mock = Mock(status_code=200, content=xml_text.encode("utf-8"))
 
     args = (_CEP_DESTINO, _CEP_ORIGEM, _CODIGO, _PACKAGE,
             _COD_EMPRESA, _SENHA, False, 0.0, False)
 
-    with patch.object(requests, "post", return_value=response_mock):
+    with patch.object(get_transport(), "post", return_value=response_mock):
         result = CorreiosWS.get_preco_prazo(*args)
 
         assert result is not None
@@ -200,9 +198,9 @@ def test_get_preco_prazo_success():
                _VALORSEMADICIONAIS,
                _OBSFIM)
 
-    response_mock = Mock(status_code=200, text=xml_text)
+    response_mock = Mock(status_code=200, content=xml_text.encode("utf-8"))
 
-    with patch.object(requests, "post", return_value=response_mock):
+    with patch.object(get_transport(), "post", return_value=response_mock):
         # deve retornar o primeiro item
         result = CorreiosWS.get_preco_prazo(*args)
 
@@ -221,8 +219,8 @@ def test_get_preco_prazo_success():
 
     # troca o cache dummy pelo default, que deve estar na memória
     import shuup_correios
-    with patch.object(shuup_correios.correios, "correios_cache", new=caches["default"]):
-        with patch.object(requests, "post", return_value=response_mock):
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=caches["default"]):
+        with patch.object(get_transport(), "post", return_value=response_mock):
             CorreiosWS.get_preco_prazo(*args)
             CorreiosWS.get_preco_prazo(*args)
             CorreiosWS.get_preco_prazo(*args)
@@ -231,6 +229,65 @@ def test_get_preco_prazo_success():
             assert len(cache._cache.values()) == 1
 
 
+def test_get_preco_prazo_servicos():
+    xml_text = """<Servicos>
+            <cServico>
+                <Codigo>4510</Codigo>
+                <Valor>21,50</Valor>
+                <PrazoEntrega>7</PrazoEntrega>
+                <Erro>0</Erro>
+                <MsgErro></MsgErro>
+            </cServico>
+            <cServico>
+                <Codigo>40010</Codigo>
+                <Valor>43,20</Valor>
+                <PrazoEntrega>2</PrazoEntrega>
+                <Erro>0</Erro>
+                <MsgErro></MsgErro>
+            </cServico>
+            <cServico>
+                <Codigo>40215</Codigo>
+                <Valor>0,00</Valor>
+                <PrazoEntrega>0</PrazoEntrega>
+                <Erro>-6</Erro>
+                <MsgErro>Serviço indisponível para o trecho informado.</MsgErro>
+            </cServico>
+        </Servicos>
+    """
+
+    _PACKAGE = create_package(4000, width=400, length=400, height=400)
+
+    cod_servicos = ['04510', CorreiosServico.SEDEX, CorreiosServico.SEDEX_10]
+    response_mock = Mock(status_code=200, content=xml_text.encode("utf-8"))
+
+    import shuup_correios
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=caches["default"]):
+        caches["default"].clear()
+
+        with patch.object(get_transport(), "post", return_value=response_mock) as mock:
+            results = CorreiosWS.get_preco_prazo_servicos('89070210', '89070400', cod_servicos, _PACKAGE)
+
+            # uma única requisição para todos os serviços
+            assert mock.call_count == 1
+            assert mock.call_args[1]["params"]["nCdServico"] == "04510,40010,40215"
+
+            assert list(results.keys()) == cod_servicos
+            assert results['04510'].valor == _convert_currency_to_decimal('21,50')
+            assert results[CorreiosServico.SEDEX].prazo_entrega == 2
+            assert results[CorreiosServico.SEDEX_10].erro == -6
+
+            # os erros de serviço indisponível também vão para o cache
+            assert len(caches["default"]._cache.values()) == 3
+
+            # os serviços em cache não são requisitados novamente
+            result = CorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.SEDEX, _PACKAGE,
+                                                servicos_adicionais=['04510'])
+            assert result.valor == _convert_currency_to_decimal('43,20')
+            assert mock.call_count == 1
+
+        caches["default"].clear()
+
+
 def test_get_preco_prazo_errors():
     xml_text = """<Servicos>
         <cServico>
@@ -250,10 +307,10 @@ def test_get_preco_prazo_errors():
       </Servicos>
     """
 
-    response_mock = Mock(status_code=200, text=xml_text)
-    _PACKAGE = SimplePackage()
+    response_mock = Mock(status_code=200, content=xml_text.encode("utf-8"))
+    _PACKAGE = create_package(0, width=0, length=0, height=0)
 
-    with patch.object(requests, "post", return_value=response_mock):
+    with patch.object(get_transport(), "post", return_value=response_mock):
         result = CorreiosWS.get_preco_prazo("312321321321",
                                             "312312321",
                                             'naoexiste',
@@ -270,9 +327,9 @@ def test_get_preco_prazo_errors():
         assert result.valor == Decimal(0.0)
 
     # must throw exception
-    response_mock = Mock(status_code=500, text=xml_text)
+    response_mock = Mock(status_code=500, content=xml_text.encode("utf-8"))
 
-    with patch.object(requests, "post", return_value=response_mock):
+    with patch.object(get_transport(), "post", return_value=response_mock):
         with pytest.raises(CorreiosWSServerErrorException):
             result = CorreiosWS.get_preco_prazo("312321321321",
                                                 "312312321",
@@ -284,7 +341,7 @@ def test_get_preco_prazo_errors():
                                                 0.0,
                                                 False)
 
-    with patch.object(requests, "post") as mock:
+    with patch.object(get_transport(), "post") as mock:
         mock.side_effect = requests.exceptions.Timeout("peeeee")
 
         with pytest.raises(CorreiosWSServerTimeoutException):
@@ -299,6 +356,26 @@ def test_get_preco_prazo_errors():
                                                 False)
 
 
+def test_match_servicos():
+    def result(codigo):
+        ws_result = CorreiosWS.CorreiosWSServiceResult()
+        ws_result.codigo = codigo
+        return ws_result
+
+    pac, sedex = result("41106"), result("40010")
+
+    # pelo código, sem os zeros à esquerda
+    assert _match_servicos(["041106", "40010"], [sedex, pac]) == {"041106": pac, "40010": sedex}
+
+    # PAC omitido: o SEDEX na primeira posição não é atribuído ao PAC
+    assert _match_servicos(["41106", "40010"], [sedex]) == {"40010": sedex}
+
+    # código desconhecido: utiliza a posição
+    other = result("")
+    assert _match_servicos(["41106", "40010"], [other, sedex]) == {"41106": other, "40010": sedex}
+    assert _match_servicos(["41106"], [sedex]) == {"41106": sedex}
+
+
 def test_convert_to_int():
     assert _convert_to_int(None) == 0
     assert _convert_to_int('') == 0
@@ -329,3 +406,178 @@ def test_convert_to_bool():
 def test_correios_exception():
     exc = CorreiosWSServerErrorException(1234, "nothing")
     repr(exc)
+
+
+def test_stale_while_revalidate(settings):
+    import shuup_correios
+    from shuup_correios_tests.benchmarks.server import build_response
+
+    _PACKAGE = create_package(4000, width=400, length=400, height=400)
+
+    args = ('89070210', '89070400', CorreiosServico.PAC, _PACKAGE)
+    response_mock = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+    cache = caches["default"]
+    cache.clear()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        with patch.object(get_transport(), "post", return_value=response_mock) as mock:
+            # ainda não obsoleta: utiliza o cache sem atualizar
+            settings.CORREIOS_CACHE_SOFT_TTL = 60
+            CorreiosWS.get_preco_prazo(*args)
+            CorreiosWS.get_preco_prazo(*args)
+            assert mock.call_count == 1
+
+            # grava uma entrada que já nasce obsoleta
+            settings.CORREIOS_CACHE_SOFT_TTL = 0
+            cache.clear()
+            CorreiosWS.get_preco_prazo(*args)
+            assert mock.call_count == 2
+
+            # a entrada obsoleta é retornada imediatamente e atualizada em segundo plano
+
+            request = CorreiosWS.PrecoPrazoRequest('89070210', '89070400', [CorreiosServico.PAC], _PACKAGE)
+            assert not request.load_cached()
+            assert request.stale == [CorreiosServico.PAC]
+
+            # atualização em andamento em outro processo: não atualiza
+            cache.add(request.cache_keys[CorreiosServico.PAC] + ":refresh", True)
+            assert CorreiosWS.refresh_stale(request) is None
+            cache.delete(request.cache_keys[CorreiosServico.PAC] + ":refresh")
+
+            thread = CorreiosWS.refresh_stale(request)
+            thread.join(2)
+            assert mock.call_count == 3
+            assert cache.get(request.cache_keys[CorreiosServico.PAC] + ":refresh") is None
+
+        # erros na atualização não afetam quem utilizou o valor obsoleto
+        with patch.object(get_transport(), "post") as mock:
+            mock.side_effect = requests.exceptions.Timeout("peeeee")
+            request = CorreiosWS.PrecoPrazoRequest('89070210', '89070400', [CorreiosServico.PAC], _PACKAGE)
+            request.load_cached()
+            thread = CorreiosWS.refresh_stale(request)
+            thread.join(2)
+            assert request.results[CorreiosServico.PAC].erro == 0
+
+    cache.clear()
+
+
+def test_negative_cache(settings):
+    import shuup_correios
+    from shuup_correios_tests.benchmarks.server import SERVICO_XML
+
+    def get_response(erro):
+        return Mock(status_code=200, content="<Servicos>{0}</Servicos>".format(
+            SERVICO_XML.format(codigo=CorreiosServico.SEDEX_10, valor="0,00", prazo=0, erro=erro, msg_erro="erro")
+        ).encode("utf-8"))
+
+    _PACKAGE = create_package(0, width=0, length=0, height=0)
+    args = ('89070210', '89070400', CorreiosServico.SEDEX_10, _PACKAGE)
+    cache = caches["default"]
+
+    assert CorreiosErro.get_class(-6) == CorreiosErro.INDISPONIVEL
+    assert CorreiosErro.get_class(-3) == CorreiosErro.INDISPONIVEL
+    assert CorreiosErro.get_class(8) == CorreiosErro.INDISPONIVEL
+    assert CorreiosErro.get_class(-33) == CorreiosErro.TEMPORARIO
+    assert CorreiosErro.get_class(-888) == CorreiosErro.TEMPORARIO
+    assert CorreiosErro.get_class(12345) == CorreiosErro.DESCONHECIDO
+
+    settings.CORREIOS_ERROR_CACHE_TTL = {
+        CorreiosErro.INDISPONIVEL: 3600,
+        CorreiosErro.TEMPORARIO: 0,
+    }
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        # serviço indisponível para o trecho: a segunda consulta vem do cache
+        cache.clear()
+        with patch.object(get_transport(), "post", return_value=get_response(-6)) as mock:
+            assert CorreiosWS.get_preco_prazo(*args).erro == -6
+            assert CorreiosWS.get_preco_prazo(*args).erro == -6
+            assert mock.call_count == 1
+
+        # erros temporários não são armazenados com TTL 0
+        cache.clear()
+        with patch.object(get_transport(), "post", return_value=get_response(-33)) as mock:
+            assert CorreiosWS.get_preco_prazo(*args).erro == -33
+            assert CorreiosWS.get_preco_prazo(*args).erro == -33
+            assert mock.call_count == 2
+
+        # classes sem configuração não são armazenadas
+        cache.clear()
+        with patch.object(get_transport(), "post", return_value=get_response(12345)) as mock:
+            CorreiosWS.get_preco_prazo(*args)
+            CorreiosWS.get_preco_prazo(*args)
+            assert mock.call_count == 2
+
+    cache.clear()
+
+
+def test_cache_entry_serialization():
+    from shuup_correios.correios import QuoteCacheEntry
+    from shuup_correios_tests.benchmarks.server import build_response
+
+    result = CorreiosWS._parse_servicos(build_response([CorreiosServico.SEDEX], erro=-33).encode("iso-8859-1"))[0]
+    assert not hasattr(result, "__dict__")
+
+    value = QuoteCacheEntry(result, 60).dumps()
+    assert isinstance(value, tuple)
+    assert not any(isinstance(item, (Decimal, CorreiosWS.CorreiosWSServiceResult)) for item in value)
+
+    entry = QuoteCacheEntry.loads(value)
+    assert not entry.is_stale()
+    for field in CorreiosWS.CorreiosWSServiceResult.__slots__:
+        assert getattr(entry.result, field) == getattr(result, field)
+    assert isinstance(entry.result.valor, Decimal)
+
+    # valores ausentes ou em outro formato são tratados como ausentes no cache
+    assert QuoteCacheEntry.loads(None) is None
+    assert QuoteCacheEntry.loads(QuoteCacheEntry(result, 60)) is None
+    assert QuoteCacheEntry.loads((QuoteCacheEntry.FORMAT_VERSION + 1,) + value[1:]) is None
+
+
+def test_get_preco_prazo_batch():
+    import shuup_correios
+    from shuup_correios.cache import QuoteCacheBatch
+    from shuup_correios_tests.benchmarks.server import build_response
+
+    packages = []
+    for weight in (1000, 2000, 3000):
+        packages.append(create_package(weight, width=0, length=0, height=0))
+
+    params = dict(cep_destino='89070210', cep_origem='89070400', cod_servico=CorreiosServico.PAC,
+                  servicos_adicionais=[CorreiosServico.SEDEX])
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC, CorreiosServico.SEDEX])
+                    .encode("iso-8859-1"))
+    cache = caches["default"]
+    cache.clear()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        batch = QuoteCacheBatch(shuup_correios.correios.quote_cache)
+
+        # todos os pacotes e serviços são lidos do cache de uma só vez
+        with patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            assert CorreiosWS.get_cached_preco_prazo_many(packages=packages, batch=batch, **params) == [None] * 3
+            assert get_many.call_count == 1
+            assert len(get_many.call_args[0][0]) == 6
+
+            # as requisições ao webservice não leem novamente as chaves ausentes
+            # e as gravações só são feitas no flush
+            with patch.object(get_transport(), "post", return_value=response) as post:
+                for package in packages:
+                    CorreiosWS.get_preco_prazo(package=package, batch=batch, **params)
+                assert post.call_count == 3
+            assert get_many.call_count == 1
+
+        assert not cache.get_many(list(batch.values.keys()))
+
+        with patch.object(cache, "set_many", wraps=cache.set_many) as set_many:
+            batch.flush()
+            assert set_many.call_count == 1
+            assert len(set_many.call_args[0][0]) == 6
+
+        # os serviços adicionais também estão no cache
+        params["cod_servico"] = CorreiosServico.SEDEX
+        params["servicos_adicionais"] = None
+        results = CorreiosWS.get_cached_preco_prazo_many(packages=packages, **params)
+        assert [result.codigo for result in results] == [CorreiosServico.SEDEX] * 3
+
+    cache.clear()
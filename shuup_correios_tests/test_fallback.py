@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from decimal import Decimal
+
+import pytest
+from django.core.cache import caches
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.correios import CorreiosServico, CorreiosWS
+from shuup_correios.fallback import (FALLBACK_OBS, FlatRateProvider,
+                                     LastKnownQuoteProvider,
+                                     PriceCurveProvider, estimate_price,
+                                     get_fallback_preco_prazo,
+                                     reset_fallback_providers)
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
+from shuup_correios_tests.benchmarks.server import build_response
+
+PROVIDERS = (
+    "shuup_correios.fallback.LastKnownQuoteProvider",
+    "shuup_correios.fallback.PriceCurveProvider",
+    "shuup_correios.fallback.FlatRateProvider",
+)
+
+
+def _get_params(cep_destino="89070210", weight=1200):
+    return {
+        "cep_destino": cep_destino,
+        "cep_origem": "89070400",
+        "cod_servico": CorreiosServico.PAC,
+        "package": create_package(weight, width=110, length=160, height=20),
+    }
+
+
+def _set_curve_point(weight, valor, prazo, cep_destino="89070210"):
+    params = _get_params(cep_destino)
+    request = CorreiosWS.PrecoPrazoRequest(params["cep_destino"], params["cep_origem"],
+                                           [CorreiosServico.PAC], params["package"])
+    key = request.get_fallback_key(CorreiosServico.PAC, 3, weight)
+    caches["default"].set(key, (valor, prazo))
+
+
+@pytest.fixture
+def fallback(settings):
+    settings.CORREIOS_FALLBACK_PROVIDERS = PROVIDERS
+    settings.CORREIOS_FALLBACK_FLAT_RATES = {}
+    caches["default"].clear()
+    reset_fallback_providers()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=caches["default"]):
+        yield
+
+    reset_fallback_providers()
+    caches["default"].clear()
+
+
+def test_estimate_price():
+    points = [(Decimal(1000), Decimal("20.00"), 3), (Decimal(3000), Decimal("30.00"), 5)]
+
+    assert estimate_price([], Decimal(1000)) is None
+    assert estimate_price(points, Decimal(1000)) == (Decimal("20.00"), 3)
+    # interpolação entre as faixas conhecidas
+    assert estimate_price(points, Decimal(2000)) == (Decimal("25.00"), 5)
+    # abaixo da primeira faixa: o preço da faixa mais leve
+    assert estimate_price(points, Decimal(300)) == (Decimal("20.00"), 3)
+    # acima da última faixa: extrapolação
+    assert estimate_price(points, Decimal(5000)) == (Decimal("40.00"), 5)
+    assert estimate_price(points[:1], Decimal(5000)) is None
+
+
+def test_last_known_quote(settings, fallback):
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+
+    # as cotações do webservice são registradas para a contingência
+    with patch.object(get_transport(), "post", return_value=response):
+        CorreiosWS.get_preco_prazo(**_get_params("89070210", 1200))
+
+    # outro CEP da mesma localidade e outro peso da mesma faixa
+    result = LastKnownQuoteProvider().get_preco_prazo(**_get_params("89070999", 1900))
+    assert result.erro == 0
+    assert result.valor == Decimal("20.00")
+    assert result.prazo_entrega == 2
+    assert result.obs_fim == FALLBACK_OBS
+
+    assert LastKnownQuoteProvider().get_preco_prazo(**_get_params("89071000", 1200)) is None
+    assert LastKnownQuoteProvider().get_preco_prazo(**_get_params("89070210", 2500)) is None
+
+    # sem provedores configurados, nada é registrado
+    caches["default"].clear()
+    settings.CORREIOS_FALLBACK_PROVIDERS = ()
+    with patch.object(get_transport(), "post", return_value=response):
+        CorreiosWS.get_preco_prazo(**_get_params("89070210", 1200))
+
+    settings.CORREIOS_FALLBACK_PROVIDERS = PROVIDERS
+    assert LastKnownQuoteProvider().get_preco_prazo(**_get_params("89070210", 1200)) is None
+
+    # cotações com valor declarado não são registradas, pois incluem a taxa do valor declarado
+    with patch.object(get_transport(), "post", return_value=response):
+        CorreiosWS.get_preco_prazo(valor_declarado=Decimal("150.00"), **_get_params("89070210", 1200))
+    assert LastKnownQuoteProvider().get_preco_prazo(**_get_params("89070210", 1200)) is None
+
+
+def test_price_curve(fallback):
+    assert PriceCurveProvider().get_preco_prazo(**_get_params()) is None
+
+    _set_curve_point(1000, "20.00", 3)
+    _set_curve_point(3000, "30.00", 5, cep_destino="89099999")
+
+    # pontos da mesma região, interpolados para a faixa de 2 kg
+    result = PriceCurveProvider().get_preco_prazo(**_get_params("89000000", 1500))
+    assert result.valor == Decimal("25.00")
+    assert result.prazo_entrega == 5
+
+    assert PriceCurveProvider().get_preco_prazo(**_get_params("01310100", 1500)) is None
+
+
+def test_flat_rate(settings, fallback):
+    assert FlatRateProvider().get_preco_prazo(**_get_params()) is None
+
+    settings.CORREIOS_FALLBACK_FLAT_RATES = {"041106": ("45.5", 10)}
+    result = FlatRateProvider().get_preco_prazo(**_get_params())
+    assert result.valor == Decimal("45.50")
+    assert result.prazo_entrega == 10
+
+
+def test_fallback_chain(settings, fallback):
+    settings.CORREIOS_FALLBACK_FLAT_RATES = {CorreiosServico.PAC: ("45.00", 10)}
+    _set_curve_point(1000, "20.00", 3)
+    _set_curve_point(3000, "30.00", 5)
+
+    # o primeiro provedor que atender é utilizado
+    assert get_fallback_preco_prazo(**_get_params()).valor == Decimal("25.00")
+
+    with patch.object(PriceCurveProvider, "get_preco_prazo", side_effect=ValueError()):
+        assert get_fallback_preco_prazo(**_get_params()).valor == Decimal("45.00")
+
+    # a taxa do valor declarado não é estimada
+    assert get_fallback_preco_prazo(valor_declarado=Decimal("150.00"), **_get_params()) is None
+
+    settings.CORREIOS_FALLBACK_FLAT_RATES = {}
+    caches["default"].clear()
+    assert get_fallback_preco_prazo(**_get_params()) is None
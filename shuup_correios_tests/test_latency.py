@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+
+import pytest
+import requests
+from django.core.cache import caches
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+                                     CorreiosWSDeadlineExceededException,
+                                     CorreiosWSServerErrorException,
+                                     CorreiosWSServerTimeoutException)
+from shuup_correios.latency import (Deadline, LatencyTracker,
+                                    get_max_request_time, get_retry_delay)
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
+from shuup_correios_tests.benchmarks.server import build_response
+
+ARGS = ("89070210", "89070400", CorreiosServico.PAC, create_package(0, width=0, length=0, height=0))
+
+
+def _success():
+    return Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+
+
+@pytest.fixture
+def tracker(settings):
+    settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF = 0
+    settings.CORREIOS_CIRCUIT_BREAKER_THRESHOLD = 0
+    caches["default"].clear()
+    shuup_correios.correios.latency_tracker.reset()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=caches["default"]):
+        yield shuup_correios.correios.latency_tracker
+
+    shuup_correios.correios.latency_tracker.reset()
+    caches["default"].clear()
+
+
+def test_latency_tracker(settings):
+    settings.CORREIOS_WEBSERVICE_LATENCY_WINDOW = 100
+    settings.CORREIOS_WEBSERVICE_LATENCY_MIN_SAMPLES = 10
+    settings.CORREIOS_WEBSERVICE_TIMEOUT = 5.0
+    settings.CORREIOS_WEBSERVICE_MIN_TIMEOUT = 1.0
+    settings.CORREIOS_WEBSERVICE_TIMEOUT_FACTOR = 3
+    settings.CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT = True
+    settings.CORREIOS_WEBSERVICE_HEDGE = True
+
+    tracker = LatencyTracker()
+    for _ in range(9):
+        tracker.record(0.1)
+
+    # amostras insuficientes: utiliza o timeout configurado e não duplica requisições
+    assert tracker.percentile(99) is None
+    assert tracker.get_timeout() == 5.0
+    assert tracker.get_hedge_delay(5.0) is None
+
+    # as amostras mais antigas são descartadas
+    for index in range(1, 201):
+        tracker.record(index / 100.0)
+    assert tracker.percentile(0) == 1.01
+    assert tracker.percentile(50) == 1.51
+    assert tracker.percentile(95) == 1.95
+    assert tracker.percentile(100) == 2.0
+
+    # p99 * 3, limitado ao timeout máximo
+    assert tracker.get_timeout() == 5.0
+    assert tracker.get_hedge_delay(5.0) == 1.95
+    assert tracker.get_hedge_delay(1.5) is None
+
+    tracker.reset()
+    for _ in range(100):
+        tracker.record(0.5)
+    assert tracker.get_timeout() == 1.5
+
+    tracker.reset()
+    for _ in range(100):
+        tracker.record(0.01)
+    assert tracker.get_timeout() == 1.0
+
+    settings.CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT = False
+    settings.CORREIOS_WEBSERVICE_HEDGE = False
+    assert tracker.get_timeout() == 5.0
+    assert tracker.get_hedge_delay(5.0) is None
+
+
+def test_retry_delay(settings):
+    settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF = 0.1
+
+    for _ in range(100):
+        assert 0 <= get_retry_delay(1) <= 0.1
+        assert 0 <= get_retry_delay(3) <= 0.4
+
+
+def test_max_request_time(settings):
+    settings.CORREIOS_WEBSERVICE_TIMEOUT = 5.0
+    settings.CORREIOS_WEBSERVICE_RETRIES = 2
+    settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF = 0.5
+    # 3 tentativas de 5s e esperas de até 0.5s e 1s
+    assert get_max_request_time() == pytest.approx(16.5)
+
+    settings.CORREIOS_WEBSERVICE_RETRIES = 0
+    assert get_max_request_time() == pytest.approx(5.0)
+
+
+def test_retries(settings, tracker):
+    settings.CORREIOS_WEBSERVICE_RETRIES = 2
+
+    # erros de conexão e 5xx são repetidos
+    with patch.object(get_transport(), "post") as mock:
+        mock.side_effect = [requests.exceptions.ConnectionError(), Mock(status_code=503, content=b""), _success()]
+        assert CorreiosWS.get_preco_prazo(*ARGS).erro == 0
+        assert mock.call_count == 3
+
+    caches["default"].clear()
+    with patch.object(get_transport(), "post", return_value=Mock(status_code=500, content=b"")) as mock:
+        with pytest.raises(CorreiosWSServerErrorException):
+            CorreiosWS.get_preco_prazo(*ARGS)
+        assert mock.call_count == 3
+
+    with patch.object(get_transport(), "post", side_effect=requests.exceptions.ConnectTimeout()) as mock:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            CorreiosWS.get_preco_prazo(*ARGS)
+        assert mock.call_count == 3
+
+    # timeouts de leitura não são repetidos
+    with patch.object(get_transport(), "post", side_effect=requests.exceptions.ReadTimeout()) as mock:
+        with pytest.raises(CorreiosWSServerTimeoutException):
+            CorreiosWS.get_preco_prazo(*ARGS)
+        assert mock.call_count == 1
+
+    settings.CORREIOS_WEBSERVICE_RETRIES = 0
+    with patch.object(get_transport(), "post", return_value=Mock(status_code=500, content=b"")) as mock:
+        with pytest.raises(CorreiosWSServerErrorException):
+            CorreiosWS.get_preco_prazo(*ARGS)
+        assert mock.call_count == 1
+
+
+def test_adaptive_timeout(settings, tracker):
+    settings.CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT = True
+    settings.CORREIOS_WEBSERVICE_LATENCY_MIN_SAMPLES = 5
+    settings.CORREIOS_WEBSERVICE_MIN_TIMEOUT = 0.5
+    settings.CORREIOS_WEBSERVICE_TIMEOUT = 5.0
+
+    for _ in range(10):
+        tracker.record(0.4)
+
+    with patch.object(get_transport(), "post", return_value=_success()) as mock:
+        CorreiosWS.get_preco_prazo(*ARGS)
+        assert mock.call_args[1]["timeout"] == pytest.approx(1.2)
+
+
+def test_hedged_request(settings, tracker):
+    settings.CORREIOS_WEBSERVICE_HEDGE = True
+    settings.CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT = False
+    settings.CORREIOS_WEBSERVICE_LATENCY_MIN_SAMPLES = 5
+    settings.CORREIOS_WEBSERVICE_TIMEOUT = 5.0
+
+    for _ in range(10):
+        tracker.record(0.05)
+
+    release = threading.Event()
+    calls = []
+
+    def post(url, params=None, timeout=None):
+        calls.append(timeout)
+        if len(calls) == 1:
+            # a primeira requisição fica presa
+            release.wait(5)
+        return _success()
+
+    # a resposta da requisição duplicada é utilizada sem aguardar a primeira
+    with patch.object(get_transport(), "post", side_effect=post):
+        start = time.time()
+        assert CorreiosWS.get_preco_prazo(*ARGS).erro == 0
+        assert time.time() - start < 1
+
+    release.set()
+    assert len(calls) == 2
+    assert calls[0] == 5.0
+    assert calls[1] == pytest.approx(4.95)
+
+    # sem threads livres no executor, a requisição é feita sem duplicação
+    caches["default"].clear()
+    shuup_correios.correios.get_hedge_executor()
+    with patch.object(shuup_correios.correios, "_hedge_slots", new=threading.BoundedSemaphore(1)) as slots:
+        slots.acquire()
+        threads = []
+        with patch.object(get_transport(), "post",
+                          side_effect=lambda *args, **kwargs: threads.append(threading.current_thread()) or _success()):
+            assert CorreiosWS.get_preco_prazo(*ARGS).erro == 0
+        assert threads == [threading.current_thread()]
+
+
+def test_hedged_request_timeout(settings, tracker):
+    settings.CORREIOS_WEBSERVICE_HEDGE = True
+    settings.CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT = False
+    settings.CORREIOS_WEBSERVICE_LATENCY_MIN_SAMPLES = 5
+    settings.CORREIOS_WEBSERVICE_TIMEOUT = 0.3
+    settings.CORREIOS_WEBSERVICE_RETRIES = 0
+
+    for _ in range(10):
+        tracker.record(0.05)
+
+    def post(url, params=None, timeout=None):
+        time.sleep(timeout)
+        raise requests.exceptions.ReadTimeout()
+
+    # o timeout da requisição duplicada não conta como uma segunda falha
+    with patch.object(get_transport(), "post", side_effect=post) as mock:
+        with patch.object(shuup_correios.correios.circuit_breaker, "record_failure") as record_failure:
+            with pytest.raises(CorreiosWSServerTimeoutException):
+                CorreiosWS.get_preco_prazo(*ARGS)
+        assert mock.call_count == 2
+        assert record_failure.call_count == 1
+
+
+def test_deadline():
+    deadline = Deadline(10)
+    assert not deadline.expired
+    assert 9 < deadline.remaining() <= 10
+    assert deadline.get_timeout(5.0) == 5.0
+    assert deadline.get_timeout(20.0) <= 10
+
+    deadline = Deadline(0)
+    assert deadline.expired
+    assert deadline.remaining() == 0
+    assert deadline.get_timeout(5.0) == 0
+
+
+def test_deadline_budget(settings, tracker):
+    settings.CORREIOS_WEBSERVICE_ADAPTIVE_TIMEOUT = False
+    settings.CORREIOS_WEBSERVICE_TIMEOUT = 5.0
+    settings.CORREIOS_WEBSERVICE_RETRIES = 2
+
+    # o timeout da requisição é limitado ao tempo restante
+    with patch.object(get_transport(), "post", return_value=_success()) as mock:
+        CorreiosWS.get_preco_prazo(*ARGS, deadline=Deadline(1))
+        assert 0.9 < mock.call_args[1]["timeout"] <= 1
+
+    # prazo esgotado: a requisição não é feita
+    caches["default"].clear()
+    with patch.object(get_transport(), "post", return_value=_success()) as mock:
+        with pytest.raises(CorreiosWSDeadlineExceededException):
+            CorreiosWS.get_preco_prazo(*ARGS, deadline=Deadline(0))
+        assert mock.call_count == 0
+
+    # o timeout causado pelo prazo não conta como falha nem como latência do webservice
+    def post(url, params=None, timeout=None):
+        time.sleep(timeout)
+        raise requests.exceptions.ReadTimeout()
+
+    with patch.object(get_transport(), "post", side_effect=post) as mock:
+        with patch.object(shuup_correios.correios.circuit_breaker, "record_failure") as record_failure:
+            with pytest.raises(CorreiosWSDeadlineExceededException):
+                CorreiosWS.get_preco_prazo(*ARGS, deadline=Deadline(0.05))
+        assert mock.call_count == 1
+        assert not record_failure.called
+    assert tracker.percentile(0) is None
+
+    # sem tempo para esperar uma nova tentativa
+    settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF = 10
+    with patch("shuup_correios.correios.get_retry_delay", return_value=5):
+        with patch.object(get_transport(), "post", return_value=Mock(status_code=503, content=b"")) as mock:
+            with pytest.raises(CorreiosWSServerErrorException):
+                CorreiosWS.get_preco_prazo(*ARGS, deadline=Deadline(1))
+            assert mock.call_count == 1
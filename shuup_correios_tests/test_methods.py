@@ -10,6 +10,8 @@
 from decimal import Decimal
 
 import pytest
+import requests
+from django.core.cache import caches
 from mock import patch
 from shuup.core.models import OrderLineType, get_person_contact
 from shuup.core.models._service_shipping import ShippingMethod
@@ -17,9 +19,18 @@ from shuup.testing.factories import (create_product, get_address,
                                      get_default_product, get_default_shop,
                                      get_default_supplier,
                                      get_default_tax_class, get_payment_method)
-from shuup_correios.correios import CorreiosWS
-from shuup_correios.models import CorreiosCarrier
+import shuup_correios
+from shuup_correios.cep_index import reset_cep_index
+from shuup_correios.correios import CorreiosServico, CorreiosWS
+from shuup_correios.fallback import reset_fallback_providers
+from shuup_correios.models import CorreiosBehaviorComponent, CorreiosCarrier
+from shuup_correios.rate_table import RATE_NOT_FOUND_ERROR, reset_rate_table
+from shuup_correios.signals import quote_calculated
+from shuup_correios.transport import get_transport
 from shuup_correios_tests import create_mock_ws_result
+from shuup_correios_tests.benchmarks.server import build_response
+from shuup_correios_tests.test_cep_index import build_cep_index
+from shuup_correios_tests.test_rate_table import RATE_TABLE_PATH
 from shuup_tests.core.test_order_creator import seed_source
 from shuup_tests.utils.basketish_order_source import BasketishOrderSource
 
@@ -384,3 +395,402 @@ def test_correios_delivery_time_2(rf, admin_user):
 
         results = bc._get_correios_results(source, packages)
         assert len(results) == 3
+
+
+@pytest.mark.django_db
+def test_correios_quote_memoized(rf, admin_user):
+    with patch.object(CorreiosWS, 'get_preco_prazo', return_value=MOCKED_SUCCESS_RESULT) as mocked:
+        pac_carrier = get_correios_carrier_2()
+        contact = get_person_contact(admin_user)
+        p1 = create_product(sku='p1',
+                            supplier=get_default_supplier(),
+                            width=400,
+                            depth=400,
+                            height=400,
+                            gross_weight=1250)
+
+        source = seed_source(admin_user)
+        source.add_line(
+            type=OrderLineType.PRODUCT,
+            product=p1,
+            supplier=get_default_supplier(),
+            quantity=2,
+            base_unit_price=source.create_price(10))
+        billing_address = get_address()
+        shipping_address = get_address(name="My House", country='BR')
+        shipping_address.postal_code = "89070210"
+        source.billing_address = billing_address
+        source.shipping_address = shipping_address
+        source.customer = contact
+
+        shipping = ShippingMethod.objects.filter(carrier=pac_carrier).first()
+        bc = shipping.behavior_components.first()
+
+        with patch.object(bc, '_pack_source', wraps=bc._pack_source) as pack_mock:
+            assert len(bc.get_unavailability_reasons(shipping, source)) == 0
+            assert len(list(bc.get_costs(shipping, source))) == 1
+            assert bc.get_delivery_time(shipping, source) is not None
+
+            # empacota e consulta os Correios apenas uma vez (2 pacotes)
+            assert pack_mock.call_count == 1
+            assert mocked.call_count == 2
+
+            # alterar o pedido invalida a cotação memorizada, mas o carrinho
+            # não mudou e não precisa ser empacotado novamente
+            shipping_address.postal_code = "89070400"
+            list(bc.get_costs(shipping, source))
+            assert pack_mock.call_count == 1
+            assert mocked.call_count == 4
+
+
+@pytest.mark.django_db
+def test_correios_quote_calculated_signal(admin_user):
+    events = []
+
+    def receiver(sender, **kwargs):
+        events.append(kwargs)
+
+    with patch.object(CorreiosWS, 'get_preco_prazo', return_value=MOCKED_SUCCESS_RESULT):
+        pac_carrier = get_correios_carrier_2()
+        p1 = create_product(sku='p1',
+                            supplier=get_default_supplier(),
+                            width=400,
+                            depth=400,
+                            height=400,
+                            gross_weight=1250)
+
+        source = seed_source(admin_user)
+        source.add_line(
+            type=OrderLineType.PRODUCT,
+            product=p1,
+            supplier=get_default_supplier(),
+            quantity=2,
+            base_unit_price=source.create_price(10))
+        shipping_address = get_address(name="My House", country='BR')
+        shipping_address.postal_code = "89070210"
+        source.shipping_address = shipping_address
+
+        shipping = ShippingMethod.objects.filter(carrier=pac_carrier).first()
+        bc = shipping.behavior_components.first()
+
+        quote_calculated.connect(receiver, sender=CorreiosBehaviorComponent)
+        try:
+            list(bc.get_costs(shipping, source))
+            bc.get_delivery_time(shipping, source)
+        finally:
+            quote_calculated.disconnect(receiver, sender=CorreiosBehaviorComponent)
+
+    # a cotação memorizada não gera um novo evento
+    assert len(events) == 1
+    assert events[0]["component"] == bc
+    assert events[0]["package_count"] == 2
+    assert events[0]["packing_duration"] >= 0
+    assert events[0]["results_duration"] >= 0
+    assert events[0]["timeout"] is False
+    assert events[0]["erros"] == [0, 0]
+
+
+@pytest.mark.django_db
+def test_correios_servicos_adicionais(admin_user):
+    carrier = CorreiosCarrier.objects.create(name="Correios")
+    pac_service = carrier.create_service(
+        'PAC',
+        shop=get_default_shop(),
+        enabled=True,
+        tax_class=get_default_tax_class(),
+        name="Correios PAC")
+    carrier.create_service(
+        'SEDEX',
+        shop=get_default_shop(),
+        enabled=True,
+        tax_class=get_default_tax_class(),
+        name="Correios SEDEX")
+    sedex10_service = carrier.create_service(
+        'SEDEX_10',
+        shop=get_default_shop(),
+        enabled=True,
+        tax_class=get_default_tax_class(),
+        name="Correios SEDEX 10")
+
+    # configuração diferente - não pode ser cotado na mesma requisição
+    sedex10_bc = sedex10_service.behavior_components.first()
+    sedex10_bc.cep_origem = '88220000'
+    sedex10_bc.save()
+
+    source = seed_source(admin_user)
+    pac_bc = pac_service.behavior_components.first()
+    assert pac_bc._get_servicos_adicionais(source) == [CorreiosServico.SEDEX]
+
+    with patch.object(CorreiosWS, 'get_preco_prazo', return_value=MOCKED_SUCCESS_RESULT) as mocked:
+        p1 = create_product(sku='p1',
+                            supplier=get_default_supplier(),
+                            width=400,
+                            depth=400,
+                            height=400,
+                            gross_weight=1250)
+        source.add_line(
+            type=OrderLineType.PRODUCT,
+            product=p1,
+            supplier=get_default_supplier(),
+            quantity=1,
+            base_unit_price=source.create_price(10))
+        shipping_address = get_address(name="My House", country='BR')
+        shipping_address.postal_code = "89070210"
+        source.shipping_address = shipping_address
+
+        pac_bc._get_correios_results(source, pac_bc._pack_source(source))
+        assert mocked.call_args[1]["servicos_adicionais"] == [CorreiosServico.SEDEX]
+
+
+@pytest.mark.django_db
+def test_correios_pricing_mode(settings, admin_user):
+    settings.CORREIOS_RATE_TABLE_PATH = RATE_TABLE_PATH
+    reset_rate_table()
+
+    pac_carrier = get_correios_carrier_1()
+    p1 = create_product(sku='p1',
+                        supplier=get_default_supplier(),
+                        width=160,
+                        depth=110,
+                        height=20,
+                        gross_weight=250)
+
+    source = seed_source(admin_user)
+    source.add_line(
+        type=OrderLineType.PRODUCT,
+        product=p1,
+        supplier=get_default_supplier(),
+        quantity=1,
+        base_unit_price=source.create_price(10))
+    shipping_address = get_address(name="My House", country='BR')
+    shipping_address.postal_code = "89070210"
+    source.shipping_address = shipping_address
+
+    bc = ShippingMethod.objects.filter(carrier=pac_carrier).first().behavior_components.first()
+    packages = bc._pack_source(source)
+
+    with patch.object(CorreiosWS, 'get_preco_prazo', return_value=MOCKED_SUCCESS_RESULT) as mocked:
+        bc.pricing_mode = bc.PRICING_MODE_TABLE
+        results = bc._get_correios_results(source, packages)
+        assert results[0].valor == Decimal("16.10")
+        assert mocked.call_count == 0
+
+        # fora da tabela: erro, sem consultar o webservice
+        shipping_address.postal_code = "70000000"
+        results = bc._get_correios_results(source, packages)
+        assert results[0].erro == RATE_NOT_FOUND_ERROR
+        assert mocked.call_count == 0
+
+        # tabela e webservice: consulta o webservice apenas quando a tabela não atende
+        bc.pricing_mode = bc.PRICING_MODE_TABLE_WS
+        results = bc._get_correios_results(source, packages)
+        assert results[0] is MOCKED_SUCCESS_RESULT
+        assert mocked.call_count == 1
+
+        shipping_address.postal_code = "89070210"
+        results = bc._get_correios_results(source, packages)
+        assert results[0].valor == Decimal("16.10")
+        assert mocked.call_count == 1
+
+    # a tabela também é utilizada quando o webservice falha, mesmo sem provedores de contingência
+    settings.CORREIOS_FALLBACK_PROVIDERS = ()
+    results, estimated = bc._get_fallback_results(source, packages)
+    assert results[0].valor == Decimal("16.10")
+    assert not estimated
+
+    reset_rate_table()
+
+
+@pytest.mark.django_db
+def test_correios_cache_lock_batch(settings, admin_user):
+    settings.CORREIOS_SINGLE_FLIGHT = True
+    settings.CORREIOS_SINGLE_FLIGHT_CACHE_LOCK = True
+    cache = caches["default"]
+    cache.clear()
+
+    pac_carrier = get_correios_carrier_2()
+    p1 = create_product(sku='p1',
+                        supplier=get_default_supplier(),
+                        width=400,
+                        depth=400,
+                        height=400,
+                        gross_weight=1250)
+
+    source = seed_source(admin_user)
+    source.add_line(
+        type=OrderLineType.PRODUCT,
+        product=p1,
+        supplier=get_default_supplier(),
+        quantity=2,
+        base_unit_price=source.create_price(10))
+    shipping_address = get_address(name="My House", country='BR')
+    shipping_address.postal_code = "89070210"
+    source.shipping_address = shipping_address
+
+    bc = ShippingMethod.objects.filter(carrier=pac_carrier).first().behavior_components.first()
+    packages = bc._pack_source(source)
+    params = bc._get_preco_prazo_params(source)
+    response = requests.Response()
+    response.status_code = 200
+    response._content = build_response([CorreiosServico.PAC]).encode("iso-8859-1")
+    released = []
+    delete = cache.delete
+
+    def release_lock(key, *args, **kwargs):
+        # ao liberar a trava, outro processo que a aguardava já encontra a cotação no cache
+        if key.startswith("correios:flight:"):
+            released.append(CorreiosWS.get_cached_preco_prazo_many(packages=packages, **params))
+        return delete(key, *args, **kwargs)
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache), \
+            patch.object(cache, "delete", side_effect=release_lock), \
+            patch.object(get_transport(), "post", return_value=response) as mocked:
+        results = bc._get_correios_results(source, packages)
+        assert all(result.erro == 0 for result in results)
+
+    assert mocked.call_count >= 1
+    assert len(released) == mocked.call_count
+    assert all(any(result is not None for result in cached) for cached in released)
+    cache.clear()
+
+
+@pytest.mark.django_db
+def test_correios_invalid_cep(settings, tmpdir, admin_user):
+    settings.CORREIOS_CEP_INDEX_PATH = build_cep_index(tmpdir)
+    reset_cep_index()
+
+    pac_carrier = get_correios_carrier_2()
+    service = ShippingMethod.objects.filter(carrier=pac_carrier).first()
+    bc = service.behavior_components.first()
+    bc.cep_origem = '89070400'
+    bc.save()
+
+    p1 = create_product(sku='p1',
+                        supplier=get_default_supplier(),
+                        width=400,
+                        depth=400,
+                        height=400,
+                        gross_weight=1250)
+
+    with patch.object(CorreiosWS, 'get_preco_prazo', return_value=MOCKED_SUCCESS_RESULT) as mocked:
+        for postal_code, code in (("99999999", "unknown_cep"), ("8907021", "invalid_cep")):
+            source = seed_source(admin_user)
+            source.add_line(
+                type=OrderLineType.PRODUCT,
+                product=p1,
+                supplier=get_default_supplier(),
+                quantity=1,
+                base_unit_price=source.create_price(10))
+            shipping_address = get_address(name="My House", country='BR')
+            shipping_address.postal_code = postal_code
+            source.shipping_address = shipping_address
+
+            # rejeitado localmente, sem consultar os Correios
+            errors = bc.get_unavailability_reasons(service, source)
+            assert len(errors) == 1
+            assert errors[0].code == code
+            assert not list(bc.get_costs(service, source))
+            assert bc.get_delivery_time(service, source) is None
+            assert mocked.call_count == 0
+
+        shipping_address.postal_code = "89070210"
+        assert not bc.get_unavailability_reasons(service, source)
+        assert mocked.call_count == 1
+
+    settings.CORREIOS_CEP_INDEX_PATH = None
+    reset_cep_index()
+
+
+@pytest.mark.django_db
+def test_correios_quote_deadline(settings, admin_user):
+    settings.CORREIOS_QUOTE_DEADLINE = 0
+
+    pac_carrier = get_correios_carrier_2()
+    service = ShippingMethod.objects.filter(carrier=pac_carrier).first()
+    bc = service.behavior_components.first()
+    bc.cep_origem = '89070400'
+    bc.save()
+
+    p1 = create_product(sku='p1',
+                        supplier=get_default_supplier(),
+                        width=400,
+                        depth=400,
+                        height=400,
+                        gross_weight=1250)
+
+    source = seed_source(admin_user)
+    source.add_line(
+        type=OrderLineType.PRODUCT,
+        product=p1,
+        supplier=get_default_supplier(),
+        quantity=1,
+        base_unit_price=source.create_price(10))
+    shipping_address = get_address(name="My House", country='BR')
+    shipping_address.postal_code = "89070210"
+    source.shipping_address = shipping_address
+
+    # prazo esgotado: informa a indisponibilidade sem consultar os Correios
+    with patch.object(get_transport(), 'post') as mocked:
+        errors = bc.get_unavailability_reasons(service, source)
+        assert len(errors) == 1
+        assert errors[0].code == "correios_unavailable"
+        assert not list(bc.get_costs(service, source))
+        assert bc.get_delivery_time(service, source) is None
+        assert mocked.call_count == 0
+
+
+@pytest.mark.django_db
+def test_correios_fallback(settings, admin_user):
+    settings.CORREIOS_WEBSERVICE_RETRIES = 0
+    settings.CORREIOS_FALLBACK_PROVIDERS = ()
+    reset_fallback_providers()
+
+    pac_carrier = get_correios_carrier_2()
+    service = ShippingMethod.objects.filter(carrier=pac_carrier).first()
+    bc = service.behavior_components.first()
+    bc.cep_origem = '89070400'
+    bc.save()
+
+    p1 = create_product(sku='p1',
+                        supplier=get_default_supplier(),
+                        width=400,
+                        depth=400,
+                        height=400,
+                        gross_weight=1250)
+
+    def get_source():
+        source = seed_source(admin_user)
+        source.add_line(
+            type=OrderLineType.PRODUCT,
+            product=p1,
+            supplier=get_default_supplier(),
+            quantity=1,
+            base_unit_price=source.create_price(10))
+        shipping_address = get_address(name="My House", country='BR')
+        shipping_address.postal_code = "89070210"
+        source.shipping_address = shipping_address
+        source.shipping_method = service
+        return source
+
+    with patch.object(get_transport(), 'post', side_effect=requests.exceptions.ConnectionError()):
+        # sem contingência, o serviço fica indisponível em vez de gerar um erro
+        source = get_source()
+        errors = bc.get_unavailability_reasons(service, source)
+        assert len(errors) == 1
+        assert errors[0].code == "correios_unavailable"
+        assert not list(bc.get_costs(service, source))
+
+        settings.CORREIOS_FALLBACK_PROVIDERS = ("shuup_correios.fallback.FlatRateProvider",)
+        settings.CORREIOS_FALLBACK_FLAT_RATES = {CorreiosServico.PAC: ("45.00", 10)}
+        reset_fallback_providers()
+
+        # preço fixo da contingência e pedido marcado para revisão
+        source = get_source()
+        assert not bc.get_unavailability_reasons(service, source)
+        costs = list(bc.get_costs(service, source))
+        assert len(costs) == 1
+        assert costs[0].price.value == Decimal("45.00") + bc.additional_price
+        assert bc.get_delivery_time(service, source).max_duration.days == 10 + bc.additional_delivery_time
+        assert source.shipping_data["correios_fallback"] is True
+
+    reset_fallback_providers()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from decimal import Decimal
+
+from django.core.cache import caches
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.packing import (PackageDimensions, get_basket_fingerprint,
+                                    get_packages)
+from shuup_correios_tests import create_package
+
+PACKING_KEY = (Decimal(30), Decimal(800), Decimal(600), Decimal(400), Decimal(2000))
+
+
+def _get_source(*lines):
+    source = Mock()
+    source.get_lines.return_value = [
+        Mock(product=Mock(pk=pk, width=100, depth=200, height=weight / 10, gross_weight=weight), quantity=quantity)
+        for pk, quantity, weight in lines
+    ] + [Mock(product=None)]
+    del source._correios_packings
+    return source
+
+
+def _pack(source):
+    return [create_package(Decimal(1500), width=Decimal(100), length=Decimal(200), height=Decimal(150))]
+
+
+def test_basket_fingerprint():
+    fingerprint = get_basket_fingerprint(_get_source((1, 2, 500), (2, 1, 1000)))
+
+    # a ordem das linhas não importa
+    assert fingerprint == get_basket_fingerprint(_get_source((2, 1, 1000), (1, 2, 500)))
+
+    assert fingerprint != get_basket_fingerprint(_get_source((1, 3, 500), (2, 1, 1000)))
+    assert fingerprint != get_basket_fingerprint(_get_source((1, 2, 600), (2, 1, 1000)))
+
+
+def test_get_packages(settings):
+    settings.CORREIOS_PACKING_CACHE_TTL = 60
+    cache = caches["default"]
+    cache.clear()
+    pack = Mock(side_effect=_pack)
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        source = _get_source((1, 2, 500))
+        packages = get_packages(source, PACKING_KEY, pack)
+        assert packages == [PackageDimensions(Decimal(1500), Decimal(100), Decimal(200), Decimal(150))]
+
+        # mesma requisição e mesmo carrinho em outra requisição: não empacota novamente
+        assert get_packages(source, PACKING_KEY, pack) == packages
+        assert get_packages(_get_source((1, 2, 500)), PACKING_KEY, pack) == packages
+        assert pack.call_count == 1
+
+        # outras restrições ou outro carrinho
+        get_packages(source, PACKING_KEY[:-1] + (Decimal(1000),), pack)
+        get_packages(_get_source((1, 3, 500)), PACKING_KEY, pack)
+        assert pack.call_count == 3
+
+        # carrinhos impossíveis de empacotar também são memorizados
+        impossible = Mock(return_value=None)
+        assert get_packages(_get_source((5, 1, 90000)), PACKING_KEY, impossible) is None
+        assert get_packages(_get_source((5, 1, 90000)), PACKING_KEY, impossible) is None
+        assert impossible.call_count == 1
+
+        # sem o cache, apenas a requisição atual é memorizada
+        settings.CORREIOS_PACKING_CACHE_TTL = 0
+        cache.clear()
+        source = _get_source((1, 2, 500))
+        get_packages(source, PACKING_KEY, pack)
+        get_packages(source, PACKING_KEY, pack)
+        get_packages(_get_source((1, 2, 500)), PACKING_KEY, pack)
+        assert pack.call_count == 5
+
+    cache.clear()
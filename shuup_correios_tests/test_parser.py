@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import xmltodict
+from xml.parsers.expat import ExpatError
+
+from shuup_correios.correios import CorreiosServico, CorreiosWS
+from shuup_correios.parser import parse_servicos
+from shuup_correios_tests.benchmarks.server import build_response
+
+COD_SERVICOS = [CorreiosServico.PAC, CorreiosServico.SEDEX, CorreiosServico.SEDEX_10,
+                CorreiosServico.SEDEX_A_COBRAR, CorreiosServico.SEDEX_HOJE, CorreiosServico.ESEDEX]
+
+
+@pytest.mark.parametrize("quantidade", range(1, len(COD_SERVICOS) + 1))
+def test_parse_servicos_xmltodict(quantidade):
+    text = build_response(COD_SERVICOS[:quantidade], erro=-888)
+
+    servicos = xmltodict.parse(text)["Servicos"]["cServico"]
+    if not isinstance(servicos, list):
+        servicos = [servicos]
+
+    assert parse_servicos(text.encode("iso-8859-1")) == [dict(servico) for servico in servicos]
+    assert parse_servicos(text) == [dict(servico) for servico in servicos]
+
+
+def test_parse_servicos_encoding():
+    content = ('<?xml version="1.0" encoding="ISO-8859-1" ?>'
+               '<Servicos><cServico><Codigo>04510</Codigo><Erro>-3</Erro>'
+               '<MsgErro>CEP de destino inválido &amp; não atendido</MsgErro>'
+               '<obsFim><![CDATA[ Observação ]]></obsFim><Valor/>'
+               '<EntregaSabado> </EntregaSabado></cServico></Servicos>').encode("iso-8859-1")
+
+    servico = parse_servicos(content)[0]
+    assert servico == {
+        "Codigo": "04510",
+        "Erro": "-3",
+        "MsgErro": "CEP de destino inválido & não atendido",
+        "obsFim": "Observação",
+        "Valor": None,
+        "EntregaSabado": None
+    }
+
+    # sem declaração, assume UTF-8
+    content = "<Servicos><cServico><Codigo>04510</Codigo><MsgErro>São Paulo</MsgErro></cServico></Servicos>"
+    assert parse_servicos(content.encode("utf-8"))[0]["MsgErro"] == "São Paulo"
+
+
+def test_parse_servicos_fallback():
+    assert parse_servicos(b"<Servicos></Servicos>") is None
+
+    # os resultados são os mesmos do parser completo
+    results = CorreiosWS._parse_servicos(build_response([CorreiosServico.PAC, CorreiosServico.SEDEX]).encode("iso-8859-1"))
+    assert [result.codigo for result in results] == [CorreiosServico.PAC, CorreiosServico.SEDEX]
+    assert results[1].valor == results[1].valor_sem_adicionais
+    assert results[1].prazo_entrega == 3
+    assert results[0].entrega_domiciliar and not results[0].entrega_sabado
+
+    # conteúdo inválido continua gerando erro
+    with pytest.raises(ExpatError):
+        CorreiosWS._parse_servicos(b"<html>Service Unavailable")
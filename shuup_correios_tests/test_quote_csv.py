@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import csv
+import io
+
+import pytest
+import requests
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.correios import CorreiosServico
+from shuup_correios.management.commands.correios_quote_csv import (Command,
+                                                                   parse_servicos)
+from shuup_correios.transport import get_transport
+from shuup_correios_tests.benchmarks.server import build_response
+
+INPUT = """cep_origem,cep_destino,peso,largura,comprimento,altura,servicos
+89070400,89070210,1000,110,160,20,PAC
+89070400,89070210,1000,110,160,20,41106
+89070400,01310100,2000,200,200,200,PAC;SEDEX
+89070400,,1000,110,160,20,PAC
+89070400,89070210,1000,110,160,20,PAC
+"""
+
+
+def _run(tmpdir, content, **options):
+    input_path = tmpdir.join("entrada.csv")
+    input_path.write(content)
+    output_path = tmpdir.join("saida.csv")
+
+    call_command(Command(), str(input_path), output=str(output_path), stderr=io.StringIO(), **options)
+
+    with io.open(str(output_path), encoding="utf-8", newline="") as output_file:
+        return list(csv.DictReader(output_file))
+
+
+def test_parse_servicos():
+    assert parse_servicos("PAC; 40010 pac") == [CorreiosServico.PAC, CorreiosServico.SEDEX]
+
+    with pytest.raises(CommandError):
+        parse_servicos("CARTA")
+
+    with pytest.raises(CommandError):
+        parse_servicos(" ; ")
+
+
+def test_quote_csv(tmpdir):
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC, CorreiosServico.SEDEX])
+                    .encode("iso-8859-1"))
+
+    with patch.object(get_transport(), "post", return_value=response) as mock:
+        rows = _run(tmpdir, INPUT, workers=2, window=10)
+
+    # as linhas iguais em andamento compartilham a mesma requisição
+    assert mock.call_count == 2
+
+    assert [(row["linha"], row["servico"]) for row in rows] == [
+        ("2", CorreiosServico.PAC),
+        ("3", CorreiosServico.PAC),
+        ("4", CorreiosServico.PAC),
+        ("4", CorreiosServico.SEDEX),
+        ("5", ""),
+        ("6", CorreiosServico.PAC),
+    ]
+    assert rows[0]["erro"] == "0"
+    assert rows[0]["valor"] == rows[1]["valor"] == rows[5]["valor"]
+    assert "CEP de destino inválido" in rows[4]["msg_erro"]
+
+
+def test_quote_csv_window(tmpdir):
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC, CorreiosServico.SEDEX])
+                    .encode("iso-8859-1"))
+
+    # com apenas uma linha em andamento, as repetições são requisitadas novamente
+    # (o cache dos testes não armazena valores)
+    with patch.object(get_transport(), "post", return_value=response) as mock:
+        rows = _run(tmpdir, INPUT, workers=1, window=1)
+
+    assert mock.call_count == 4
+    assert len(rows) == 6
+
+
+def test_quote_csv_cep_index(settings, tmpdir):
+    from shuup_correios.cep_index import reset_cep_index
+    from shuup_correios_tests.test_cep_index import build_cep_index
+
+    settings.CORREIOS_CEP_INDEX_PATH = build_cep_index(tmpdir)
+    reset_cep_index()
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+
+    # CEPs fora do índice são rejeitados sem consultar o webservice
+    with patch.object(get_transport(), "post", return_value=response) as mock:
+        rows = _run(tmpdir, INPUT.replace("01310100", "99999999"), workers=1, window=1)
+
+    assert mock.call_count == 3
+    assert "CEP de destino não encontrado" in rows[2]["msg_erro"]
+
+    settings.CORREIOS_CEP_INDEX_PATH = None
+    reset_cep_index()
+
+
+def test_quote_csv_errors(tmpdir):
+    with pytest.raises(CommandError):
+        _run(tmpdir, "cep_origem,cep_destino,peso\n89070400,89070210,1000\n")
+
+    with patch.object(shuup_correios.correios.circuit_breaker, "allow_request", return_value=False):
+        with pytest.raises(CommandError):
+            _run(tmpdir, INPUT)
+
+
+def test_quote_csv_leading_zero(tmpdir):
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+
+    # CEP que perdeu o zero à esquerda na planilha
+    with patch.object(get_transport(), "post", return_value=response) as mock:
+        rows = _run(tmpdir, INPUT.splitlines()[0] + "\n89070400,1310100,1000,110,160,20,PAC\n")
+
+    assert rows[0]["erro"] == "0"
+    assert mock.call_args[1]["params"]["sCepDestino"] == "01310100"
+
+
+def test_quote_csv_connection_error(settings, tmpdir):
+    settings.CORREIOS_WEBSERVICE_RETRIES = 0
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC, CorreiosServico.SEDEX])
+                    .encode("iso-8859-1"))
+
+    # a falha de conexão é gravada na linha e as demais linhas continuam
+    with patch.object(get_transport(), "post") as mock:
+        mock.side_effect = [requests.exceptions.ConnectionError()] + [response] * 3
+        rows = _run(tmpdir, INPUT, workers=1, window=1)
+
+    assert "ConnectionError" in rows[0]["msg_erro"]
+    assert rows[1]["erro"] == "0"
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+from decimal import Decimal
+
+from shuup_correios.correios import CorreiosServico
+from shuup_correios.rate_table import (RATE_NOT_FOUND_ERROR, RateTable,
+                                       get_rate_table, reset_rate_table)
+from shuup_correios_tests import create_package
+
+RATE_TABLE_PATH = os.path.join(os.path.dirname(__file__), "data", "rate_table.csv")
+DIMENSIONS = {"width": Decimal(160), "length": Decimal(110), "height": Decimal(20)}
+
+
+def test_rate_table_lookup():
+    table = RateTable.load(RATE_TABLE_PATH)
+    assert table.size == 9
+
+    result = table.get_preco_prazo("89070-210", "89070400", CorreiosServico.PAC,
+                                   create_package(Decimal(250), **DIMENSIONS))
+    assert result.erro == 0
+    assert result.codigo == CorreiosServico.PAC
+    assert result.valor == Decimal("16.10")
+    assert result.prazo_entrega == 3
+
+    # faixa de peso seguinte
+    result = table.get_preco_prazo("89070210", "89070400", CorreiosServico.PAC,
+                                   create_package(Decimal(301), **DIMENSIONS))
+    assert result.valor == Decimal("17.80")
+
+    # outra faixa de destino, CEP sem o zero à esquerda
+    result = table.get_preco_prazo("1310100", "89070400", CorreiosServico.PAC,
+                                   create_package(Decimal(1500), **DIMENSIONS))
+    assert result.valor == Decimal("31.30")
+    assert result.prazo_entrega == 6
+
+    # valores com ponto decimal e separador de milhar
+    result = table.get_preco_prazo("89070210", "89070400", "40010",
+                                   create_package(Decimal(1500), **DIMENSIONS))
+    assert result.valor == Decimal("1032.60")
+
+    # serviços adicionais
+    result = table.get_preco_prazo("89070210", "89070400", CorreiosServico.PAC,
+                                   create_package(Decimal(250), **DIMENSIONS),
+                                   mao_propria=True, aviso_recebimento=True)
+    assert result.valor_sem_adicionais == Decimal("16.10")
+    assert result.valor == Decimal("16.10") + Decimal("5.50") + Decimal("3.70")
+
+
+def test_rate_table_brackets(settings):
+    settings.CORREIOS_WEIGHT_BRACKETS = (300, 1000, 2000)
+    row = {"servico": CorreiosServico.PAC, "cep_origem_inicial": "89000000", "cep_origem_final": "89999999",
+           "cep_destino_inicial": "89000000", "cep_destino_final": "89999999"}
+    table = RateTable([dict(row, peso="300", valor="16,10", prazo="3"),
+                       dict(row, peso="500", valor="17,00", prazo="3"),
+                       dict(row, peso="1000", valor="17,80", prazo="3")])
+
+    # faixa de 500 g, que não está em CORREIOS_WEIGHT_BRACKETS
+    result = table.get_preco_prazo("89070210", "89070400", CorreiosServico.PAC,
+                                   create_package(Decimal(400), **DIMENSIONS))
+    assert result.valor == Decimal("17.00")
+
+    result = table.get_preco_prazo("89070210", "89070400", CorreiosServico.PAC,
+                                   create_package(Decimal(501), **DIMENSIONS))
+    assert result.valor == Decimal("17.80")
+
+
+def test_rate_table_not_found():
+    table = RateTable.load(RATE_TABLE_PATH)
+    package = create_package(Decimal(250), **DIMENSIONS)
+
+    # serviço, origem, destino e peso desconhecidos
+    assert table.get_preco_prazo("89070210", "89070400", CorreiosServico.SEDEX_10, package) is None
+    assert table.get_preco_prazo("89070210", "70000000", CorreiosServico.PAC, package) is None
+    assert table.get_preco_prazo("70000000", "89070400", CorreiosServico.PAC, package) is None
+    assert table.get_preco_prazo("89070210", "89070400", CorreiosServico.PAC,
+                                 create_package(Decimal(2500), **DIMENSIONS)) is None
+
+    # valor declarado não é suportado
+    assert table.get_preco_prazo("89070210", "89070400", CorreiosServico.PAC, package,
+                                 valor_declarado=Decimal(100)) is None
+
+    result = RateTable.get_not_found_result(CorreiosServico.PAC)
+    assert result.erro == RATE_NOT_FOUND_ERROR
+    assert result.msg_erro
+
+
+def test_get_rate_table(settings):
+    reset_rate_table()
+    settings.CORREIOS_RATE_TABLE_PATH = None
+    assert get_rate_table() is None
+
+    settings.CORREIOS_RATE_TABLE_PATH = RATE_TABLE_PATH
+    table = get_rate_table()
+    assert table.size == 9
+    assert get_rate_table() is table
+
+    reset_rate_table()
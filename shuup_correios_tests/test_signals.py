@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import requests
+from django.core.cache import caches
+from django.dispatch import Signal
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+                                     CorreiosWSServerTimeoutException)
+from shuup_correios.signals import preco_prazo_requested, ws_request_finished
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+class Receiver(object):
+    def __init__(self, signal):
+        self.signal = signal
+        self.events = []
+
+    def __call__(self, sender, **kwargs):
+        self.events.append(kwargs)
+
+    def __enter__(self):
+        self.signal.connect(self, sender=CorreiosWS, weak=False)
+        return self
+
+    def __exit__(self, *args):
+        self.signal.disconnect(self, sender=CorreiosWS)
+
+
+def test_signals_not_sent_without_receivers():
+    args = ('89070210', '89070400', CorreiosServico.PAC, create_package())
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+    cache = caches["default"]
+    cache.clear()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        with patch.object(get_transport(), "post", return_value=response):
+            with patch.object(Signal, "send") as send:
+                CorreiosWS.get_preco_prazo(*args)
+                CorreiosWS.get_cached_preco_prazo(*args)
+                assert not send.called
+
+    cache.clear()
+
+
+def test_signals():
+    args = ('89070210', '89070400', CorreiosServico.PAC, create_package())
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC, CorreiosServico.SEDEX]).encode("iso-8859-1"))
+    cache = caches["default"]
+    cache.clear()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        with Receiver(preco_prazo_requested) as requested, Receiver(ws_request_finished) as finished:
+            with patch.object(get_transport(), "post", return_value=response):
+                CorreiosWS.get_preco_prazo(*args, servicos_adicionais=[CorreiosServico.SEDEX])
+
+                assert len(requested.events) == 1
+                event = requested.events[0]
+                assert event["cache_hits"] == []
+                assert event["cache_misses"] == [CorreiosServico.PAC, CorreiosServico.SEDEX]
+                assert event["cache_only"] is False
+                assert event["duration"] >= 0
+                assert event["exception"] is None
+
+                assert len(finished.events) == 1
+                event = finished.events[0]
+                assert event["status_code"] == 200
+                assert event["http_duration"] >= 0
+                assert event["parse_duration"] >= 0
+                assert event["erros"] == {CorreiosServico.PAC: 0, CorreiosServico.SEDEX: 0}
+
+                # resultado do cache: sem requisição ao webservice
+                CorreiosWS.get_cached_preco_prazo(*args)
+                assert len(finished.events) == 1
+                assert requested.events[1]["cache_hits"] == [CorreiosServico.PAC]
+                assert requested.events[1]["cache_only"] is True
+
+            cache.clear()
+            with patch.object(get_transport(), "post", side_effect=requests.exceptions.Timeout("peeeee")):
+                with pytest.raises(CorreiosWSServerTimeoutException):
+                    CorreiosWS.get_preco_prazo(*args)
+
+                assert isinstance(requested.events[2]["exception"], CorreiosWSServerTimeoutException)
+                event = finished.events[1]
+                assert event["status_code"] is None
+                assert event["parse_duration"] is None
+                assert isinstance(event["exception"], CorreiosWSServerTimeoutException)
+
+    cache.clear()
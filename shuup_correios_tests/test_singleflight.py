@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+import requests
+from django.core.cache import caches
+from mock import Mock, patch
+
+import shuup_correios
+from shuup_correios.correios import (CorreiosServico, CorreiosWS,
+                                     CorreiosWSServerTimeoutException)
+from shuup_correios.singleflight import SingleFlight
+from shuup_correios.transport import get_transport
+from shuup_correios_tests import create_package
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+def _run_threads(count, target):
+    results = []
+    errors = []
+
+    def run():
+        try:
+            results.append(target())
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    return results, errors
+
+
+def test_single_flight_do():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return "resultado"
+
+    leader = threading.Thread(target=flight.do, args=("chave", func))
+    leader.start()
+    started.wait(2)
+
+    followers = []
+    threads = [threading.Thread(target=lambda: followers.append(flight.do("chave", func))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(0.05)
+    release.set()
+    leader.join(2)
+    for thread in threads:
+        thread.join(2)
+
+    assert len(calls) == 1
+    assert followers == [("resultado", True)] * 3
+
+    # sem chamada em andamento a função é executada novamente
+    assert flight.do("chave", func) == ("resultado", False)
+    assert len(calls) == 2
+
+
+def test_single_flight_exception():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def func():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError("falhou")
+
+    leader = threading.Thread(target=lambda: pytest.raises(ValueError, flight.do, "chave", func))
+    leader.start()
+    started.wait(2)
+
+    with pytest.raises(ValueError):
+        flight.do("chave", func)
+
+    leader.join(2)
+
+
+def test_single_flight_timeout():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def func():
+        started.set()
+        release.wait(2)
+        return "resultado"
+
+    leader = threading.Thread(target=flight.do, args=("chave", func))
+    leader.start()
+    started.wait(2)
+
+    # a chamada em andamento não termina a tempo
+    with pytest.raises(FutureTimeoutError):
+        flight.do("chave", func, 0.05)
+
+    release.set()
+    leader.join(2)
+
+
+def test_get_preco_prazo_coalesced(settings):
+    settings.CORREIOS_SINGLE_FLIGHT = True
+    settings.CORREIOS_SINGLE_FLIGHT_CACHE_LOCK = False
+    args = ('89070210', '89070400', CorreiosServico.PAC, create_package())
+    cache = caches["default"]
+    cache.clear()
+
+    def slow_post(*args, **kwargs):
+        time.sleep(0.2)
+        return Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        with patch.object(get_transport(), "post", side_effect=slow_post) as mock:
+            results, errors = _run_threads(5, lambda: CorreiosWS.get_preco_prazo(*args))
+            assert not errors
+            assert len(results) == 5
+            assert mock.call_count == 1
+            assert all(result.valor == results[0].valor for result in results)
+
+        cache.clear()
+
+        def slow_timeout(*args, **kwargs):
+            time.sleep(0.2)
+            raise requests.exceptions.Timeout("peeeee")
+
+        # a exceção do webservice também é repassada a quem aguardava
+        with patch.object(get_transport(), "post", side_effect=slow_timeout) as mock:
+            results, errors = _run_threads(5, lambda: CorreiosWS.get_preco_prazo(*args))
+            assert not results
+            assert len(errors) == 5
+            assert all(isinstance(error, CorreiosWSServerTimeoutException) for error in errors)
+            assert mock.call_count == 1
+
+    cache.clear()
+
+
+def test_get_preco_prazo_cache_lock(settings):
+    settings.CORREIOS_SINGLE_FLIGHT = True
+    settings.CORREIOS_SINGLE_FLIGHT_CACHE_LOCK = True
+    settings.CORREIOS_SINGLE_FLIGHT_POLL_INTERVAL = 0.01
+    package = create_package()
+    cache = caches["default"]
+    cache.clear()
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        request = CorreiosWS.PrecoPrazoRequest('89070210', '89070400', [CorreiosServico.PAC], package)
+        cache_keys = [request.cache_keys[CorreiosServico.PAC]]
+        lock_key = shuup_correios.correios._get_flight_lock_key(cache_keys)
+
+        # outro processo possui a trava e grava a cotação no cache
+        cache.add(lock_key, True)
+        response = Mock(status_code=200, content=build_response([CorreiosServico.PAC]).encode("iso-8859-1"))
+
+        def other_process():
+            time.sleep(0.1)
+            other_request = CorreiosWS.PrecoPrazoRequest('89070210', '89070400', [CorreiosServico.PAC], package)
+            other_request.process_response(response.status_code, response.content)
+
+        thread = threading.Thread(target=other_process)
+        thread.start()
+
+        with patch.object(get_transport(), "post", return_value=response) as mock:
+            result = CorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.PAC, package)
+            assert mock.call_count == 0
+            assert result.erro == 0
+
+        thread.join(2)
+
+        # sem trava, requisita e libera a trava ao final
+        cache.clear()
+        with patch.object(get_transport(), "post", return_value=response) as mock:
+            CorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.PAC, package)
+            assert mock.call_count == 1
+            assert cache.get(lock_key) is None
+
+        # o outro processo não terminou a tempo: requisita sem liberar a trava dele
+        cache.clear()
+        cache.add(lock_key, True)
+        settings.CORREIOS_WEBSERVICE_TIMEOUT = 0.2
+        settings.CORREIOS_WEBSERVICE_RETRIES = 0
+        with patch.object(get_transport(), "post", return_value=response) as mock:
+            CorreiosWS.get_preco_prazo('89070210', '89070400', CorreiosServico.PAC, package)
+            assert mock.call_count == 1
+            assert cache.get(lock_key) is True
+
+    cache.clear()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from mock import Mock, patch
+
+from shuup.utils.importing import clear_load_cache
+from shuup_correios.transport import (CorreiosTransport,
+                                      RequestsSessionTransport, get_transport,
+                                      reset_transport)
+
+
+class DummyTransport(CorreiosTransport):
+    def post(self, url, params=None, timeout=None):
+        return Mock(status_code=200, content=b"")
+
+
+def test_default_transport():
+    reset_transport()
+    transport = get_transport()
+
+    assert isinstance(transport, RequestsSessionTransport)
+    # a mesma instância é reutilizada
+    assert get_transport() is transport
+
+    reset_transport()
+    assert get_transport() is not transport
+
+
+def test_transport_pool():
+    transport = RequestsSessionTransport(pool_connections=3, pool_maxsize=7, pool_block=True)
+    adapter = transport.session.get_adapter("http://ws.correios.com.br/")
+
+    assert adapter._pool_connections == 3
+    assert adapter._pool_maxsize == 7
+    assert adapter._pool_block is True
+
+    with patch.object(transport.session, "post") as mock:
+        transport.post("http://ws.correios.com.br/", params={"a": 1}, timeout=2)
+        mock.assert_called_once_with("http://ws.correios.com.br/", params={"a": 1}, timeout=2)
+
+    transport.close()
+
+
+def test_custom_transport(settings):
+    settings.CORREIOS_WEBSERVICE_TRANSPORT_CLASS = "shuup_correios_tests.test_transport:DummyTransport"
+    clear_load_cache()
+    reset_transport()
+
+    assert isinstance(get_transport(), DummyTransport)
+
+    settings.CORREIOS_WEBSERVICE_TRANSPORT_CLASS = "shuup_correios.transport:RequestsSessionTransport"
+    clear_load_cache()
+    reset_transport()
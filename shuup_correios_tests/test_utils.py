@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+
+import pytest
+from shuup_correios.correios import CorreiosWSServerTimeoutException
+from shuup_correios.utils import run_concurrently
+
+
+def test_run_concurrently_order():
+    def slow_double(value):
+        # os primeiros itens demoram mais, mas a ordem deve ser mantida
+        time.sleep(0.01 * (5 - value))
+        return value * 2
+
+    assert run_concurrently(slow_double, range(5), 4) == [0, 2, 4, 6, 8]
+    assert run_concurrently(slow_double, range(5), 1) == [0, 2, 4, 6, 8]
+    assert run_concurrently(slow_double, [], 4) == []
+
+
+def test_run_concurrently_parallel():
+    barrier = threading.Barrier(3, timeout=2)
+
+    def wait(value):
+        # só passa se as três chamadas estiverem em execução ao mesmo tempo
+        barrier.wait()
+        return value
+
+    assert run_concurrently(wait, [1, 2, 3], 3) == [1, 2, 3]
+
+
+def test_run_concurrently_error():
+    executed = []
+
+    def fail_first(value):
+        if value == 0:
+            raise CorreiosWSServerTimeoutException()
+        time.sleep(0.05)
+        executed.append(value)
+        return value
+
+    with pytest.raises(CorreiosWSServerTimeoutException):
+        run_concurrently(fail_first, range(10), 2)
+
+    # as tarefas pendentes foram canceladas
+    time.sleep(0.2)
+    assert len(executed) < 9
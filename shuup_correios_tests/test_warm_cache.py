@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# This file is part of Shuup Correios.
+#
+# Copyright (c) 2016, Rockho Team. All rights reserved.
+# Author: Christian Hess
+#
+# This source code is licensed under the AGPLv3 license found in the
+# LICENSE file in the root directory of this source tree.
+
+from decimal import Decimal
+
+import pytest
+import requests
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from mock import Mock, patch
+from shuup.testing.factories import get_default_shop, get_default_tax_class
+
+import shuup_correios
+from shuup_correios.correios import CorreiosServico
+from shuup_correios.management.commands.correios_warm_cache import (parse_cep,
+                                                                    parse_package)
+from shuup_correios.models import CorreiosCarrier
+from shuup_correios.transport import get_transport
+from shuup_correios_tests.benchmarks.server import build_response
+
+
+def test_parse_arguments():
+    assert parse_cep("89070-210") == "89070210"
+    assert parse_cep("1310100") == "01310100"
+
+    # prefixos não são aceitos
+    for cep in ("890702100", "8907", ""):
+        with pytest.raises(CommandError):
+            parse_cep(cep)
+
+    package = parse_package("1000, 110,160,20")
+    assert package.weight == Decimal(1000)
+    assert package.height == Decimal(20)
+
+    with pytest.raises(CommandError):
+        parse_package("1000,110,160")
+
+    with pytest.raises(CommandError):
+        parse_package("1000,110,abc,20")
+
+
+@pytest.mark.django_db
+def test_warm_cache(settings):
+    settings.CORREIOS_WEBSERVICE_RETRIES = 1
+    settings.CORREIOS_WEBSERVICE_RETRY_BACKOFF = 0
+    carrier = CorreiosCarrier.objects.create(name="Correios")
+    for servico in ("PAC", "SEDEX"):
+        carrier.create_service(
+            servico,
+            shop=get_default_shop(),
+            enabled=True,
+            tax_class=get_default_tax_class(),
+            name="Correios " + servico)
+
+    cache = caches["default"]
+    cache.clear()
+    response = Mock(status_code=200, content=build_response([CorreiosServico.PAC, CorreiosServico.SEDEX]).encode("iso-8859-1"))
+
+    with pytest.raises(CommandError):
+        call_command("correios_warm_cache", ceps=["89070210"])
+
+    with patch.object(shuup_correios.correios, "get_correios_cache", return_value=cache):
+        with patch.object(get_transport(), "post", return_value=response) as mock:
+            call_command("correios_warm_cache", ceps=["89070210"], packages=["1000,110,160,20"])
+
+            # os dois serviços são cotados na mesma requisição
+            assert mock.call_count == 1
+            params = mock.call_args[1]["params"]
+            assert params["sCepDestino"] == "89070210"
+            assert params["nCdServico"] == "{0},{1}".format(CorreiosServico.PAC, CorreiosServico.SEDEX)
+
+            # executar novamente não requisita o que já está no cache
+            call_command("correios_warm_cache", ceps=["89070210"], packages=["1000,110,160,20", "2000,110,160,20"])
+            assert mock.call_count == 2
+
+            call_command("correios_warm_cache", ceps=["89070210"], packages=["1000,110,160,20"], force=True)
+            assert mock.call_count == 3
+
+        with patch.object(get_transport(), "post", side_effect=requests.exceptions.Timeout("peeeee")) as mock:
+            # falhas são informadas, mas não interrompem o comando
+            call_command("correios_warm_cache", ceps=["88000000"], packages=["1000,110,160,20"])
+            assert mock.call_count == 1
+
+        # o erro de conexão também é contado como falha
+        with patch.object(get_transport(), "post", side_effect=requests.exceptions.ConnectionError()) as mock:
+            call_command("correios_warm_cache", ceps=["88010000"], packages=["1000,110,160,20"])
+            assert mock.call_count == 2
+
+    cache.clear()